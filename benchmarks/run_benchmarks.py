@@ -0,0 +1,393 @@
+#!/usr/bin/python
+'''
+Benchmarks the merge and plotting code on synthetic detector data (see
+synthetic_data), recording frames/s, MB/s and the peak memory (RSS) of each
+benchmark in a JSON file, so that runs can be compared over time (--compare).
+
+Each benchmark is run in a fresh process, so that its peak memory is its own
+and not that of whatever ran before it. Benchmarks which need something that
+isn't installed (e.g. matplotlib) are recorded as skipped.
+'''
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows; peak memory isn't recorded there
+    resource = None
+
+import synthetic_data
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLOTTING_DIR = os.path.join(REPO_DIR, 'plotting')
+
+
+def _import_merge():
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    from data_handling import merge
+    return merge
+
+
+def _import_merge_new():
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    from data_handling import merge_new
+    return merge_new
+
+
+def _import_plotting():
+    if PLOTTING_DIR not in sys.path:
+        sys.path.insert(0, PLOTTING_DIR)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import histogram_applicator
+    return histogram_applicator
+
+
+def _import_merged_writer():
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    from data_handling import accumulators, merged_writer
+    return accumulators, merged_writer
+
+
+def _import_histogram_limits():
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    from data_handling import histogram_limits
+    return histogram_limits
+
+
+'''
+Each benchmark does its setup (imports, reading frames it needs in memory)
+and returns (run, n_frames): only run() is timed, and n_frames is the number
+of frames it handles.
+'''
+def bench_merge_plain(series, file_format, options):
+    merge = _import_merge()
+    file_list = series.files(file_format)
+    return lambda: merge.merge_files(file_list, readers=options.readers), len(file_list)
+
+
+def bench_merge_windowed(series, file_format, options):
+    merge = _import_merge()
+    file_list = series.files(file_format)
+    return lambda: merge.merge_files(file_list, window=options.window, readers=options.readers, workers=options.workers), len(file_list)
+
+
+def bench_merge_new_windowed(series, file_format, options):
+    merge_new = _import_merge_new()
+    file_nums = list(range(series.n_frames))
+    windows = [file_nums[i:i + options.window] for i in range(0, len(file_nums), options.window)]
+    return lambda: merge_new.merge(series.basename, windows, file_format, window=True, readers=options.readers, workers=options.workers), series.n_frames
+
+
+def bench_merge_hdf_range(series, file_format, options):
+    merge = _import_merge()
+    first, last = hdf_range(series, options)
+    return lambda: merge.merge_hdf(series.hdf_file, synthetic_data.HDF_DSET_PATH, first, last), last - first + 1
+
+
+def bench_merge_hdf_windowed(series, file_format, options):
+    merge = _import_merge()
+    first, last = hdf_range(series, options)
+    return lambda: merge.merge_hdf(series.hdf_file, synthetic_data.HDF_DSET_PATH, first, last, window=options.window), last - first + 1
+
+
+def bench_merge_frames(series, file_format, options, window=None):
+    merge = _import_merge()
+    import h5py
+    first, last = hdf_range(series, options)
+    hdf_file = h5py.File(series.hdf_file, 'r')
+    dataset = hdf_file[synthetic_data.HDF_DSET_PATH]
+    return lambda: merge.merge_frames(dataset, (first, last), window=window), last - first + 1
+
+
+def bench_merge_frames_windowed(series, file_format, options):
+    return bench_merge_frames(series, file_format, options, window=options.window)
+
+
+'''
+Writes the windows of the whole series, merged in memory beforehand, to an hdf
+file through MergedWriter, as the merges stream them; only the writing is
+timed. n_frames counts the frames the windows were merged from.
+'''
+def bench_write_windows(series, file_format, options, compression=None):
+    accumulators, merged_writer = _import_merged_writer()
+    n_windows = series.n_frames // options.window
+    frames = np.stack(list(synthetic_data.make_frames(n_windows * options.window, series.shape, series.dtype)))
+    merged = accumulators.reduce_stack(frames, window=options.window)
+    del frames
+    out_dir = tempfile.mkdtemp(dir=series.directory)
+    def run():
+        with merged_writer.MergedWriter(os.path.join(out_dir, 'merged.h5'), compression=compression) as writer:
+            writer.write(merged)
+    return run, n_windows * options.window
+
+
+def bench_write_windows_lzf(series, file_format, options):
+    return bench_write_windows(series, file_format, options, compression='lzf')
+
+
+def bench_write_windows_gzip(series, file_format, options):
+    return bench_write_windows(series, file_format, options, compression='gzip')
+
+
+def bench_histogram_limits(series, file_format, options, sample=None):
+    histogram_limits = _import_histogram_limits()
+    frames = list(synthetic_data.make_frames(min(options.render_frames, series.n_frames), series.shape, series.dtype))
+    def run():
+        for frame in frames:
+            histogram_limits.histo_lims(frame, sample=sample)
+    return run, len(frames)
+
+
+def bench_histogram_limits_sampled(series, file_format, options):
+    return bench_histogram_limits(series, file_format, options, sample=options.sample)
+
+
+def bench_histogram_limits_global(series, file_format, options):
+    histogram_limits = _import_histogram_limits()
+    frames = list(synthetic_data.make_frames(min(options.render_frames, series.n_frames), series.shape, series.dtype))
+    def run():
+        accumulator = histogram_limits.HistogramAccumulator()
+        for frame in frames:
+            accumulator.add(frame)
+        accumulator.limits()
+    return run, len(frames)
+
+
+def bench_plot_img(series, file_format, options):
+    histogram_applicator = _import_plotting()
+    file_list = series.files(file_format)[:options.render_frames]
+    out_dir = tempfile.mkdtemp(dir=series.directory)
+    def run():
+        for i, file_name in enumerate(file_list):
+            histogram_applicator.plot_img(file_name, name=os.path.join(out_dir, str(i)))
+    return run, len(file_list)
+
+
+def bench_render_batch(series, file_format, options):
+    histogram_applicator = _import_plotting()
+    file_list = series.files(file_format)[:options.render_frames]
+    out_dir = tempfile.mkdtemp(dir=series.directory)
+    return lambda: histogram_applicator.render_batch(file_list, workers=options.workers, out_dir=out_dir), len(file_list)
+
+
+def bench_preview(series, file_format, options, downsample=1):
+    histogram_applicator = _import_plotting()
+    file_list = series.files(file_format)[:options.render_frames]
+    out_dir = tempfile.mkdtemp(dir=series.directory)
+    preview = {'image_format': 'png', 'downsample': downsample}
+    return lambda: histogram_applicator.render_batch(file_list, workers=options.workers, out_dir=out_dir, preview=preview), len(file_list)
+
+
+def bench_preview_downsampled(series, file_format, options):
+    return bench_preview(series, file_format, options, downsample=4)
+
+
+def bench_preview_hdf(series, file_format, options):
+    histogram_applicator = _import_plotting()
+    import image_sources
+    frames = image_sources.hdf_frames(series.hdf_file, synthetic_data.HDF_DSET_PATH, 0, min(options.render_frames, series.n_frames) - 1)
+    out_dir = tempfile.mkdtemp(dir=series.directory)
+    preview = {'image_format': 'png'}
+    return lambda: histogram_applicator.render_batch(frames, workers=options.workers, out_dir=out_dir, preview=preview), len(frames)
+
+
+# name -> (benchmark, file formats it is run for)
+BENCHMARKS = collections.OrderedDict([
+    ('merge_plain', (bench_merge_plain, ['tif', 'edf', 'edf.gz'])),
+    ('merge_windowed', (bench_merge_windowed, ['tif', 'edf', 'edf.gz'])),
+    ('merge_new_windowed', (bench_merge_new_windowed, ['tif', 'edf'])),
+    ('merge_hdf_range', (bench_merge_hdf_range, ['h5'])),
+    ('merge_hdf_windowed', (bench_merge_hdf_windowed, ['h5'])),
+    ('merge_frames', (bench_merge_frames, ['h5'])),
+    ('merge_frames_windowed', (bench_merge_frames_windowed, ['h5'])),
+    ('write_windows', (bench_write_windows, [None])),
+    ('write_windows_lzf', (bench_write_windows_lzf, [None])),
+    ('write_windows_gzip', (bench_write_windows_gzip, [None])),
+    ('histogram_limits', (bench_histogram_limits, [None])),
+    ('histogram_limits_sampled', (bench_histogram_limits_sampled, [None])),
+    ('histogram_limits_global', (bench_histogram_limits_global, [None])),
+    ('plot_img', (bench_plot_img, ['tif'])),
+    ('render_batch', (bench_render_batch, ['tif'])),
+    ('preview', (bench_preview, ['tif'])),
+    ('preview_downsampled', (bench_preview_downsampled, ['tif'])),
+    ('preview_hdf', (bench_preview_hdf, ['h5'])),
+])
+
+
+'''
+Frames (first, last) merged by the hdf benchmarks: --hdf-range, or the
+whole series
+'''
+def hdf_range(series, options):
+    if options.hdf_range:
+        return options.hdf_range
+    return 0, series.n_frames - 1
+
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+
+'''
+Runs one benchmark (in the process it is called in) and returns its result.
+Anything the merge code prints is thrown away, so that printing doesn't
+count towards the time.
+'''
+def run_benchmark(name, file_format, series, options):
+    result = {'name': name if file_format is None else '{}:{}'.format(name, file_format), 'benchmark': name, 'format': file_format}
+    benchmark = BENCHMARKS[name][0]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            run, n_frames = benchmark(series, file_format, options)
+        except ImportError as err:
+            result.update(status='skipped', reason=str(err))
+            return result
+        setup_rss = peak_rss_mb(resource.RUSAGE_SELF) if resource else None
+        started = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - started
+
+    result.update(status='ok', frames=n_frames, seconds=seconds,
+                  frames_per_s=n_frames / seconds, mb_per_s=n_frames * series.frame_bytes / seconds / 1024.**2,
+                  setup_rss_mb=setup_rss, peak_rss_mb=peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+                  peak_children_rss_mb=peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None)
+    return result
+
+
+'''
+Runs a benchmark repeat times, each in a new process, and keeps the fastest
+run (and the largest peak memory of any run)
+'''
+def run_repeated(name, file_format, series, options):
+    runs = []
+    for _ in range(options.repeat):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            runs.append(pool.submit(run_benchmark, name, file_format, series, options).result())
+    if runs[0]['status'] != 'ok':
+        return runs[0]
+
+    result = min(runs, key=lambda run: run['seconds'])
+    result['repeats'] = [run['seconds'] for run in runs]
+    for key in ['setup_rss_mb', 'peak_rss_mb', 'peak_children_rss_mb']:
+        if result[key] is not None:
+            result[key] = max(run[key] for run in runs)
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import h5py
+    return {'host': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'h5py': h5py.__version__, 'cpus': os.cpu_count(), 'git_commit': commit}
+
+
+'''
+Prints the change in frames/s of each benchmark since an earlier run
+'''
+def compare(results, config, previous_file):
+    with open(previous_file) as json_file:
+        previous_report = json.load(json_file)
+    if previous_report['config']['series'] != config['series']:
+        print('WARNING: {} was run on a different series ({})'.format(previous_file, previous_report['config']['series']))
+    previous = {result['name']: result for result in previous_report['results'] if result['status'] == 'ok'}
+    print('{:32s} {:>12s} {:>12s} {:>8s}'.format('Benchmark', 'Before fps', 'Now fps', 'Change'))
+    for result in results:
+        before = previous.get(result['name'])
+        if result['status'] != 'ok' or before is None:
+            continue
+        print('{:32s} {:12.1f} {:12.1f} {:+7.1f}%'.format(result['name'], before['frames_per_s'], result['frames_per_s'],
+                                                       100. * (result['frames_per_s'] / before['frames_per_s'] - 1)))
+
+
+def frame_shape(value):
+    return tuple(int(size) for size in value.lower().split('x'))
+
+
+def frame_range(value):
+    first, last = (int(frame) for frame in value.split(','))
+    return first, last
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks merging and plotting synthetic detector frames and writes the results as JSON')
+    parser.add_argument('-n', '--frames', type=int, default=100, help='Number of frames in the synthetic series')
+    parser.add_argument('-s', '--shape', type=frame_shape, default=(1024, 1024), help='Frame shape, as ROWSxCOLUMNS (default 1024x1024)')
+    parser.add_argument('-t', '--dtype', default='uint16', choices=sorted(synthetic_data.EDF_DATA_TYPES), help='Frame dtype')
+    parser.add_argument('-w', '--window', type=int, default=10, help='Window size for the windowed merges')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Worker processes for the windowed file merges and batch rendering')
+    parser.add_argument('--readers', type=int, default=1, help='Reader threads for the file merges')
+    parser.add_argument('--hdf-range', type=frame_range, default=None, help='First and last frames (FIRST,LAST) for the hdf merges (default all)')
+    parser.add_argument('--render-frames', type=int, default=10, help='Number of frames for the histogram and plotting benchmarks')
+    parser.add_argument('--sample', type=int, default=2**18, help='Pixels sampled from each frame for histogram_limits_sampled')
+    parser.add_argument('-b', '--benchmarks', default=','.join(BENCHMARKS), help='Comma separated benchmarks to run (default all: {})'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Runs of each benchmark (the fastest is kept)')
+    parser.add_argument('--data-dir', default=None, help='Directory for the synthetic series, which is kept for later runs (default a temporary directory)')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results (default benchmark-<time>.json)')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.benchmarks.split(',') if name.strip()]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmark(s) {}; should be some of {}'.format(', '.join(unknown), ', '.join(BENCHMARKS)))
+    if args.window < 1 or args.repeat < 1:
+        parser.error('--window and --repeat should be at least 1')
+    if args.hdf_range and not 0 <= args.hdf_range[0] <= args.hdf_range[1] < args.frames:
+        parser.error('--hdf-range should be within the {} frames'.format(args.frames))
+
+    created = datetime.datetime.now()
+    output = args.output or 'benchmark-{}.json'.format(created.strftime('%Y%m%d-%H%M%S'))
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='merge-benchmark-')
+    try:
+        series = synthetic_data.write_series(data_dir, args.frames, args.shape, args.dtype)
+        results = []
+        for name in names:
+            for file_format in BENCHMARKS[name][1]:
+                result = run_repeated(name, file_format, series, args)
+                if result['status'] == 'ok':
+                    print('{:32s} {:10.1f} frames/s {:10.1f} MB/s  peak RSS {} MB'.format(result['name'], result['frames_per_s'], result['mb_per_s'],
+                                                                                     'n/a' if result['peak_rss_mb'] is None else '{:.0f}'.format(result['peak_rss_mb'])))
+                else:
+                    print('{:32s} skipped ({})'.format(result['name'], result['reason']))
+                results.append(result)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {'created': created.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+              'config': dict(vars(args), shape=list(args.shape), series=series.info()), 'results': results}
+    with open(output, 'w') as json_file:
+        json.dump(report, json_file, indent=2)
+    print('Results written to {}'.format(output))
+
+    if args.compare:
+        compare(results, report['config'], args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import gzip
+import h5py
+import json
+import numpy as np
+import os
+import struct
+
+# edf.gz frames are gzip compressed EDF files, which can't be memory mapped and
+# so are decoded by fabio
+FORMATS = ['tif', 'edf', 'edf.gz', 'h5']
+HDF_DSET_PATH = 'entry/data'
+SERIES_BASENAME = 'bench'
+SERIES_INFO = 'series.json'
+
+# numpy dtype -> TIFF SampleFormat
+TIFF_SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+# numpy dtype -> EDF DataType
+EDF_DATA_TYPES = {'uint8': 'UnsignedByte', 'int8': 'SignedByte', 'uint16': 'UnsignedShort', 'int16': 'SignedShort',
+                  'uint32': 'UnsignedInteger', 'int32': 'SignedInteger', 'float32': 'FloatValue', 'float64': 'DoubleValue'}
+EDF_BLOCK_SIZE = 512
+# Quick to write, and about what detector software uses
+GZIP_LEVEL = 1
+
+
+'''
+A series of synthetic frames written to directory: one file per frame for
+each file format (named like a detector series, bench-00000.tif etc.) and one
+hdf file holding all of the frames in a single dataset (HDF_DSET_PATH).
+'''
+class SyntheticSeries(object):
+
+    def __init__(self, directory, n_frames, shape, dtype, formats=FORMATS):
+        self.directory = directory
+        self.n_frames = n_frames
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.formats = list(formats)
+
+    @property
+    def basename(self):
+        return os.path.join(self.directory, SERIES_BASENAME)
+
+    @property
+    def frame_bytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def hdf_file(self):
+        return self.basename + '.h5'
+
+    def files(self, file_format):
+        return ['{}-{:05d}.{}'.format(self.basename, i, file_format) for i in range(self.n_frames)]
+
+    def info(self):
+        return {'n_frames': self.n_frames, 'shape': list(self.shape), 'dtype': self.dtype.name, 'formats': self.formats}
+
+
+'''
+Yields n_frames synthetic diffraction frames: powder rings on a background,
+with counting (Poisson) noise and a few zingers per frame, so that the frames
+have a realistic spread of intensities for the histogram limits. Integer
+frames are clipped to the range of the dtype.
+'''
+def make_frames(n_frames, shape, dtype, seed=0):
+    dtype = np.dtype(dtype)
+    rng = np.random.default_rng(seed)
+    rows, cols = np.indices(shape, dtype=np.float32)
+    radius = np.hypot(rows - shape[0] / 2., cols - shape[1] / 2.)
+    pattern = np.full(shape, 50., dtype=np.float32)
+    for ring_radius, height in zip(np.linspace(0.1, 0.45, 6) * min(shape), [2000, 800, 1200, 400, 600, 300]):
+        pattern += height * np.exp(-0.5 * ((radius - ring_radius) / 2.)**2)
+
+    high = np.iinfo(dtype).max if dtype.kind in 'iu' else None
+    for _ in range(n_frames):
+        frame = rng.poisson(pattern).astype(np.float64)
+        zingers = rng.integers(0, frame.size, 10)
+        frame.flat[zingers] += rng.uniform(1e4, 6e4, len(zingers))
+        if high is not None:
+            np.clip(frame, 0, high, out=frame)
+        yield frame.astype(dtype)
+
+
+'''
+Writes a frame as an uncompressed, single strip, little endian TIFF
+'''
+def write_tiff(file_name, frame):
+    frame = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder('<'))
+    height, width = frame.shape
+    data_offset = 8
+    ifd_offset = data_offset + frame.nbytes
+    # tag, field type (3: short, 4: long), value
+    entries = [(256, 4, width), (257, 4, height), (258, 3, frame.dtype.itemsize * 8), (259, 3, 1), (262, 3, 1),
+               (273, 4, data_offset), (277, 3, 1), (278, 4, height), (279, 4, frame.nbytes),
+               (339, 3, TIFF_SAMPLE_FORMATS[frame.dtype.kind])]
+    with open(file_name, 'wb') as image_file:
+        image_file.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        image_file.write(frame.tobytes())
+        image_file.write(struct.pack('<H', len(entries)))
+        for tag, field_type, value in entries:
+            value = struct.pack('<H2x', value) if field_type == 3 else struct.pack('<I', value)
+            image_file.write(struct.pack('<HHI', tag, field_type, 1) + value)
+        image_file.write(struct.pack('<I', 0))
+
+
+'''
+Writes a frame as an uncompressed EDF file, with a header padded to a whole
+number of blocks (as ESRF software writes them)
+'''
+def write_edf(file_name, frame, frame_number=0):
+    with open(file_name, 'wb') as image_file:
+        image_file.write(edf_bytes(frame, frame_number))
+
+
+'''
+Writes a frame as a gzip compressed EDF file (see write_edf)
+'''
+def write_edf_gz(file_name, frame, frame_number=0):
+    with gzip.open(file_name, 'wb', compresslevel=GZIP_LEVEL) as image_file:
+        image_file.write(edf_bytes(frame, frame_number))
+
+
+def edf_bytes(frame, frame_number):
+    frame = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder('<'))
+    header = '{{\nHeaderID = EH:{:06d}:000000:000000 ;\nImage = {} ;\nByteOrder = LowByteFirst ;\nDataType = {} ;\nDim_1 = {} ;\nDim_2 = {} ;\nSize = {} ;\ncount_time = 1.0 ;\n'.format(
+        frame_number + 1, frame_number + 1, EDF_DATA_TYPES[frame.dtype.name], frame.shape[1], frame.shape[0], frame.nbytes)
+    padded_size = -(-(len(header) + 2) // EDF_BLOCK_SIZE) * EDF_BLOCK_SIZE
+    header += ' ' * (padded_size - len(header) - 2) + '}\n'
+    return header.encode('ascii') + frame.tobytes()
+
+
+'''
+Writes (or reuses) a synthetic series in directory. If the directory already
+holds a series written with the same parameters, it is used as it is, so that
+repeated benchmark runs don't each spend time writing the frames.
+'''
+def write_series(directory, n_frames, shape, dtype, formats=FORMATS, seed=0):
+    series = SyntheticSeries(directory, n_frames, shape, dtype, formats)
+    info_path = os.path.join(directory, SERIES_INFO)
+    if os.path.exists(info_path):
+        with open(info_path) as info_file:
+            if json.load(info_file) == dict(series.info(), seed=seed):
+                print('Using the synthetic series in {}'.format(directory))
+                return series
+        os.remove(info_path)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    print('Writing {} synthetic {} frames of {} ({}) to {}...'.format(n_frames, series.dtype.name, 'x'.join(map(str, shape)), ', '.join(formats), directory))
+    hdf_file = None
+    file_names = {file_format: series.files(file_format) for file_format in formats}
+    try:
+        if 'h5' in formats:
+            hdf_file = h5py.File(series.hdf_file, 'w')
+            dset = hdf_file.create_dataset(HDF_DSET_PATH, shape=(n_frames,) + series.shape, dtype=series.dtype, chunks=(1,) + series.shape)
+        for i, frame in enumerate(make_frames(n_frames, series.shape, series.dtype, seed)):
+            if 'tif' in formats:
+                write_tiff(file_names['tif'][i], frame)
+            if 'edf' in formats:
+                write_edf(file_names['edf'][i], frame, i)
+            if 'edf.gz' in formats:
+                write_edf_gz(file_names['edf.gz'][i], frame, i)
+            if hdf_file is not None:
+                dset[i] = frame
+    finally:
+        if hdf_file is not None:
+            hdf_file.close()
+
+    with open(info_path, 'w') as info_file:
+        json.dump(dict(series.info(), seed=seed), info_file)
+    return series
@@ -0,0 +1,398 @@
+import collections
+import functools
+import numpy as np
+
+try:
+    from . import instrumentation
+except ImportError:
+    import instrumentation
+
+SUM_DTYPES = ['auto', 'uint32', 'int64', 'float64']
+AVG_DTYPES = ['float32', 'float64']
+
+
+'''
+Chooses the dtype to sum frames of frame_dtype in. Integer frames are summed
+exactly as integers: uint32 for unsigned frames of up to 16 bits (e.g. most
+detector images), int64 otherwise. Floating point frames are summed as
+float64. Giving sum_dtype (other than 'auto') overrides this for integer
+frames.
+
+The sum dtype must hold every value of frame_dtype, so e.g. signed frames
+can't be summed as uint32, where negative values would wrap around. A
+sum_dtype which doesn't is refused. uint64 frames don't fit in int64 either,
+so by default they are summed as float64 (which doesn't wrap, but is only
+exact up to 2**53).
+'''
+def choose_sum_dtype(frame_dtype, sum_dtype=None):
+    frame_dtype = np.dtype(frame_dtype)
+    if frame_dtype.kind == 'f':
+        return np.dtype(np.float64)
+    if sum_dtype not in (None, 'auto'):
+        dtype = np.dtype(sum_dtype)
+    elif frame_dtype.kind in 'ub' and frame_dtype.itemsize <= 2:
+        dtype = np.dtype(np.uint32)
+    else:
+        dtype = np.dtype(np.int64)
+    if not np.can_cast(frame_dtype, dtype):
+        if sum_dtype not in (None, 'auto'):
+            raise Exception('Frames of {} cannot be summed as {}; use a sum dtype which holds every {} value (e.g. int64), or auto'.format(frame_dtype, dtype, frame_dtype))
+        dtype = np.dtype(np.float64)
+    return dtype
+
+
+'''
+Largest absolute value a frame of frame_dtype could hold
+'''
+def _dtype_abs_max(frame_dtype):
+    info = np.iinfo(frame_dtype) if np.dtype(frame_dtype).kind in 'iu' else np.iinfo(np.uint8)
+    return max(abs(int(info.min)), int(info.max))
+
+
+'''
+Largest absolute value in an integer array
+'''
+def _abs_max(data):
+    return max(abs(int(np.min(data))), int(np.max(data)))
+
+
+'''
+Divides sums by the number of frames in them, giving averages of avg_dtype.
+counts can be a single number or one number per sum in a stack.
+'''
+def average(sumd, counts, avg_dtype=np.float32):
+    avgd = np.empty(sumd.shape, dtype=avg_dtype)
+    if np.ndim(counts) == 0:
+        np.divide(sumd, counts, out=avgd)
+    else:
+        # One window at a time, so we never need the whole stack as float64
+        for i, count in enumerate(counts):
+            np.divide(sumd[i], count, out=avgd[i])
+    return avgd
+
+
+'''
+Folds frames one at a time into running summed and averaged images, so that
+the memory needed for a merge depends on the size of a frame (and the number of
+windows) rather than on the number of frames being merged.
+
+The average is the true mean of the frames (sum / number of frames), rather
+than a running pairwise average, which weights the last frames most heavily.
+
+Sums are kept in the dtype chosen by choose_sum_dtype. For integer sums, an
+upper bound on the sum is tracked and, if it could overflow, the sum is moved
+to int64 (or an OverflowError is raised, if it is already int64). Averages are
+avg_dtype (float32 by default).
+
+If a window is given, a new sum is started every window frames and the
+completed windows are kept. Frames left over at the end which do not fill a
+whole window are dropped, unless keep_partial is set, in which case they form
+a final, smaller window (c.f. merge_new.py).
+
+If stride is given (and differs from window), a new window starts every stride
+frames instead. For overlapping (sliding) windows the last window frames are
+kept, and each frame is added to and later subtracted from one running sum.
+
+If on_window is given, each window is passed to on_window(avg, sum) as soon as
+it is complete (e.g. to write it out) instead of being kept, so memory no
+longer grows with the number of windows. result() then only returns a final
+partial window (if keep_partial is set), or None.
+'''
+class MergeAccumulator(object):
+
+    def __init__(self, window=None, keep_partial=False, stride=None, sum_dtype=None, avg_dtype=np.float32, on_window=None):
+        self.window = window
+        self.on_window = on_window
+        self.keep_partial = keep_partial
+        self.stride = stride if stride != window else None
+        self.sum_dtype = sum_dtype
+        self.avg_dtype = np.dtype(avg_dtype)
+        self.n_frames = 0
+        # Index (file or frame number) of the last frame added, if known
+        self.last_index = None
+
+        # Frames in the current sliding window
+        self.recent = collections.deque()
+
+        # Running sum of the current window (or of all frames, if not windowed)
+        # and an upper bound on its absolute values, to catch overflows
+        self.sumd = None
+        self.n_sumd = 0
+        self.sum_bound = 0
+
+        # Sums of the completed windows (unless passed on to on_window)
+        self.window_sums = []
+        self.n_windows = 0
+
+    def add(self, frame, index=None):
+        with instrumentation.get().stage('accumulate'):
+            self._add(frame, index)
+
+    def _add(self, frame, index):
+        if index is not None:
+            self.last_index = index
+
+        if self.window and self.stride:
+            self._add_sliding(frame)
+            return
+
+        self._add_to_sum(frame)
+        self.n_frames += 1
+
+        if self.window and self.n_sumd == self.window:
+            self._complete_window(self.sumd)
+            self.sumd = None
+            self.n_sumd = 0
+
+    def _add_sliding(self, frame):
+        self.n_frames += 1
+        if self.stride > self.window:
+            # Frames between windows are not needed
+            if (self.n_frames - 1) % self.stride >= self.window:
+                return
+        else:
+            # Frames may be views into a reused read buffer, so keep a copy
+            self.recent.append(np.array(frame))
+
+        self._add_to_sum(frame)
+
+        if self.n_sumd > self.window:
+            self.sumd -= self.recent.popleft()
+            self.n_sumd -= 1
+
+        if self.n_sumd == self.window and (self.n_frames - self.window) % self.stride == 0:
+            self._complete_window(self.sumd.copy())
+            if self.stride > self.window:
+                self.sumd = None
+                self.n_sumd = 0
+
+    def _complete_window(self, sumd):
+        self.n_windows += 1
+        if self.on_window is None:
+            self.window_sums.append(sumd)
+        else:
+            self.on_window(average(sumd, self.window, self.avg_dtype), sumd)
+
+    def _add_to_sum(self, frame):
+        if self.sumd is None:
+            self.sumd = np.array(frame, dtype=choose_sum_dtype(frame.dtype, self.sum_dtype))
+            self.sum_bound = _dtype_abs_max(frame.dtype) if self.sumd.dtype.kind != 'f' else 0
+        else:
+            self._check_overflow(frame)
+            self.sumd += frame
+        self.n_sumd += 1
+
+    '''
+    Makes sure that frame can be added to the integer running sum without
+    overflowing, changing the dtype of the sum if not
+    '''
+    def _check_overflow(self, frame):
+        if self.sumd.dtype.kind == 'f':
+            return
+        if frame.dtype.kind == 'f':
+            instrumentation.get().warning('Floating point frame added to an integer sum; summing as float64')
+            self.sumd = self.sumd.astype(np.float64)
+            return
+
+        limit = int(np.iinfo(self.sumd.dtype).max)
+        if self.sum_bound + _dtype_abs_max(frame.dtype) <= limit:
+            self.sum_bound += _dtype_abs_max(frame.dtype)
+            return
+
+        # The bound from the dtypes alone is too big, so use the actual values
+        self.sum_bound = _abs_max(self.sumd) + _abs_max(frame)
+        if self.sum_bound <= limit:
+            return
+        if self.sumd.dtype != np.int64 and self.sum_bound <= np.iinfo(np.int64).max:
+            instrumentation.get().warning('Summed frames would overflow {}; summing as int64'.format(self.sumd.dtype))
+            self.sumd = self.sumd.astype(np.int64)
+            return
+        raise OverflowError('Summed frames would overflow {}'.format(self.sumd.dtype))
+
+    '''
+    Returns the merged frames as {"avg": ..., "sum": ...}. This does not change
+    the state of the accumulator, so more frames can be added afterwards.
+    '''
+    def result(self):
+        if self.n_frames == 0:
+            raise Exception('No frames were merged.')
+
+        if not self.window:
+            return {"avg": average(self.sumd, self.n_sumd, self.avg_dtype), "sum": self.sumd}
+
+        sums = list(self.window_sums)
+        counts = [self.window] * len(sums)
+        if self.keep_partial and self.n_sumd > 0 and not self.stride:
+            sums.append(self.sumd)
+            counts.append(self.n_sumd)
+        if not sums and self.on_window is not None:
+            return None
+        if not sums:
+            raise Exception('Not enough frames ({}) to fill a window of {}.'.format(self.n_frames, self.window))
+
+        sumd = np.stack(sums)
+        return {"avg": average(sumd, counts, self.avg_dtype), "sum": sumd}
+
+    '''
+    Returns everything needed to carry on the merge later, apart from the
+    sums of the completed windows (which are the merged output):
+    (attributes dictionary, running sum, frames in the current sliding window)
+    '''
+    def get_state(self):
+        attrs = {
+            'window': self.window or 0,
+            'stride': self.stride or 0,
+            'keep_partial': self.keep_partial,
+            'sum_dtype': self.sum_dtype or 'auto',
+            'avg_dtype': self.avg_dtype.name,
+            'n_frames': self.n_frames,
+            'n_sumd': self.n_sumd,
+            'sum_bound': self.sum_bound,
+            'n_windows': self.n_windows,
+            'last_index': -1 if self.last_index is None else self.last_index,
+        }
+        recent = np.stack(self.recent) if self.recent else None
+        return attrs, self.sumd, recent
+
+    '''
+    Creates an accumulator from the output of get_state and the sums of the
+    completed windows
+    '''
+    @classmethod
+    def from_state(cls, attrs, sumd=None, recent=None, window_sums=None):
+        accumulator = cls(window=int(attrs['window']) or None, keep_partial=bool(attrs['keep_partial']), stride=int(attrs['stride']) or None,
+                          sum_dtype=str(attrs.get('sum_dtype', 'auto')), avg_dtype=str(attrs.get('avg_dtype', 'float32')))
+        accumulator.n_frames = int(attrs['n_frames'])
+        accumulator.n_sumd = int(attrs['n_sumd'])
+        accumulator.sum_bound = int(attrs.get('sum_bound', 0))
+        accumulator.last_index = None if attrs['last_index'] < 0 else int(attrs['last_index'])
+        accumulator.n_windows = int(attrs['n_windows'])
+        accumulator.sumd = None if sumd is None else np.array(sumd)
+        if recent is not None:
+            accumulator.recent.extend(recent)
+        if window_sums is not None:
+            accumulator.window_sums = list(window_sums[:int(attrs['n_windows'])])
+        return accumulator
+
+
+'''
+Merges the same frames with several window sizes at once, so that one pass
+over the frames gives every window series: each frame is added to one
+MergeAccumulator per window size. Extra window sizes only cost the memory of
+their running sums, not another read of the frames.
+
+Other keyword arguments are passed on to each MergeAccumulator. If on_window
+is given, it is called as on_window(window, avg, sum) for each completed
+window.
+'''
+class MultiWindowAccumulator(object):
+
+    def __init__(self, windows, on_window=None, **kwargs):
+        self.accumulators = collections.OrderedDict()
+        for window in windows:
+            window_callback = None
+            if on_window is not None:
+                window_callback = functools.partial(on_window, window)
+            self.accumulators[window] = MergeAccumulator(window=window, on_window=window_callback, **kwargs)
+
+    @property
+    def n_frames(self):
+        return next(iter(self.accumulators.values())).n_frames
+
+    def add(self, frame, index=None):
+        with instrumentation.get().stage('accumulate'):
+            for accumulator in self.accumulators.values():
+                accumulator.add(frame, index)
+
+    '''
+    Returns {window: merged frames} (see MergeAccumulator.result) for each
+    window size
+    '''
+    def result(self):
+        return collections.OrderedDict((window, accumulator.result()) for window, accumulator in self.accumulators.items())
+
+
+'''
+Merges a stack of frames which is already in memory, with vectorised numpy
+reductions rather than a loop over the frames.
+
+Without a window, the whole stack is merged. With a window, consecutive
+windows of window frames are merged; frames left over at the end which do not
+fill a whole window are dropped. If stride is given, a new window starts every
+stride frames, so windows overlap when stride < window (a sliding window).
+Overlapping windows are calculated from one running sum, as in
+MergeAccumulator, so the cost scales with the number of frames rather than the
+number of frames times window, and the only extra memory is one frame.
+
+Sums and averages have the same dtypes as in MergeAccumulator. Since the
+number of frames is known up front, an integer sum dtype which could overflow
+is replaced by int64 before summing.
+
+Returns {"avg": ..., "sum": ...}, as MergeAccumulator.result() does.
+'''
+def reduce_stack(stack, window=None, stride=None, sum_dtype=None, avg_dtype=np.float32):
+    with instrumentation.get().stage('accumulate'):
+        return _reduce_stack(stack, window, stride, sum_dtype, avg_dtype)
+
+
+def _reduce_stack(stack, window, stride, sum_dtype, avg_dtype):
+    n_frames = stack.shape[0]
+    dtype = choose_sum_dtype(stack.dtype, sum_dtype)
+    if dtype.kind != 'f' and n_frames * _dtype_abs_max(stack.dtype) > np.iinfo(dtype).max:
+        dtype = np.dtype(np.int64)
+
+    if not window:
+        sumd = np.sum(stack, axis=0, dtype=dtype)
+        return {"avg": average(sumd, n_frames, avg_dtype), "sum": sumd}
+
+    stride = stride or window
+    if n_frames < window:
+        raise Exception('Not enough frames ({}) to fill a window of {}.'.format(n_frames, window))
+
+    if stride == window:
+        n_windows = n_frames // window
+        windowed = stack[:n_windows*window].reshape((n_windows, window) + stack.shape[1:])
+        sumd = np.sum(windowed, axis=1, dtype=dtype)
+    else:
+        sumd = _sliding_sums(stack, window, stride, dtype)
+
+    return {"avg": average(sumd, [window] * len(sumd), avg_dtype), "sum": sumd}
+
+
+'''
+Sums windows of window frames starting every stride frames: each frame is
+added to the running sum when it enters a window and subtracted when it leaves.
+When stride > window the windows do not overlap, so each is summed afresh.
+'''
+def _sliding_sums(stack, window, stride, dtype):
+    n_windows = (stack.shape[0] - window) // stride + 1
+    sumd = np.empty((n_windows,) + stack.shape[1:], dtype=dtype)
+    running = np.empty(stack.shape[1:], dtype=dtype)
+    for index in range(n_windows):
+        start = index * stride
+        if index == 0 or stride >= window:
+            np.sum(stack[start:start+window], axis=0, dtype=dtype, out=running)
+        else:
+            for leaving in stack[start-stride:start]:
+                running -= leaving
+            for entering in stack[start-stride+window:start+window]:
+                running += entering
+        sumd[index] = running
+    return sumd
+
+
+'''
+Stores the i-th of n_windows merged windows in the (n_windows, H, W) output
+datasets avgd and sumd, creating them (or widening the dtype of the sums, if a
+window had to be summed in a larger dtype) as needed. Returns the datasets.
+'''
+def store_window(avgd, sumd, i, n_windows, merged):
+    if avgd is None:
+        dset_shape = (n_windows,) + merged['avg'].shape
+        avgd = np.empty(dset_shape, dtype=merged['avg'].dtype)
+        sumd = np.empty(dset_shape, dtype=merged['sum'].dtype)
+    elif not np.can_cast(merged['sum'].dtype, sumd.dtype):
+        sumd = sumd.astype(np.result_type(sumd, merged['sum']))
+    avgd[i] = merged['avg']
+    sumd[i] = merged['sum']
+    return avgd, sumd
@@ -0,0 +1,266 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+try:
+    from . import discovery, image_paths
+except ImportError:
+    import discovery
+    import image_paths
+
+# Keys a scan in a manifest can have (see scan_arguments)
+SCAN_KEYS = ['name', 'basename', 'file_ext', 'range', 'exclude', 'include', 'window', 'stride', 'dset', 'dset_range', 'in_path', 'out_path', 'args', 'memory']
+# Memory estimate of a scan (see estimate_memory): the merge process itself,
+# plus this many times the size of one frame for the accumulated sums and
+# averages, the frame being merged and frames read ahead
+PROCESS_MEMORY = 200 * 1024**2
+FRAME_MEMORY_FACTOR = 8
+# Frames are read from hdf datasets in batches of up to this many bytes (see
+# frame_io.HDFFrameSource)
+HDF_BATCH_BYTES = 64 * 1024**2
+
+
+'''
+Converts a size such as 500M or 8G to bytes (see frame_cache.parse_size)
+'''
+def parse_size(size):
+    # frame_cache brings in numpy, which the scheduling process doesn't need
+    # until a size is given
+    try:
+        from . import frame_cache
+    except ImportError:
+        import frame_cache
+    return frame_cache.parse_size(size)
+
+
+'''
+Reads a manifest of scans to merge: a JSON (or, if PyYAML is installed, YAML)
+file holding either a list of scans, or {"defaults": {...}, "scans": [...]},
+where defaults are used for any keys a scan doesn't give. Each scan is a
+dictionary of the keys in SCAN_KEYS, e.g.
+
+{"basename": "sample1", "file_ext": "tif", "range": [1, 500], "exclude": [17],
+ "window": 10, "in_path": "raw/sample1", "out_path": "merged"}
+
+Returns the list of scans, each with a name (by default its basename and
+range) and its position in the manifest.
+'''
+def load_manifest(file_name):
+    with open(file_name) as manifest_file:
+        if os.path.splitext(file_name)[1].lower() in ['.yaml', '.yml']:
+            try:
+                import yaml
+            except ImportError:
+                raise Exception('PyYAML is needed to read {}; use a JSON manifest instead'.format(file_name))
+            manifest = yaml.safe_load(manifest_file)
+        else:
+            manifest = json.load(manifest_file)
+    if isinstance(manifest, list):
+        manifest = {'scans': manifest}
+
+    defaults = manifest.get('defaults', {})
+    scans = []
+    for i, scan in enumerate(manifest.get('scans', [])):
+        scan = dict(defaults, **scan)
+        unknown = sorted(set(scan) - set(SCAN_KEYS))
+        if unknown:
+            raise Exception('Unknown key(s) {} in scan {} of {}; should be from {}'.format(', '.join(unknown), i, file_name, ', '.join(SCAN_KEYS)))
+        for key in ['basename', 'file_ext', 'range']:
+            if key not in scan:
+                raise Exception('Scan {} of {} has no {}'.format(i, file_name, key))
+        scan.setdefault('name', '{}_{}-{}'.format(scan['basename'], scan['range'][0], scan['range'][1]))
+        scan['index'] = i
+        scans.append(scan)
+    return scans
+
+
+'''
+Command line arguments of merge.py for a scan
+'''
+def scan_arguments(scan, quiet=True):
+    first, last = scan['range']
+    argv = [scan['basename'], scan['file_ext'], '-s', str(first), '-f', str(last)]
+    if scan.get('in_path'):
+        argv += ['-i', scan['in_path']]
+    if scan.get('out_path'):
+        argv += ['-o', scan['out_path']]
+    if scan.get('window'):
+        window = scan['window']
+        argv += ['-w', ','.join(str(width) for width in window) if isinstance(window, list) else str(window)]
+    if scan.get('stride'):
+        argv += ['--stride', str(scan['stride'])]
+    if scan.get('exclude'):
+        argv += ['--exclude'] + [str(nr) for nr in scan['exclude']]
+    if scan.get('include'):
+        argv += ['--include'] + [str(nr) for nr in scan['include']]
+    if scan.get('dset'):
+        argv += ['--dset', scan['dset']]
+    if scan.get('dset_range'):
+        argv += ['--dset-start', str(scan['dset_range'][0]), '--dset-finish', str(scan['dset_range'][1])]
+    if quiet:
+        argv += ['-q']
+    return argv + [str(arg) for arg in scan.get('args', [])]
+
+
+'''
+Estimates the memory a scan needs while it is merged, from the size of its
+frames: the size of its first file or, for hdf datasets, of one frame of the
+dataset (see PROCESS_MEMORY and FRAME_MEMORY_FACTOR). A scan's memory key, if
+given (e.g. 2G), is used instead.
+'''
+def estimate_memory(scan):
+    if scan.get('memory'):
+        return parse_size(scan['memory'])
+    index = discovery.index_frames(scan.get('in_path') or '.', scan['basename'], scan['file_ext'])
+    first = scan['range'][0]
+    file_name = index.paths[first] if first in index.paths else next(iter(index.paths.values()))
+    if '.' + scan['file_ext'] in image_paths.HDF_EXTS and scan.get('dset'):
+        import h5py
+        with h5py.File(file_name, 'r') as data_file:
+            dataset = data_file.get(scan['dset'])
+            if dataset is None:
+                raise Exception('Could not find dataset {} in {}'.format(scan['dset'], file_name))
+            frame_bytes = dataset.dtype.itemsize
+            for size in dataset.shape[1:]:
+                frame_bytes *= size
+        return PROCESS_MEMORY + FRAME_MEMORY_FACTOR * frame_bytes + HDF_BATCH_BYTES
+    return PROCESS_MEMORY + FRAME_MEMORY_FACTOR * os.path.getsize(file_name)
+
+
+'''
+Merges one scan with merge.py, in a worker process, and returns the outcome:
+its status (done or failed, with the error), runtime and the number of frames
+merged and frames/s. merge (with fabio, h5py and numpy) is only imported by the
+workers, once each, however many scans they merge.
+'''
+def run_scan(scan, quiet=True):
+    try:
+        from . import instrumentation, merge
+    except ImportError:
+        import instrumentation
+        import merge
+
+    result = collections.OrderedDict([('name', scan['name']), ('index', scan['index']), ('status', 'done'), ('error', None)])
+    # merge.main starts its own instrumentation, but may fail before it does
+    instrumentation.start(quiet=True)
+    started = time.time()
+    try:
+        merge.main(scan_arguments(scan, quiet))
+    except SystemExit as error:
+        # merge.py exits with 0 if there was nothing to do
+        if error.code:
+            result['status'] = 'failed'
+            result['error'] = 'merge.py exited with {}'.format(error.code)
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['seconds'] = time.time() - started
+    report = instrumentation.get().report()
+    result['frames'] = report['frames']
+    result['frames_per_second'] = report['frames'] / result['seconds'] if result['seconds'] > 0 else 0.
+    result['stages'] = report['stages']
+    return result
+
+
+'''
+Merges the scans over a pool of worker processes which is shared by all of
+them, so each worker only starts (and imports the merge code) once.
+
+Scans are started in manifest order as workers become free, as long as the
+memory estimates (see estimate_memory) of the scans running stay within
+memory_budget; a later, smaller scan is started ahead of one which doesn't
+fit. A scan bigger than the whole budget is run on its own. Scans whose
+estimate fails (e.g. because their files can't be found) are reported as
+failed without being run.
+
+Returns the outcome of each scan (see run_scan), in manifest order.
+'''
+def run_batch(scans, workers=1, memory_budget=None, quiet=True):
+    results = []
+    pending = []
+    for scan in scans:
+        try:
+            scan['memory_estimate'] = estimate_memory(scan)
+        except Exception as error:
+            results.append(collections.OrderedDict([('name', scan['name']), ('index', scan['index']), ('status', 'failed'), ('error', '{}: {}'.format(type(error).__name__, error)),
+                                                    ('seconds', 0.), ('frames', 0), ('frames_per_second', 0.), ('stages', {})]))
+            print('Failed {}: {}'.format(scan['name'], results[-1]['error']))
+            continue
+        if scan.get('out_path') and not os.path.exists(scan['out_path']):
+            os.makedirs(scan['out_path'])
+        pending.append(scan)
+
+    running = {}
+    memory_used = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            while pending and len(running) < workers:
+                fitting = [scan for scan in pending if not memory_budget or memory_used + scan['memory_estimate'] <= memory_budget]
+                if not fitting and running:
+                    break
+                scan = fitting[0] if fitting else pending[0]
+                if memory_budget and scan['memory_estimate'] > memory_budget:
+                    print('WARNING: {} needs about {:.1f} GB, more than the memory budget; merging it on its own'.format(scan['name'], scan['memory_estimate'] / 1024.**3))
+                pending.remove(scan)
+                memory_used += scan['memory_estimate']
+                running[pool.submit(run_scan, scan, quiet)] = scan
+                print('Started {}'.format(scan['name']))
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                scan = running.pop(future)
+                memory_used -= scan['memory_estimate']
+                result = future.result()
+                results.append(result)
+                if result['status'] == 'done':
+                    print('Merged {}: {} frames in {:.1f} s ({:.1f} frames/s)'.format(result['name'], result['frames'], result['seconds'], result['frames_per_second']))
+                else:
+                    print('Failed {}: {}'.format(result['name'], result['error']))
+    return sorted(results, key=lambda result: result['index'])
+
+
+'''
+Prints a table of the runtime and throughput of each scan, and the totals
+'''
+def print_summary(results, elapsed):
+    print('{:30s} {:>6s} {:>8s} {:>9s} {:>9s}'.format('scan', 'status', 'frames', 'seconds', 'frames/s'))
+    for result in results:
+        print('{:30s} {:>6s} {:8d} {:9.1f} {:9.1f}'.format(result['name'][:30], result['status'], result['frames'], result['seconds'], result['frames_per_second']))
+    frames = sum(result['frames'] for result in results)
+    n_failed = sum(1 for result in results if result['status'] != 'done')
+    print('Merged {} of {} scans ({} frames) in {:.1f} s ({:.1f} frames/s overall)'.format(len(results) - n_failed, len(results), frames, elapsed, frames / elapsed if elapsed > 0 else 0.))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge the scans listed in a manifest over a shared pool of worker processes (see load_manifest for the manifest format).')
+    parser.add_argument('manifest', type=str, help='JSON (or YAML) manifest of the scans to merge')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=1, help='Number of scans to merge at once')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=parse_size, default=None, help='Memory the scans being merged at once may use between them (e.g. 16G), from an estimate of each scan; by default there is no limit')
+    parser.add_argument('--report', dest='report', type=str, default=None, help='JSON file to write the outcome, runtime and throughput of each scan to (- for stdout)')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Print the progress of each scan, not only when it starts and finishes')
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    scans = load_manifest(args.manifest)
+    results = run_batch(scans, workers=args.workers, memory_budget=args.memory_budget, quiet=not args.verbose)
+    elapsed = time.time() - started
+    print_summary(results, elapsed)
+
+    report = collections.OrderedDict([('manifest', os.path.abspath(args.manifest)), ('elapsed_seconds', elapsed), ('workers', args.workers),
+                                      ('memory_budget', args.memory_budget), ('scans', results)])
+    if args.report == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if any(result['status'] != 'done' for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
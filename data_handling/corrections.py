@@ -0,0 +1,125 @@
+import h5py
+import numpy as np
+
+try:
+    from . import accumulators, frame_io, image_paths, instrumentation
+except ImportError:
+    import accumulators
+    import frame_io
+    import image_paths
+    import instrumentation
+
+
+'''
+Reads an image (or stack of images, from an hdf dataset) from an image path
+(see image_paths.split_image_path)
+'''
+def read_image(image_path):
+    file_name, dset_path = image_paths.split_image_path(image_path)
+    if dset_path is None:
+        return np.asarray(frame_io.read_image(file_name))
+    with h5py.File(file_name, 'r') as data_file:
+        if dset_path not in data_file:
+            raise Exception('Could not find dataset {} in {}'.format(dset_path, file_name))
+        return data_file[dset_path][()]
+
+
+'''
+Averages the dark images in dark_paths: any number of images and stacks of
+images (e.g. an hdf dataset of dark frames). If a cache (frame_cache.FrameCache)
+is given, the averaged dark is kept in it, so it is only calculated once for
+the same dark files.
+'''
+def load_dark(dark_paths, cache=None):
+    if cache is not None:
+        file_names = [image_paths.split_image_path(dark_path)[0] for dark_path in dark_paths]
+        return cache.read(file_names, lambda _: _average_images(dark_paths), extra=','.join(dark_paths))
+    return _average_images(dark_paths)
+
+
+def _average_images(dark_paths):
+    accumulator = accumulators.MergeAccumulator()
+    for dark_path in dark_paths:
+        instrumentation.get().message('Reading dark {}...'.format(dark_path))
+        images = read_image(dark_path)
+        for image in (images if images.ndim == 3 else [images]):
+            accumulator.add(image)
+    return accumulator.result()['avg']
+
+
+'''
+Dark, flat field and mask correction of frames, applied to each frame as it is
+merged: corrected = (frame - dark) * gain, where gain is the reciprocal of the
+flat field (which should already be dark corrected) normalised to a mean of 1.
+Masked pixels (non-zero in the mask, and any where the flat field is not
+positive) are set to 0, so they add nothing to the merged sums.
+
+Everything which doesn't depend on the frame is worked out once, so each frame
+costs one subtraction and one multiplication, done in place in a float32
+buffer which is reused for every frame. The corrected frame is only valid
+until the next frame is corrected (c.f. frame_io.HDFFrameSource); the
+accumulators copy frames they need to keep.
+'''
+class FrameCorrection(object):
+
+    def __init__(self, dark=None, flat=None, mask=None, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self.dark = None if dark is None else np.asarray(dark, dtype=self.dtype)
+
+        bad = None
+        if mask is not None:
+            bad = np.asarray(mask) != 0
+        self.gain = None
+        if flat is not None:
+            flat = np.asarray(flat, dtype=np.float64)
+            bad_flat = ~(flat > 0)
+            bad = bad_flat if bad is None else bad | bad_flat
+            good_flat = flat[~bad]
+            if good_flat.size == 0:
+                raise Exception('Flat field has no usable (positive, unmasked) pixels')
+            self.gain = np.zeros(flat.shape, dtype=self.dtype)
+            np.divide(good_flat.mean(), flat, out=self.gain, where=~bad, casting='unsafe')
+        elif bad is not None:
+            self.gain = (~bad).astype(self.dtype)
+        self.buffer = None
+
+    # Each process needs its own buffer
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffer'] = None
+        return state
+
+    def apply(self, frame):
+        with instrumentation.get().stage('correct'):
+            return self._apply(frame)
+
+    def _apply(self, frame):
+        if self.buffer is None or self.buffer.shape != frame.shape:
+            self._check_shape(frame.shape)
+            self.buffer = np.empty(frame.shape, dtype=self.dtype)
+        if self.dark is not None:
+            np.subtract(frame, self.dark, out=self.buffer, casting='unsafe')
+        else:
+            self.buffer[...] = frame
+        if self.gain is not None:
+            self.buffer *= self.gain
+        return self.buffer
+
+    def _check_shape(self, shape):
+        for name, image in [('dark', self.dark), ('flat/mask', self.gain)]:
+            if image is not None and image.shape != shape:
+                raise Exception('The {} image has shape {}, but frames have shape {}'.format(name, image.shape, shape))
+
+
+'''
+Creates the FrameCorrection for the given dark image paths, flat and mask
+image paths (any of which may be None), or returns None if there is nothing
+to correct
+'''
+def make_correction(dark_paths=None, flat_path=None, mask_path=None, cache=None):
+    if not (dark_paths or flat_path or mask_path):
+        return None
+    dark = load_dark(dark_paths, cache) if dark_paths else None
+    flat = read_image(flat_path) if flat_path else None
+    mask = read_image(mask_path) if mask_path else None
+    return FrameCorrection(dark, flat, mask)
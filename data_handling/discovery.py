@@ -0,0 +1,149 @@
+import collections
+import hashlib
+import json
+import os
+import re
+
+try:
+    from . import instrumentation
+except ImportError:
+    import instrumentation
+
+FRAME_SEPARATORS = ['_', '-']
+INDEX_CACHE_PREFIX = 'frame_index_'
+
+
+'''
+Index of the frames of one scan in a directory: the path of each file by frame
+number, with the separator and zero fill found in the file names.
+duplicates holds any frame numbers which appear in more than one file name
+(e.g. with different separators or zero fill), with all of their paths.
+'''
+FrameIndex = collections.namedtuple('FrameIndex', ['paths', 'separator', 'zero_fill', 'duplicates'])
+
+
+'''
+Regex matching file names of the form basename+sep+file_index+.+file_ext
+'''
+def frame_name_pattern(basename, file_ext):
+    separators = ''.join(re.escape(sep) for sep in FRAME_SEPARATORS)
+    return re.compile('^{}(?P<sep>[{}])(?P<index>\\d+)\\.{}$'.format(re.escape(basename), separators, re.escape(file_ext)))
+
+
+'''
+Builds an index of the frames of a scan in one pass over the directory,
+rather than checking for each file in turn.
+
+If cache_dir is given, the index is saved there as json (next to the frames
+cached by frame_cache.FrameCache) and later runs reuse it, unless the
+modification time of the directory has changed (i.e. files have been added or
+removed).
+'''
+def index_frames(path, basename, file_ext, cache_dir=None):
+    path = path or os.curdir
+    dir_mtime = os.stat(path).st_mtime_ns
+    cache_file = None
+    if cache_dir:
+        cache_file = _index_cache_file(cache_dir, path, basename, file_ext)
+        index = _load_index(cache_file, path, dir_mtime)
+        if index is not None:
+            return index
+
+    pattern = frame_name_pattern(basename, file_ext)
+    found = collections.defaultdict(list)
+    separators = collections.Counter()
+    zero_fills = collections.Counter()
+    with instrumentation.get().stage('discover'), os.scandir(path) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match is None:
+                continue
+            found[int(match.group('index'))].append(os.path.join(path, entry.name))
+            separators[match.group('sep')] += 1
+            zero_fills[len(match.group('index'))] += 1
+
+    if not found:
+        raise Exception('Could not find any files matching {} in {}'.format(pattern.pattern, path))
+    if len(separators) > 1:
+        instrumentation.get().warning('Files in {} use more than one frame number separator ({})'.format(path, ', '.join(separators)))
+
+    paths = {index: sorted(names)[0] for index, names in found.items()}
+    duplicates = {index: sorted(names) for index, names in found.items() if len(names) > 1}
+    index = FrameIndex(paths, separators.most_common(1)[0][0], zero_fills.most_common(1)[0][0], duplicates)
+    if cache_file is not None:
+        _save_index(cache_file, dir_mtime, index)
+    return index
+
+
+def _index_cache_file(cache_dir, path, basename, file_ext):
+    key = '\0'.join([os.path.abspath(path), basename, file_ext])
+    return os.path.join(cache_dir, INDEX_CACHE_PREFIX + hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+'''
+Reads an index saved by _save_index, or returns None if there isn't one or the
+directory has changed since it was saved
+'''
+def _load_index(cache_file, path, dir_mtime):
+    try:
+        with open(cache_file) as index_file:
+            saved = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+    if saved.get('dir_mtime') != dir_mtime:
+        return None
+    # File names are saved without the directory, which may be given as a
+    # different relative path next time
+    paths = {int(nr): os.path.join(path, name) for nr, name in saved['paths'].items()}
+    duplicates = {int(nr): [os.path.join(path, name) for name in names] for nr, names in saved['duplicates'].items()}
+    return FrameIndex(paths, saved['separator'], saved['zero_fill'], duplicates)
+
+
+def _save_index(cache_file, dir_mtime, index):
+    saved = {
+        'dir_mtime': dir_mtime,
+        'paths': {nr: os.path.basename(name) for nr, name in index.paths.items()},
+        'separator': index.separator,
+        'zero_fill': index.zero_fill,
+        'duplicates': {nr: [os.path.basename(name) for name in names] for nr, names in index.duplicates.items()},
+    }
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # Written to a temporary file first, so that merges running at the same
+    # time never read half an index
+    temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(temp_file, 'w') as index_file:
+        json.dump(saved, index_file)
+    os.replace(temp_file, cache_file)
+
+
+'''
+Checks that every one of file_numbers is in the index, exactly once, so that
+missing or duplicated frames are reported before any data is read.
+Returns the file paths for file_numbers.
+'''
+def check_frames(index, file_numbers):
+    missing = [nr for nr in file_numbers if nr not in index.paths]
+    duplicated = [nr for nr in file_numbers if nr in index.duplicates]
+
+    problems = []
+    if missing:
+        problems.append('Missing frames: {}'.format(_format_numbers(missing)))
+    for nr in duplicated:
+        problems.append('Frame {} found in more than one file:\n  {}'.format(nr, '\n  '.join(index.duplicates[nr])))
+    if problems:
+        raise Exception('\n'.join(problems))
+
+    return [index.paths[nr] for nr in file_numbers]
+
+
+'''
+Formats a list of numbers compactly, e.g. [1, 2, 3, 7] as '1-3, 7'
+'''
+def _format_numbers(numbers):
+    ranges = []
+    for nr in sorted(numbers):
+        if ranges and nr == ranges[-1][1] + 1:
+            ranges[-1][1] = nr
+        else:
+            ranges.append([nr, nr])
+    return ', '.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
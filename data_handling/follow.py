@@ -0,0 +1,256 @@
+import os
+import time
+
+try:
+    from . import accumulators, discovery, frame_io, instrumentation, merge_state, merged_writer
+except ImportError:
+    import accumulators
+    import discovery
+    import frame_io
+    import instrumentation
+    import merge_state
+    import merged_writer
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Seconds to wait for frames missing from the numbering before merging on
+# without them (see FrameOrder)
+REORDER_TIMEOUT = 5.
+
+
+'''
+Watches a directory for files whose names match a regex (with the frame number
+in its index group, see discovery.frame_name_pattern), returning each file
+once it has been completely written.
+
+Uses inotify (through the inotify_simple package) where available, in which
+case a file is complete once it is closed after writing or moved into the
+directory. Otherwise (or if use_inotify is False) the directory is polled, and
+a file is complete once its size has not changed for settle_time seconds.
+
+Files which are already in the directory when watching starts are also
+returned (once they are complete).
+'''
+class FileWatcher(object):
+
+    def __init__(self, directory, pattern, poll_interval=1., settle_time=1., use_inotify=True):
+        self.directory = directory
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.seen = set()
+        # Files which are still being written: file name -> (size, time size was last seen to change)
+        self.growing = {}
+
+        self.inotify = None
+        if use_inotify and inotify_simple is not None:
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            self.inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+        # Pick up anything which was written before we started watching
+        self.backlog = self._poll()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    '''
+    Waits up to timeout seconds (default: the poll interval) for files to be
+    completed and returns their paths, in order of frame number
+    '''
+    def wait(self, timeout=None):
+        timeout = self.poll_interval if timeout is None else timeout
+        completed, self.backlog = self.backlog, []
+        if self.growing:
+            # Some of the files already in the directory were still being written
+            completed.extend(self._poll())
+
+        if not completed:
+            if self.inotify is not None:
+                for event in self.inotify.read(timeout=int(timeout * 1000)):
+                    if event.name not in self.seen and self.pattern.match(event.name):
+                        self.seen.add(event.name)
+                        self.growing.pop(event.name, None)
+                        completed.append(event.name)
+            else:
+                time.sleep(timeout)
+                completed.extend(self._poll())
+
+        return [os.path.join(self.directory, file_name) for file_name in sorted(completed, key=self.frame_number)]
+
+    def frame_number(self, file_name):
+        return int(self.pattern.match(os.path.basename(file_name)).group('index'))
+
+    def _poll(self):
+        completed = []
+        now = time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name in self.seen or not self.pattern.match(entry.name):
+                    continue
+                size = entry.stat().st_size
+                last_size, last_change = self.growing.get(entry.name, (None, now))
+                if size != last_size:
+                    last_change = entry.stat().st_mtime if last_size is None else now
+                if size > 0 and now - last_change >= self.settle_time:
+                    self.seen.add(entry.name)
+                    self.growing.pop(entry.name, None)
+                    completed.append(entry.name)
+                else:
+                    self.growing[entry.name] = (size, last_change)
+        return completed
+
+
+'''
+Puts frames which are completed out of order (e.g. by a detector writing
+several files at once) back in order of frame number before they are merged.
+
+Frames after a gap in the numbering are held back until the missing frames
+are completed, or until the frames after the gap have waited timeout seconds,
+when the missing frames are given up on (with a warning) and the merge carries
+on after them. When a merge is started, frames are held back for timeout
+seconds too, in case a frame before the first one completed is still being
+written. A frame completed after later frames have been merged can't be
+merged any more, and is warned about.
+'''
+class FrameOrder(object):
+
+    def __init__(self, last_index=None, timeout=REORDER_TIMEOUT):
+        self.last_index = last_index
+        self.timeout = timeout
+        # Frames waiting to be merged: frame number -> (file path, time completed)
+        self.pending = {}
+
+    def add(self, num, file_path, now):
+        if self.last_index is not None and num <= self.last_index:
+            instrumentation.get().warning('Frame {} ({}) was completed after later frames had been merged, so it has not been merged'.format(num, file_path))
+            return
+        self.pending[num] = (file_path, now)
+
+    '''
+    Yields (frame number, file path) of the frames which can be merged now, in
+    order. If flush is set (e.g. when following stops), every frame waiting is
+    yielded, whether or not frames before it are missing.
+    '''
+    def ready(self, now, flush=False):
+        while self.pending:
+            num = min(self.pending)
+            if self.last_index is None or num != self.last_index + 1:
+                waited = now - min(completed for _, completed in self.pending.values())
+                if not flush and waited < self.timeout:
+                    return
+                if self.last_index is not None:
+                    missing = 'Frame {}'.format(num - 1) if num - 1 == self.last_index + 1 else 'Frames {}-{}'.format(self.last_index + 1, num - 1)
+                    instrumentation.get().warning('{} not found after {:.1f} s; merging on from frame {}'.format(missing, waited, num))
+            file_path, _ = self.pending.pop(num)
+            self.last_index = num
+            yield num, file_path
+
+
+'''
+Merges frames as they are written to in_path into merge_filename, so that a
+live merged image is available during a scan.
+
+Frames are files named <basename><separator><number>.<file_ext>. Each is
+folded into the accumulator as soon as it is complete. The output file is kept
+open by one MergedWriter for the whole scan: completed windows are appended to
+it as they are merged and dropped from memory, so memory stays bounded however
+long the scan, and each window is only written (and compressed) once. If
+merge_filename already holds a merge state, the merge carries on from it. Only
+files numbered after the last merged file are merged. Frames are merged in
+order of frame number: frames completed out of order are held back for up to
+reorder_timeout seconds for the frames before them (see FrameOrder).
+
+At most every update_interval seconds while frames are arriving, and once more
+when following stops, the running sum and average (of all of the frames, or of
+the window being merged, see merged_writer.MergedWriter.write_partial_window)
+are written, with the merge state, and the file is flushed. compression,
+shuffle and pyramid are passed on to the MergedWriter.
+
+Following stops after idle_timeout seconds without new frames (if given), or
+on Ctrl-C. Frames are corrected with correction (a corrections.FrameCorrection),
+if given.
+'''
+def follow_merge(in_path, basename, file_ext, merge_filename, window=None, idle_timeout=None, update_interval=5., poll_interval=1., use_inotify=True, sum_dtype=None, avg_dtype='float32', correction=None, compression=None, shuffle=False, pyramid=None, reorder_timeout=REORDER_TIMEOUT):
+    accumulator = merge_state.load_state(merge_filename, load_windows=False)
+    n_windows = None
+    if accumulator is None:
+        accumulator = accumulators.MergeAccumulator(window=window, keep_partial=True, sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+    else:
+        merge_state.check_resumable(accumulator, window)
+        n_windows = accumulator.n_windows
+
+    pattern = discovery.frame_name_pattern(basename, file_ext)
+    watcher = FileWatcher(in_path, pattern, poll_interval=poll_interval, use_inotify=use_inotify)
+    instruments = instrumentation.get()
+    instruments.message('Following {} for {} files...'.format(in_path, basename))
+    # Frames up to this one were merged by an earlier run
+    merged_before = accumulator.last_index
+    order = FrameOrder(accumulator.last_index, reorder_timeout)
+
+    with merged_writer.MergedWriter(merge_filename, compression=compression, shuffle=shuffle, n_windows=n_windows, pyramid=pyramid) as writer:
+        if window:
+            accumulator.on_window = writer.append_window
+        checkpoint = merge_state.Checkpointer(writer, accumulator, n_frames=None)
+        checkpoint.save()
+
+        last_new = time.time()
+        last_write = 0
+        unwritten = False
+        try:
+            while True:
+                new_files = watcher.wait()
+                now = time.time()
+                for file_path in new_files:
+                    num = watcher.frame_number(file_path)
+                    if merged_before is None or num > merged_before:
+                        order.add(num, file_path, now)
+                        last_new = now
+                for num, file_path in order.ready(now):
+                    _merge_frame(accumulator, file_path, num, correction)
+                    unwritten = True
+
+                if unwritten and now - last_write >= update_interval:
+                    _update_output(writer, accumulator, checkpoint)
+                    last_write = time.time()
+                    unwritten = False
+
+                if idle_timeout is not None and now - last_new > idle_timeout:
+                    instruments.message('No new frames for {} s, stopping'.format(idle_timeout))
+                    break
+        except KeyboardInterrupt:
+            instruments.message('Stopping...')
+        finally:
+            watcher.close()
+
+        for num, file_path in order.ready(time.time(), flush=True):
+            _merge_frame(accumulator, file_path, num, correction)
+            unwritten = True
+        if unwritten:
+            _update_output(writer, accumulator, checkpoint)
+    return accumulator
+
+
+def _merge_frame(accumulator, file_path, num, correction=None):
+    frame = frame_io.read_image(file_path)
+    if correction is not None:
+        frame = correction.apply(frame)
+    accumulator.add(frame, num)
+    instrumentation.get().frame_done()
+
+
+'''
+Writes the running sum and average of a merge being followed (the window being
+merged, if windowed, after the windows already written) and saves its state
+'''
+def _update_output(writer, accumulator, checkpoint):
+    merged = accumulator.result()
+    if merged is not None and merged['avg'].ndim == 3:
+        writer.write_partial_window(merged['avg'][0], merged['sum'][0])
+    elif merged is not None:
+        writer.write_image(merged['avg'], merged['sum'])
+    checkpoint.save()
@@ -0,0 +1,158 @@
+import hashlib
+import numpy as np
+import os
+import threading
+
+try:
+    from . import instrumentation
+except ImportError:
+    import instrumentation
+
+CACHE_EXT = '.npy'
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+'''
+Converts a size such as 500M or 20G (or a plain number of bytes) to bytes
+'''
+def parse_size(size):
+    size = str(size).strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+'''
+Local cache of decoded frames, so that merging the same files again (e.g. with
+a different window size, range or excluded files) reads raw arrays from disk
+instead of decoding every image again.
+
+Each frame is stored in cache_dir as a .npy file, named from a hash of the
+path, size and modification time of the original file, so a file which is
+changed or replaced is decoded again rather than read from a stale entry.
+Cached frames are opened memory-mapped.
+
+The cache is kept below max_bytes by deleting the least recently used frames
+(cached files are touched each time they are read, so their modification
+times give the order of use). A frame bigger than max_bytes is not cached,
+nor is a frame which the loader memory mapped (see mmap_readers).
+
+The cache can be shared by threads and by processes: entries are written to a
+temporary file and moved into place, so a half-written entry is never read.
+'''
+class FrameCache(object):
+
+    def __init__(self, cache_dir, max_bytes=10*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = parse_size(max_bytes)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    # The lock can't be pickled, so make a new one when a cache is passed to
+    # another process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def cache_path(self, file_name, extra=''):
+        keys = []
+        for name in (file_name if isinstance(file_name, (list, tuple)) else [file_name]):
+            stat = os.stat(name)
+            keys.append('{}:{}:{}'.format(os.path.abspath(name), stat.st_size, stat.st_mtime_ns))
+        key = '|'.join(keys + [extra])
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + CACHE_EXT)
+
+    '''
+    Returns the frame in file_name, from the cache if it is there, otherwise
+    from loader(file_name) (the frame is then added to the cache).
+
+    file_name can also be a list of files for an image made from several files
+    (e.g. an averaged dark image), and extra anything else the image depends
+    on (e.g. a dataset path), which is added to the key.
+    '''
+    def read(self, file_name, loader, extra=''):
+        instruments = instrumentation.get()
+        cache_path = self.cache_path(file_name, extra)
+        try:
+            with instruments.stage('read'):
+                frame = np.load(cache_path, mmap_mode='r')
+                # Mark the entry as recently used
+                os.utime(cache_path)
+            self.hits += 1
+            instruments.count('cache_hits')
+            return frame
+        except (IOError, OSError, ValueError):
+            # Not cached (or evicted by another process as we opened it)
+            pass
+
+        self.misses += 1
+        instruments.count('cache_misses')
+        frame = loader(file_name)
+        if not isinstance(frame, np.memmap):
+            # Memory mapped frames are already read straight from disk
+            self.store(cache_path, frame)
+        return frame
+
+    def store(self, cache_path, frame):
+        frame = np.asarray(frame)
+        if frame.nbytes > self.max_bytes:
+            return
+        tmp_path = '{}.{}.{}.tmp'.format(cache_path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                np.save(tmp_file, frame, allow_pickle=False)
+            os.replace(tmp_path, cache_path)
+        except (IOError, OSError) as err:
+            instrumentation.get().warning('Could not cache frame in {}: {}'.format(cache_path, err))
+            return
+
+        with self.lock:
+            self.total_bytes += os.path.getsize(cache_path)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    '''
+    Deletes the least recently used entries until the cache is below
+    max_bytes. The size of the cache is recounted from the directory first,
+    since other processes may have added or removed entries.
+    '''
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+            self.total_bytes -= size
+
+    '''
+    (path, size, last used) of each entry in the cache
+    '''
+    def _entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as dir_entries:
+            for entry in dir_entries:
+                if not entry.name.endswith(CACHE_EXT):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in self._entries():
+                os.remove(path)
+            self.total_bytes = 0
@@ -0,0 +1,260 @@
+import collections
+import concurrent.futures
+import fabio
+import functools
+import h5py
+import numpy as np
+import os
+
+try:
+    from . import instrumentation, mmap_readers
+except ImportError:
+    import instrumentation
+    import mmap_readers
+
+
+'''
+Opens an image file and returns the frame as a numpy array. Uncompressed TIFF
+and EDF files are memory mapped rather than read (see mmap_readers; when
+reading ahead, see prefetch_frames, they are read by the reader threads);
+anything else is opened with fabio.
+'''
+def read_image(file_name, use_mmap=True):
+    instruments = instrumentation.get()
+    frame = None
+    if use_mmap:
+        with instruments.stage('read'):
+            frame = mmap_readers.read_frame(file_name)
+    if frame is None:
+        with instruments.stage('decode'):
+            # There is no close function in fabio, so can't use a with statement
+            frame = fabio.open(file_name).data
+    instruments.count('files_read')
+    instruments.count('bytes_read', frame.nbytes)
+    return frame
+
+
+'''
+Yields (file name, frame) for each file in file_list, in order.
+
+With more than one reader (or a prefetch depth), the next files are opened and
+decoded by a pool of threads while the current frame is being merged. At most
+prefetch files are read ahead of the frame being merged, so memory stays
+bounded however long file_list is. If prefetch is not given, it defaults to
+twice the number of readers.
+
+loader is called with the file name and should return a numpy array. If a
+cache (frame_cache.FrameCache) is given, frames are read from it where
+possible, and loaded frames are added to it.
+
+Memory mapped frames (see read_image, and frames from the cache) are only read
+from disk when their pixels are used. When reading ahead, they are read into
+memory by the reader threads, so that the reads overlap with the merge rather
+than happening in the merge itself.
+'''
+def prefetch_frames(file_list, loader=read_image, readers=1, prefetch=None, cache=None):
+    if prefetch is None:
+        prefetch = 2 * readers if readers > 1 else 0
+    if cache is not None:
+        loader = functools.partial(cache.read, loader=loader)
+
+    if prefetch < 1:
+        for file_name in file_list:
+            yield file_name, loader(file_name)
+        return
+    loader = functools.partial(_load_in_memory, loader)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(readers, 1))
+    pending = collections.deque()
+    file_iter = iter(file_list)
+    try:
+        for file_name in file_iter:
+            pending.append((file_name, pool.submit(loader, file_name)))
+            if len(pending) > prefetch:
+                break
+
+        while pending:
+            file_name, future = pending.popleft()
+            with instrumentation.get().stage('wait'):
+                frame = future.result()
+            # Keep the queue topped up before handing the frame back
+            for next_name in file_iter:
+                pending.append((next_name, pool.submit(loader, next_name)))
+                break
+            yield file_name, frame
+    finally:
+        # If we stop early (e.g. an exception during the merge), don't wait for
+        # files which will never be used
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _load_in_memory(loader, file_name):
+    frame = loader(file_name)
+    if isinstance(frame, np.memmap):
+        with instrumentation.get().stage('read'):
+            frame = np.array(frame)
+    return frame
+
+
+'''
+Builds a virtual dataset which concatenates the dataset at dset_path in each of
+the files in file_list along the frame axis (e.g. the _data_00001.h5,
+_data_00002.h5... files written by an Eiger for one scan). No data is copied:
+the virtual dataset is held in an in-memory hdf file and reads from the
+original files. Returns the open in-memory file; the dataset is at 'data'.
+'''
+def build_virtual_dataset(file_list, dset_path):
+    sources = []
+    frame_shape = dtype = chunk_frames = None
+    for file_name in file_list:
+        with h5py.File(file_name, 'r') as data_file:
+            dataset = data_file.get(dset_path)
+            if dataset is None:
+                raise Exception('Could not find dataset {} in {}'.format(dset_path, file_name))
+            if frame_shape is None:
+                frame_shape, dtype = dataset.shape[1:], dataset.dtype
+                chunk_frames = dataset.chunks[0] if dataset.chunks else 1
+            elif dataset.shape[1:] != frame_shape:
+                raise Exception('Frames in {} have shape {}, expected {}'.format(file_name, dataset.shape[1:], frame_shape))
+            sources.append(h5py.VirtualSource(os.path.abspath(file_name), dset_path, shape=dataset.shape))
+
+    n_frames = sum(source.shape[0] for source in sources)
+    layout = h5py.VirtualLayout(shape=(n_frames,) + frame_shape, dtype=dtype)
+    offset = 0
+    for source in sources:
+        layout[offset:offset + source.shape[0]] = source
+        offset += source.shape[0]
+
+    vds_file = h5py.File('virtual-{}.h5'.format(id(layout)), 'w', driver='core', backing_store=False)
+    vds_dataset = vds_file.create_virtual_dataset('data', layout)
+    # Virtual datasets are not chunked, so remember how the sources are
+    vds_dataset.attrs['chunk_frames'] = chunk_frames
+    return vds_file
+
+
+'''
+Number of frames in the dataset at dset_path of an hdf file, or in all of the
+files of a scan whose frames are split across a list of files (c.f.
+HDFFrameSource)
+'''
+def count_frames(file_name, dset_path):
+    n_frames = 0
+    for name in file_name if isinstance(file_name, (list, tuple)) else [file_name]:
+        with h5py.File(name, 'r') as data_file:
+            dataset = data_file.get(dset_path)
+            if dataset is None:
+                raise Exception('Could not find dataset {} in {}'.format(dset_path, name))
+            n_frames += dataset.shape[0]
+    return n_frames
+
+
+'''
+Reads frames from a dataset in an HDF/NeXus file.
+
+file_name may also be a list of files, each holding part of the scan in
+dset_path. These are read through a virtual dataset (see
+build_virtual_dataset), so start and finish count frames across the whole scan
+and reads cross file boundaries without copying the data.
+
+The file is kept open for as long as the source is in use (use it in a with
+statement), and only the frames from start to finish (inclusive; counting
+backwards if start > finish) are read. Frames are read in batches which line up
+with the chunks of the dataset, using read_direct into a single buffer which is
+reused for every batch, so a merge over a small range of a large file never
+touches the rest of the dataset.
+
+Iterating yields (frame index, frame). The frames are views into the reused
+buffer, so they must be copied if they are needed after the next frame is read.
+'''
+class HDFFrameSource(object):
+
+    def __init__(self, file_name, dset_path, start=None, finish=None, batch_bytes=64*1024**2):
+        self.file_name = file_name
+        self.dset_path = dset_path
+        self.start = start
+        self.finish = finish
+        self.batch_bytes = batch_bytes
+        self.data_file = None
+        self.dataset = None
+
+    def __enter__(self):
+        if isinstance(self.file_name, (list, tuple)):
+            self.data_file = build_virtual_dataset(self.file_name, self.dset_path)
+            self.dataset = self.data_file['data']
+        else:
+            self.data_file = h5py.File(self.file_name, 'r')
+            self.dataset = self.data_file.get(self.dset_path)
+        if self.dataset is None:
+            self.close()
+            raise Exception('Could not find dataset {} in {}'.format(self.dset_path, self.file_name))
+
+        n_frames = self.dataset.shape[0]
+        start = 0 if self.start is None else self.start
+        finish = n_frames - 1 if self.finish is None else self.finish
+        if not (0 <= start < n_frames and 0 <= finish < n_frames):
+            self.close()
+            raise Exception('Frames {}-{} are outside dataset {} ({} frames)'.format(start, finish, self.dset_path, n_frames))
+        self.reverse = start > finish
+        self.first, self.last = min(start, finish), max(start, finish)
+        self.batch_frames = self._get_batch_frames()
+        self.buffer = np.empty((min(self.batch_frames, len(self)),) + self.dataset.shape[1:], dtype=self.dataset.dtype)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.data_file = None
+            self.dataset = None
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    @property
+    def frame_shape(self):
+        return self.dataset.shape[1:]
+
+    '''
+    Number of frames in each batch: a whole number of chunks (along the frame
+    axis) which fits in batch_bytes, or at least one chunk.
+    '''
+    def _get_batch_frames(self):
+        frame_bytes = int(np.prod(self.dataset.shape[1:])) * self.dataset.dtype.itemsize
+        if self.dataset.chunks:
+            chunk_frames = self.dataset.chunks[0]
+        else:
+            chunk_frames = int(self.dataset.attrs.get('chunk_frames', 1))
+        n_chunks = max(self.batch_bytes // (frame_bytes * chunk_frames), 1)
+        return n_chunks * chunk_frames
+
+    '''
+    Batch boundaries, as (first frame, last frame + 1), aligned to multiples of
+    the batch size so that each batch covers whole chunks.
+    '''
+    def _batches(self):
+        batches = []
+        batch_start = self.first
+        while batch_start <= self.last:
+            batch_end = min((batch_start // self.batch_frames + 1) * self.batch_frames, self.last + 1)
+            batches.append((batch_start, batch_end))
+            batch_start = batch_end
+        if self.reverse:
+            batches.reverse()
+        return batches
+
+    def __iter__(self):
+        instruments = instrumentation.get()
+        for batch_start, batch_end in self._batches():
+            n_read = batch_end - batch_start
+            with instruments.stage('read'):
+                self.dataset.read_direct(self.buffer, source_sel=np.s_[batch_start:batch_end], dest_sel=np.s_[0:n_read])
+            instruments.count('bytes_read', self.buffer[:n_read].nbytes)
+            frame_indices = range(n_read)
+            if self.reverse:
+                frame_indices = reversed(frame_indices)
+            for i in frame_indices:
+                yield batch_start + i, self.buffer[i]
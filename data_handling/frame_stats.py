@@ -0,0 +1,53 @@
+import numpy as np
+
+try:
+    from . import instrumentation
+except ImportError:
+    import instrumentation
+
+FRAME_STATS_DTYPE = np.dtype([('index', np.int64), ('total', np.float64), ('mean', np.float64), ('max', np.float64), ('saturated', np.int64)])
+
+
+'''
+Collects statistics of each frame as it is merged, for checking a scan (e.g.
+to choose frames to exclude) without reading the frames again: the total and
+mean intensity, the maximum and the number of saturated pixels.
+
+Pixels are saturated if they are at least saturation. By default this is the
+largest value the dtype of integer frames can hold; floating point frames
+have no saturated pixels unless saturation is given.
+
+table() returns the statistics as a structured array (see FRAME_STATS_DTYPE),
+with one row per frame, in the order the frames were added. index is the file
+or frame number of each frame.
+'''
+class FrameStats(object):
+
+    def __init__(self, saturation=None):
+        self.saturation = saturation
+        self.rows = []
+
+    def add(self, frame, index=None):
+        with instrumentation.get().stage('frame_stats'):
+            self._add(frame, index)
+
+    def _add(self, frame, index):
+        saturation = self.saturation
+        if saturation is None and frame.dtype.kind in 'iu':
+            saturation = np.iinfo(frame.dtype).max
+        total = float(np.sum(frame, dtype=np.float64))
+        saturated = 0 if saturation is None else int(np.count_nonzero(frame >= saturation))
+        self.rows.append((-1 if index is None else index, total, total / frame.size, float(np.max(frame)), saturated))
+
+    def table(self):
+        return np.array(self.rows, dtype=FRAME_STATS_DTYPE)
+
+    '''
+    Returns the table (see table) and forgets its rows, so that the next table
+    taken only has the frames added after this one (e.g. for writing the rows
+    out at each checkpoint of a merge, see merge_state.Checkpointer)
+    '''
+    def take_table(self):
+        table = self.table()
+        self.rows = []
+        return table
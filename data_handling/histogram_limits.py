@@ -0,0 +1,201 @@
+"""histogram_limits.py: Fast calculation of colour histogram limits for 2d (diffraction) images."""
+
+import numpy as np
+
+__author__ = "Michael T. Wharmby"
+__license__ = "MIT License"
+__status__ = "Development"
+
+N_BINS = 256
+# Integer images are counted value by value if their range of values is no
+# wider than this; wider ranges (and floating point images) are counted in
+# FINE_BINS bins instead
+MAX_EXACT_RANGE = 2**24
+FINE_BINS = 65536
+
+
+def sample_step(shape, sample):
+    """Step between sampled pixels along each axis, so that at most sample pixels are used (1 uses every pixel)"""
+    if not sample:
+        return 1
+    size = int(np.prod(shape))
+    return max(int(np.ceil(np.sqrt(size / float(sample)))), 1)
+
+
+def histogram_edges(lo, hi):
+    """Bin edges as np.histogram(img, bins=256) makes them for an image with values from lo to hi"""
+    lo, hi = float(lo), float(hi)
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    return np.linspace(lo, hi, N_BINS + 1)
+
+
+def limits_from_histogram(freqs, edges, value_freq_percent=0.005):
+    """Min and max of the colour histogram: the lowest and highest bins (by their lower edges) holding more than value_freq_percent % of the largest bin"""
+    bins = edges[:-1]
+    min_freq = np.amax(freqs) * (value_freq_percent/100)
+    more_than_min_bins = bins[freqs > min_freq]
+    return (np.amin(more_than_min_bins), np.amax(more_than_min_bins))
+
+
+class HistogramAccumulator(object):
+    """Histogram of the intensities of one or more images, added one at a time, from which the colour histogram limits are calculated.
+
+    Integer images are counted exactly, value by value (with np.bincount), so the 256 bin histogram over the full range of values is the same as np.histogram would give, without a pass over the images to find the range first. Floating point images, and integer images whose values span more than MAX_EXACT_RANGE, are counted in FINE_BINS bins over the range seen so far, which are rebinned if a later image widens the range; a value may then be counted in a neighbouring bin, an error of at most 1/256 of a bin.
+
+    Adding several images gives limits for the whole set (one consistent colour scale for a batch), from a single pass over the images.
+
+    Parameters
+    ----------
+    sample : int
+        If given, only about this many pixels of each image (every n-th pixel along each axis) are counted, with their counts scaled up to the size of the image. The range of values (and so the bin edges) is still found from every pixel, so only the counts are estimates.
+    """
+
+    def __init__(self, sample=None):
+        self.sample = sample
+        self.lo = self.hi = None
+        # Counts of each value from lo (exact mode), or of FINE_BINS bins from
+        # fine_lo to fine_hi (fine mode)
+        self.counts = None
+        self.fine = False
+        self.fine_lo = self.fine_hi = None
+
+    def add(self, img):
+        """Add the intensities of an image"""
+        img = np.asarray(img)
+        step = sample_step(img.shape, self.sample)
+        values = img[::step, ::step] if step > 1 and img.ndim == 2 else img
+        weight = step * step if values is not img else 1
+
+        if img.dtype.kind in 'ub' and img.dtype.itemsize <= 2 and step == 1:
+            # Count every value; the range comes from the counts, so the image is only read once
+            counts = np.bincount(img.ravel(), minlength=2)
+            nonzero = np.flatnonzero(counts)
+            lo, hi = int(nonzero[0]), int(nonzero[-1])
+            counts = counts[lo:hi + 1]
+        else:
+            lo, hi = img.min(), img.max()
+            if img.dtype.kind in 'iub':
+                lo, hi = int(lo), int(hi)
+            counts = None
+        self._extend(lo, hi, img.dtype.kind in 'iub')
+
+        if self.fine:
+            freqs, _ = np.histogram(values, bins=FINE_BINS, range=(self.fine_lo, self.fine_hi))
+            self.counts += freqs * weight
+            return
+        if counts is None:
+            counts = np.bincount(np.subtract(values.ravel(), lo, dtype=np.int64).astype(np.intp, copy=False), minlength=hi - lo + 1)
+        self.counts[lo - self.lo:hi - self.lo + 1] += counts * weight
+
+    def _extend(self, lo, hi, is_integer):
+        """Widen the range of values counted to include lo to hi"""
+        new_lo = lo if self.lo is None else min(self.lo, lo)
+        new_hi = hi if self.hi is None else max(self.hi, hi)
+        if not self.fine and (not is_integer or int(new_hi) - int(new_lo) + 1 > MAX_EXACT_RANGE):
+            self._to_fine()
+        if self.fine:
+            self._extend_fine(new_lo, new_hi)
+        else:
+            new_lo, new_hi = int(new_lo), int(new_hi)
+            if self.counts is None:
+                self.counts = np.zeros(new_hi - new_lo + 1, dtype=np.int64)
+            elif new_lo < self.lo or new_hi > self.hi:
+                self.counts = np.pad(self.counts, (self.lo - new_lo, new_hi - self.hi), mode='constant')
+        self.lo, self.hi = new_lo, new_hi
+
+    def _to_fine(self):
+        """Switch from counting values to counting FINE_BINS bins"""
+        self.fine = True
+        if self.counts is None:
+            return
+        nonzero = np.flatnonzero(self.counts)
+        values = self.lo + nonzero.astype(np.float64)
+        counts = self.counts[nonzero]
+        self.counts = np.zeros(FINE_BINS, dtype=np.int64)
+        self.fine_lo, self.fine_hi = float(self.lo), float(self.hi)
+        if self.fine_lo == self.fine_hi:
+            self.fine_hi = self.fine_lo + 1.
+        self._add_fine(values, counts)
+
+    def _extend_fine(self, lo, hi):
+        """Widen the range of the fine bins to include lo to hi, rebinning the counts so far"""
+        lo, hi = float(lo), float(hi)
+        if hi == lo:
+            hi = lo + 1.
+        if self.fine_lo is None:
+            self.counts = np.zeros(FINE_BINS, dtype=np.int64)
+            self.fine_lo, self.fine_hi = lo, hi
+            return
+        if lo >= self.fine_lo and hi <= self.fine_hi:
+            return
+        centres = self._fine_centres()
+        counts = self.counts
+        self.counts = np.zeros(FINE_BINS, dtype=np.int64)
+        self.fine_lo, self.fine_hi = min(lo, self.fine_lo), max(hi, self.fine_hi)
+        self._add_fine(centres, counts)
+
+    def _fine_centres(self):
+        width = (self.fine_hi - self.fine_lo) / FINE_BINS
+        return self.fine_lo + (np.arange(FINE_BINS) + 0.5) * width
+
+    def _add_fine(self, values, counts):
+        indices = ((values - self.fine_lo) * (FINE_BINS / (self.fine_hi - self.fine_lo))).astype(np.intp)
+        np.clip(indices, 0, FINE_BINS - 1, out=indices)
+        self.counts += np.bincount(indices, weights=counts, minlength=FINE_BINS).astype(np.int64)
+
+    def histogram(self):
+        """The 256 bin histogram of all of the images added, over the full range of their values
+
+        Returns
+        -------
+        type : tuple of numpy arrays
+            Frequencies and bin edges, as returned by np.histogram"""
+        if self.counts is None:
+            raise Exception('No images have been added to the histogram')
+        edges = histogram_edges(self.lo, self.hi)
+        if self.fine:
+            # Each fine bin is counted in the bin holding its centre
+            indices = np.searchsorted(edges, self._fine_centres(), side='right') - 1
+            np.clip(indices, 0, N_BINS - 1, out=indices)
+            freqs = np.bincount(indices, weights=self.counts, minlength=N_BINS).astype(np.int64)
+            return freqs, edges
+
+        # Bins hold values from their lower edge up to (but not including) the
+        # next edge, except the last, which also holds the highest value
+        boundaries = np.clip(np.ceil(edges) - self.lo, 0, len(self.counts)).astype(np.intp)
+        boundaries[-1] = len(self.counts)
+        cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        return np.diff(cumulative[boundaries]), edges
+
+    def limits(self, value_freq_percent=0.005):
+        """Min and max intensity values for the colourmap (see limits_from_histogram)"""
+        freqs, edges = self.histogram()
+        return limits_from_histogram(freqs, edges, value_freq_percent)
+
+
+def histo_lims(img, value_freq_percent=0.005, sample=None):
+    """Calculate the colour histogram limits of an image (see plotting/histogram_applicator.histo_lim_calc).
+
+    Integer images are counted exactly with np.bincount; floating point images use np.histogram, or the fine bins of HistogramAccumulator if sampled.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image data to have histogram applied
+    value_freq_percent : float
+        Limiting percentage used to identify min and max
+    sample : int
+        If given, estimate the histogram from about this many pixels (see HistogramAccumulator)
+
+    Returns
+    -------
+    type : tuple of float
+        Min and max intensity values for the colourmap"""
+    img = np.asarray(img)
+    if img.dtype.kind == 'f' and not sample:
+        freqs, edges = np.histogram(img, bins=N_BINS)
+        return limits_from_histogram(freqs, edges, value_freq_percent)
+    accumulator = HistogramAccumulator(sample=sample)
+    accumulator.add(img)
+    return accumulator.limits(value_freq_percent)
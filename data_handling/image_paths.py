@@ -0,0 +1,24 @@
+import os
+
+# Kept free of fabio, h5py and numpy, so that it can be imported by processes
+# which only schedule merges (see batch.py) and by the plotting scripts
+
+HDF_EXTS = ['.h5', '.hdf', '.nxs']
+
+
+'''
+Splits an image path of the form file.h5:/path/to/dataset into the file and
+dataset path. Other paths (any image file fabio can open) have no dataset path.
+'''
+def split_image_path(image_path):
+    file_name, sep, dset_path = image_path.rpartition(':')
+    if sep and os.path.splitext(file_name)[1] in HDF_EXTS:
+        return file_name, dset_path
+    return image_path, None
+
+
+'''
+Whether an image path (see split_image_path) is of an hdf file
+'''
+def is_hdf(image_path):
+    return os.path.splitext(split_image_path(image_path)[0])[1] in HDF_EXTS
@@ -0,0 +1,236 @@
+import collections
+import datetime
+import json
+import sys
+import threading
+import time
+
+# Stages of a merge, in the order they are reported
+STAGES = ['discover', 'read', 'decode', 'wait', 'correct', 'frame_stats', 'accumulate', 'reduce', 'pyramid', 'write']
+PROGRESS_INTERVAL = 1.
+
+
+'''
+Timers and counters for the stages of a merge, and a progress line.
+
+Time is recorded per stage (see STAGES): discover (finding the files), read
+(memory mapping or reading frames from hdf files), decode (opening files with
+fabio, which reads and decodes them), wait (waiting for frames being read by
+reader threads), correct, frame_stats, accumulate, reduce, pyramid (making
+downsampled previews of merged images as they are written) and write. Memory
+mapped frames are only read from disk when their pixels are first used, which
+is counted towards correct or accumulate. Stage times are exclusive: time in a
+stage started within another (e.g. writing a window as it is completed) only
+counts towards the inner one. Times from reader threads are added up over the
+threads, so they can add up to more than the elapsed time.
+
+A progress line (frames merged, frames/s and time remaining, if the number of
+frames is known) is printed at most every interval seconds as frames are
+merged, unless quiet is set. On a terminal the line is updated in place.
+'''
+class Instrumentation(object):
+
+    def __init__(self, total=None, quiet=False, interval=PROGRESS_INTERVAL, stream=None):
+        self.total = total
+        self.expect_total = total is None
+        self.quiet = quiet
+        self.interval = interval
+        self.stream = stream
+        self.start_time = time.time()
+        self.frames = 0
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.last_progress = self.start_time
+        self.progress_shown = False
+
+    '''
+    Times the stage name (use it in a with statement)
+    '''
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    '''
+    Adds n_frames to the number of frames expected, unless the total was
+    given when the instrumentation was started
+    '''
+    def expect(self, n_frames):
+        if self.expect_total:
+            self.total = (self.total or 0) + n_frames
+
+    '''
+    Records that n frames have been merged, and updates the progress line
+    '''
+    def frame_done(self, n=1):
+        self.frames += n
+        if self.quiet:
+            return
+        now = time.time()
+        if now - self.last_progress >= self.interval:
+            self.last_progress = now
+            self._show_progress(now)
+
+    '''
+    Prints a message (unless quiet), below the progress line
+    '''
+    def message(self, text):
+        if self.quiet:
+            return
+        self._end_progress()
+        print(text, file=self._stream())
+
+    '''
+    Prints a warning (even if quiet), below the progress line
+    '''
+    def warning(self, text):
+        self._end_progress()
+        print('WARNING: ' + text, file=self._stream())
+
+    def _stream(self):
+        return self.stream or sys.stdout
+
+    def _show_progress(self, now):
+        elapsed = now - self.start_time
+        rate = self.frames / elapsed if elapsed > 0 else 0.
+        line = 'Merged {} frames'.format(self.frames if not self.total else '{}/{}'.format(self.frames, self.total))
+        line += ' ({:.1f} frames/s'.format(rate)
+        if self.total and rate > 0:
+            line += ', {} remaining'.format(datetime.timedelta(seconds=int(max(self.total - self.frames, 0) / rate)))
+        line += ')'
+        stream = self._stream()
+        if stream.isatty():
+            stream.write('\r' + line.ljust(79))
+            self.progress_shown = True
+        else:
+            stream.write(line + '\n')
+        stream.flush()
+
+    def _end_progress(self):
+        if self.progress_shown:
+            self._stream().write('\n')
+            self.progress_shown = False
+
+    '''
+    The timings and counts so far, as a dictionary which can be written as JSON
+    '''
+    def report(self):
+        elapsed = time.time() - self.start_time
+        with self.lock:
+            names = [name for name in STAGES if name in self.seconds] + sorted(set(self.seconds) - set(STAGES))
+            stages = collections.OrderedDict((name, {'seconds': self.seconds[name], 'calls': self.calls[name]}) for name in names)
+            counters = dict(self.counters)
+        return collections.OrderedDict([('elapsed_seconds', elapsed), ('frames', self.frames),
+                                        ('frames_per_second', self.frames / elapsed if elapsed > 0 else 0.),
+                                        ('stages', stages), ('counters', counters)])
+
+    '''
+    Stores the report as attributes of an hdf group: the whole report as JSON
+    (instrumentation), and the frames merged, frames/s and the seconds spent in
+    each stage (stage_<name>_seconds) as numbers
+    '''
+    def write_attrs(self, group):
+        report = self.report()
+        # Stages of an earlier run (e.g. of a resumed merge) which weren't used this time
+        for name in [name for name in group.attrs if name.startswith('stage_')]:
+            del group.attrs[name]
+        group.attrs['instrumentation'] = json.dumps(report)
+        group.attrs['frames_merged'] = report['frames']
+        group.attrs['frames_per_second'] = report['frames_per_second']
+        for name, stage in report['stages'].items():
+            group.attrs['stage_{}_seconds'.format(name)] = stage['seconds']
+
+    '''
+    Prints a summary of where the time went (unless quiet), and writes the
+    report as JSON to report_file, if given ('-' for stdout)
+    '''
+    def finish(self, report_file=None):
+        report = self.report()
+        if not self.quiet:
+            self._end_progress()
+            elapsed = report['elapsed_seconds']
+            print('Merged {} frames in {:.1f} s ({:.1f} frames/s)'.format(report['frames'], elapsed, report['frames_per_second']), file=self._stream())
+            for name, stage in report['stages'].items():
+                print('  {:12s} {:9.2f} s {:5.1f}%'.format(name, stage['seconds'], 100. * stage['seconds'] / elapsed if elapsed > 0 else 0.), file=self._stream())
+        if report_file == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        elif report_file:
+            with open(report_file, 'w') as json_file:
+                json.dump(report, json_file, indent=2)
+        return report
+
+
+'''
+Times one stage of an Instrumentation (see Instrumentation.stage). Each thread
+has a stack of the stages it is in; while an inner stage runs, the outer one's
+clock is stopped.
+'''
+class StageTimer(object):
+
+    __slots__ = ['instrumentation', 'name']
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        now = time.perf_counter()
+        stack = getattr(self.instrumentation.local, 'stack', None)
+        if stack is None:
+            stack = self.instrumentation.local.stack = []
+        nested = any(name == self.name for name, _ in stack)
+        if stack:
+            outer = stack[-1]
+            self._add(outer[0], now - outer[1], 0)
+        stack.append([self.name, now])
+        if not nested:
+            self._add(self.name, 0., 1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        now = time.perf_counter()
+        stack = self.instrumentation.local.stack
+        name, started = stack.pop()
+        self._add(name, now - started, 0)
+        if stack:
+            stack[-1][1] = now
+
+    def _add(self, name, seconds, calls):
+        with self.instrumentation.lock:
+            self.instrumentation.seconds[name] += seconds
+            self.instrumentation.calls[name] += calls
+
+
+# The instrumentation of the current merge (see start)
+_current = Instrumentation()
+
+
+def get():
+    return _current
+
+
+'''
+Starts instrumenting a new merge, replacing the current instrumentation
+'''
+def start(total=None, quiet=False, interval=PROGRESS_INTERVAL):
+    global _current
+    _current = Instrumentation(total=total, quiet=quiet, interval=interval)
+    return _current
+
+
+'''
+Initialiser for worker processes: their own stages aren't reported, and they
+don't print progress (the parent reports windows as they are merged)
+'''
+def start_worker():
+    start(quiet=True)
+
+
+def finish(report_file=None):
+    return _current.finish(report_file)
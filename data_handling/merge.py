@@ -1,4 +1,3 @@
-import fabio
 import h5py
 import numpy as np
 import os
@@ -6,8 +5,24 @@ import sys
 import time
 
 import argparse
-
-__hdf_ext = ['.h5', '.hdf', '.nxs']
+import functools
+
+try:
+    from . import accumulators, corrections, discovery, frame_cache, frame_io, frame_stats, image_paths, instrumentation, merge_state, merged_writer, parallel, previews, reductions
+except ImportError:
+    import accumulators
+    import corrections
+    import discovery
+    import frame_cache
+    import frame_io
+    import frame_stats
+    import image_paths
+    import instrumentation
+    import merge_state
+    import merged_writer
+    import parallel
+    import previews
+    import reductions
 
 
 '''
@@ -15,114 +30,145 @@ From a given file path/name, return a numpy dataset
 '''
 def get_data(file_name, dset_path=None):
 
-    if os.path.splitext(file_name)[1] in __hdf_ext and dset_path:
-        with h5py.File(file_name, 'r') as data_file:
-            return data_file.get(dset_path)
+    if os.path.splitext(file_name)[1] in image_paths.HDF_EXTS and dset_path:
+        with instrumentation.get().stage('read'), h5py.File(file_name, 'r') as data_file:
+            # Read the data now, since the dataset can't be used once the file is closed
+            return data_file[dset_path][()]
     else:
-        # There is no close function in fabio, so can't use a with statement and I don't see how try/except would be useful
-        data_file = fabio.open(file_name)
-        return data_file.data
-
-
-
-def merge_files(file_list, window=None):
+        return frame_io.read_image(file_name)
 
-    n_img = len(file_list)
-    dataset = np.zeros(shape=(n_img, 1, 1))
-    for i in range(n_img):
-        print('Reading {}...'.format(file_list[i]))
-        img = get_data(file_list[i])
-        if dataset.size == n_img:
-            dataset.resize((n_img, img.shape[-2], img.shape[-1]))
-        dataset[i] = img
 
-    return merge_frames(dataset, window=window)
 
+'''
+Merges the frames in a list of files. To carry on an earlier merge, pass its
+accumulator (which then sets the windowing). file_numbers, if given, records
+which file each frame came from, so that a later merge can be resumed.
+
+If on_window is given, windows are passed to on_window(avg, sum) as they are
+completed rather than returned (see accumulators.MergeAccumulator).
+
+If cache (a frame_cache.FrameCache) is given, decoded frames are read from and
+added to it. If correction (a corrections.FrameCorrection) is given, each
+frame is dark/flat/mask corrected before it is merged. If frame_stats (a
+frame_stats.FrameStats) is given, the statistics of each (uncorrected) frame
+are added to it. If checkpoint is given, it is called after each frame has been
+merged (see merge_state.Checkpointer).
+
+Progress and the time spent in each stage are recorded by the current
+instrumentation (see instrumentation.get).
+'''
+def merge_files(file_list, window=None, readers=1, prefetch=None, workers=1, stride=None, accumulator=None, file_numbers=None, sum_dtype=None, avg_dtype=np.float32, on_window=None, cache=None, correction=None, frame_stats=None, checkpoint=None):
+
+    instruments = instrumentation.get()
+    instruments.expect(len(file_list))
+    if accumulator is None:
+        warn_window_remainder(len(file_list), window, stride)
+        accumulator = accumulators.MergeAccumulator(window=window, stride=stride, sum_dtype=sum_dtype, avg_dtype=avg_dtype, on_window=on_window)
+    elif window and workers > 1:
+        instruments.message('Resuming a merge, so windows will not be merged in parallel')
+        workers = 1
+    if window and workers > 1 and frame_stats is not None:
+        instruments.message('Collecting frame statistics, so windows will not be merged in parallel')
+        workers = 1
+
+    if window and workers > 1:
+        # Each worker reads and merges the files of its own windows
+        reduce_window = functools.partial(merge_files, readers=readers, prefetch=prefetch, sum_dtype=sum_dtype, avg_dtype=avg_dtype, cache=cache, correction=correction)
+        return parallel.merge_windows(parallel.split_windows(file_list, window, stride=stride), reduce_window, workers, on_window=on_window)
+
+    # Frames are folded into the accumulator as they are read, so only one
+    # frame (plus the merged result and any read-ahead) is held in memory at a time
+    frames = frame_io.prefetch_frames(file_list, get_data, readers=readers, prefetch=prefetch, cache=cache)
+    for j, (file_name, frame) in enumerate(frames):
+        if frame_stats is not None:
+            frame_stats.add(frame, file_numbers[j] if file_numbers else None)
+        if correction is not None:
+            frame = correction.apply(frame)
+        accumulator.add(frame, file_numbers[j] if file_numbers else None)
+        if checkpoint is not None:
+            checkpoint()
+        instruments.frame_done()
+
+    return accumulator.result()
 
-def merge_frames(dataset, bounds=None, window=None):
-
-    if window:
-        if dataset.shape[0]%window != 0:
-            print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-            print('WARNING: Dataset axis does not divide by {}'.format(window))
-            print('         Last frames will not be windowed')
-            print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-
-        print('Dataset shape: {}'.format(dataset.shape))
-        n_windows = dataset.shape[0] // window
-        avgd = np.zeros(shape=(n_windows, dataset.shape[-2], dataset.shape[-1]))
-        sumd = np.zeros(shape=(n_windows, dataset.shape[-2], dataset.shape[-1]))
-
-        for i in range(n_windows):
-            print('Merging window {0} of {1}...'.format(i+1, n_windows))
-            bounds = (window*i, (window*i)+window-1)
-            windowed_data = merge_frames(dataset, bounds)
-            avgd[i] = windowed_data['avg']
-            sumd[i] = windowed_data['sum']
 
-    else:
+'''
+Merges frames start to finish of a dataset in an hdf file, reading only those
+frames and keeping the file open for the whole merge. file_name may be a list
+of files which each hold part of the scan, in which case start and finish
+count frames across all of the files. Frames are corrected with correction,
+their statistics added to frame_stats and checkpoint called after each one, if
+given (see merge_files).
+'''
+def merge_hdf(file_name, dset_path, start=None, finish=None, window=None, stride=None, accumulator=None, sum_dtype=None, avg_dtype=np.float32, on_window=None, correction=None, frame_stats=None, checkpoint=None):
+
+    instruments = instrumentation.get()
+    with frame_io.HDFFrameSource(file_name, dset_path, start, finish) as source:
+        instruments.expect(len(source))
+        if accumulator is None:
+            warn_window_remainder(len(source), window, stride)
+            accumulator = accumulators.MergeAccumulator(window=window, stride=stride, sum_dtype=sum_dtype, avg_dtype=avg_dtype, on_window=on_window)
+        for i, frame in source:
+            if frame_stats is not None:
+                frame_stats.add(frame, i)
+            if correction is not None:
+                frame = correction.apply(frame)
+            accumulator.add(frame, i)
+            if checkpoint is not None:
+                checkpoint()
+            instruments.frame_done()
+
+    return accumulator.result()
+
+
+def merge_frames(dataset, bounds=None, window=None, stride=None, sum_dtype=None, avg_dtype=np.float32):
+
+    instruments = instrumentation.get()
+    with instruments.stage('read'):
         if bounds:
             # Are we starting at the end of the file and working backwards?
             if bounds[0] > bounds[1]:
-                frame_list = range(bounds[0], bounds[1] - 1, -1)
+                stack = dataset[bounds[1]:bounds[0] + 1][::-1]
             else:
-                frame_list = range(bounds[0], bounds[1] + 1)
+                stack = dataset[bounds[0]:bounds[1] + 1]
         else:
-            frame_list = range(0, len(dataset))
-
-        # The first run, we need to create our datasets to sum/average against
-        # Having this as a separate block avoids an if-statement in the for-loop
-        i, j = frame_list[0], 1
-        first_frame = dataset[i]
-        avgd = first_frame
-        sumd = first_frame
-        print('Merging: {}/{} (Frame number: {})'.format(j, len(frame_list), i))
+            stack = dataset[:]
 
-        # Here we actually do the merging.
-        # i needs to start from the second (index 1) position in frame_list
-        for i in frame_list[1:]:
-            j += 1
-            frame = dataset[i]
-            avgd = (avgd + frame) / 2
-            sumd = sumd + frame
-            print('Merging: {}/{} (Frame number: {})'.format(j, len(frame_list), i))
+    if window:
+        warn_window_remainder(len(stack), window, stride)
+        instruments.message('Dataset shape: {}'.format(dataset.shape))
 
-    return {"avg": avgd, "sum": sumd}
+    instruments.message('Merging {} frames...'.format(len(stack)))
+    instruments.expect(len(stack))
+    merged = accumulators.reduce_stack(stack, window=window, stride=stride, sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+    instruments.frame_done(len(stack))
+    return merged
 
 
-def build_file_path(path, basename, file_index, file_ext, frame_separator='_', zero_fill=5):
-    filename = '{0}{1}{2:0{fill}}.{3}'.format(basename, frame_separator, file_index, file_ext, fill = zero_fill)
-    return os.path.join(path, filename)
+def warn_window_remainder(n_frames, window, stride=None):
+    if window and (n_frames - window) % (stride or window) != 0:
+        instrumentation.get().warning('Dataset axis does not divide by {}; the last frames will not be windowed'.format(stride or window))
 
 
 '''
-TODO This would be better done with regex:
-- identify files with the basename in the given directory
-- assert structure consists of basename+sep+file_index+.+file_ext
-- extract the sep based on the same regex
-- print warning if it's not in possible_separators
+Group in the output file for the window series of width window, when several
+window sizes are merged at once
 '''
-def get_frame_nr_separator(path, basename, file_index, file_ext, zero_fill=5):
-    possible_separators = ['_', '-']
-    test_filenames = []
-    for sep in possible_separators:
-        filename = build_file_path(path, basename, file_index, file_ext, frame_separator=sep, zero_fill=zero_fill)
-        test_filenames.append(filename)
-        if os.path.exists(filename):
-            return sep
-    else:
-        test_filenames_prinable = '\n'.join(test_filenames)
-        raise Exception('Could not find any of the files:\n{1}\n\nCannot determine the character which separates filename from the frame index.'.format(path, test_filenames_prinable))
+def window_group(window):
+    return 'data/w{}'.format(window)
 
 
-def create_merged_hdf(out_file_path, datasets_to_write):
-
-    with h5py.File(out_file_path, 'w') as out_data_file:
-        out_data_file.create_dataset("data/averaged", data=datasets_to_write['avg'], chunks=True)
-        out_data_file.create_dataset("data/summed", data=datasets_to_write['sum'], chunks=True)
+'''
+Parses the window size option: one width, or several separated by commas
+'''
+def window_sizes(value):
+    return [int(width) for width in value.split(',')]
 
 
-if __name__=="__main__":
+'''
+Runs a merge from command line arguments (argv, or sys.argv if not given)
+'''
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Merge a set of files as summed and averaged datasets in an hdf5 file.")
     parser.add_argument("basename", metavar="file base name", type=str)
     parser.add_argument("file_ext", metavar='file_ext', type=str)
@@ -131,14 +177,39 @@ if __name__=="__main__":
     parser.add_argument('-f', '--finish-at', dest='final_n', action="store", type=int, default=None, help="Number to stop counting the sequence of file numbers at")
     parser.add_argument("-i", "--in-path", dest="in_path", action="store", type=str, default='', help="Directory containing input files")
     parser.add_argument("-o", "--out-path", dest="out_path", action="store", type=str, default='', help="Directory where output hdf5 will be written")
-    parser.add_argument('-w', '--window-size', dest='window', action='store', type=int, default=None, help='Width of window for window avergaing')
+    parser.add_argument('-w', '--window-size', dest='window', action='store', type=window_sizes, default=None, help='Width of window for window avergaing. Several widths can be given separated by commas (e.g. 1,10,100), which are all merged in one pass over the frames and written to groups data/w<width>')
+    parser.add_argument('--stride', dest='stride', action='store', type=int, default=None, help='Number of frames between the starts of consecutive windows (default: the window size). Windows overlap if smaller than the window size')
     parser.add_argument("--exclude", dest="excl", action="store", nargs="*", type=int, default=None, help="File numbers to be excluded")
     parser.add_argument("--include", dest="incl", action="store", nargs="*", type=int, default=None, help="File numbers to be explicitly included")
     parser.add_argument('--dset', dest='dset_path', action='store', type=str, default=None, help='Path to dataset in hdf file')
-    parser.add_argument('--dset-start', dest='dset_start', action='store', type=str, default=None, help='First frame in an hdf dataset to merge')
-    parser.add_argument('--dset-finish', dest='dset_end', action='store', type=str, default=None, help='First frame in an hdf dataset to merge')
-
-    args=parser.parse_args()
+    parser.add_argument('--dset-start', dest='dset_start', action='store', type=int, default=None, help='First frame in an hdf dataset to merge')
+    parser.add_argument('--dset-finish', dest='dset_end', action='store', type=int, default=None, help='Last frame in an hdf dataset to merge')
+    parser.add_argument('--sum-dtype', dest='sum_dtype', action='store', choices=accumulators.SUM_DTYPES, default='auto', help='Data type of the summed frames (default: exact integer sums for integer frames, float64 for uint64 and floating point frames)')
+    parser.add_argument('--avg-dtype', dest='avg_dtype', action='store', choices=accumulators.AVG_DTYPES, default='float32', help='Data type of the averaged frames')
+    parser.add_argument('--compression', dest='compression', action='store', type=str, default='none', help='Compression of the output datasets: none, lzf, gzip or gzip:<level>')
+    parser.add_argument('--shuffle', dest='shuffle', action='store_true', help='Apply the shuffle filter before compressing the output')
+    parser.add_argument('--pyramid', dest='pyramid', action='store', type=previews.parse_levels, default=None, help='Also write the merged images downsampled by these factors, separated by commas (e.g. 2,4,8), to data/pyramid/<factor>x, with the colour histogram limits of each image, for quick looks at the data')
+    parser.add_argument('--resume', dest='resume', action='store', type=str, default=None, help='Merge file to update with only the frames not yet merged into it (created if it does not exist)')
+    parser.add_argument('--checkpoint-every', dest='checkpoint_frames', action='store', type=int, default=merge_state.CHECKPOINT_FRAMES, help='With --resume, save the state of the merge to the merge file every this many frames, so that an interrupted merge can be resumed from there (0 to only save it at the end)')
+    parser.add_argument('-j', '--workers', dest='workers', action='store', type=int, default=1, help='Number of processes merging windows in parallel')
+    parser.add_argument('--readers', dest='readers', action='store', type=int, default=1, help='Number of threads opening and decoding files')
+    parser.add_argument('--prefetch', dest='prefetch', action='store', type=int, default=None, help='Number of files to read ahead of the frame being merged (default: twice the number of readers, or none with a single reader)')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', type=str, default=None, help='Directory in which to cache decoded frames and the index of the input directory, so that merging the same files again is faster')
+    parser.add_argument('--cache-size', dest='cache_size', action='store', type=str, default='10G', help='Maximum size of the frame cache (e.g. 500M, 20G); least recently used frames are removed beyond this')
+    parser.add_argument('--dark', dest='dark', action='append', default=None, help='Dark image to subtract from every frame; give --dark more than once to average several dark images. Images in hdf files are given as file.h5:/path/to/dataset')
+    parser.add_argument('--flat', dest='flat', action='store', default=None, help='Flat field image (dark corrected) to divide every frame by')
+    parser.add_argument('--mask', dest='mask', action='store', default=None, help='Mask image; pixels which are non-zero in the mask are set to 0 in every frame')
+    parser.add_argument('--frame-stats', dest='frame_stats', action='store_true', help='Also write the total, mean, maximum and number of saturated pixels of each frame to data/frame_stats')
+    parser.add_argument('--stats-only', dest='stats_only', action='store_true', help='Only write the statistics of each frame (see --frame-stats), not the merged images')
+    parser.add_argument('--saturation', dest='saturation', action='store', type=float, default=None, help='Pixels at or above this value count as saturated (default: the largest value of integer frames)')
+    parser.add_argument('--reduce', dest='reduce', action='store', type=reductions.parse_reductions, default=None, help='Statistics of the frames to write, separated by commas, from: {} (e.g. sum,mean,median,std). Median and clipped_mean are calculated in bands of rows which fit in --memory-budget'.format(', '.join(reductions.REDUCTIONS)))
+    parser.add_argument('--memory-budget', dest='memory_budget', action='store', type=frame_cache.parse_size, default='1G', help='Memory to use for each band of rows of the frames with --reduce (e.g. 500M, 4G)')
+    parser.add_argument('--clip-sigma', dest='clip_sigma', action='store', type=float, default=3., help='Values more than this many standard deviations from the median are dropped from clipped_mean')
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', help='Do not print progress or the summary of where the time went')
+    parser.add_argument('--report', dest='report', action='store', type=str, default=None, help='JSON file to write the time spent in each stage of the merge to (- for stdout); this is also stored in the attributes of the output data group')
+
+    args=parser.parse_args(argv)
+    instruments = instrumentation.start(quiet=args.quiet)
 
     start = 0
     end = 0
@@ -168,30 +239,152 @@ if __name__=="__main__":
         for nr in args.incl:
             file_numbers.append(nr)
 
+    # Several window sizes are merged together, each to its own group
+    windows = args.window or [None]
+    args.window = windows[0] if len(windows) == 1 else None
+    if len(windows) > 1 and args.resume:
+        parser.error('--resume can only be used with a single window size')
+    if args.reduce and (args.window or len(windows) > 1 or args.resume):
+        parser.error('--reduce cannot be used with --window-size or --resume')
+    if args.reduce and (args.dark or args.flat or args.mask):
+        parser.error('--reduce cannot be used with --dark, --flat or --mask')
+    if args.reduce and args.frame_stats:
+        parser.error('--reduce cannot be used with --frame-stats')
+    if args.stats_only and args.resume:
+        parser.error('--stats-only cannot be used with --resume')
+
     in_path = os.path.normpath(args.in_path)
     out_path = os.path.normpath(args.out_path)
+    is_hdf = '.' + args.file_ext in image_paths.HDF_EXTS and args.dset_path
+
+    accumulator = None
+    n_windows_written = None
+    if args.resume:
+        # Windows already in the file are kept there; new ones are appended
+        accumulator = merge_state.load_state(args.resume, load_windows=False)
+        if accumulator is None:
+            accumulator = accumulators.MergeAccumulator(window=args.window, stride=args.stride, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype)
+        else:
+            merge_state.check_resumable(accumulator, args.window, args.stride)
+            n_windows_written = accumulator.n_windows
+        if accumulator.last_index is not None:
+            # Only merge what has been added since the last run
+            if is_hdf:
+                args.dset_start = max(args.dset_start or 0, accumulator.last_index + 1)
+            else:
+                file_numbers = [nr for nr in file_numbers if nr > accumulator.last_index]
+            if not file_numbers or (args.dset_end is not None and args.dset_start > args.dset_end):
+                print('No new frames to merge into {}'.format(args.resume))
+                sys.exit(0)
+
+    # Find all the files in one pass over the directory, and check they're all
+    # there before we start reading any of them
+    frame_index = discovery.index_frames(in_path, args.basename, args.file_ext, args.cache_dir)
+    file_list = discovery.check_frames(frame_index, file_numbers)
+    # Multiple hdf files are read as one scan, with the frame range counting across all of them
+    hdf_files = file_list[0] if len(file_list) == 1 else file_list
+
+    if is_hdf and args.resume and args.dset_end is None and args.dset_start is not None:
+        # Without a last frame, the frames to merge run to the end of the dataset
+        if args.dset_start >= frame_io.count_frames(hdf_files, args.dset_path):
+            print('No new frames to merge into {}'.format(args.resume))
+            sys.exit(0)
+
+    if args.resume:
+        out_file_name = args.resume
+    else:
+        runtime = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        out_file_name = "{0}_{1}_{2}".format(runtime, args.basename, file_numbers[0])
+        if len(file_numbers) > 1:
+            out_file_name = '{0}-{1}'.format(out_file_name, file_numbers[-1])
+        if args.dset_start is not None or args.dset_end is not None:
+            out_file_name = '{0}_Frames({1}-{2})'.format(out_file_name, args.dset_start, args.dset_end)
+        out_file_name = '{0}.{1}'.format(out_file_name, 'hdf')
+        out_file_name = os.path.join(out_path, out_file_name)
+
+    cache = None
+    if args.cache_dir:
+        cache = frame_cache.FrameCache(args.cache_dir, args.cache_size)
+    correction = corrections.make_correction(args.dark, args.flat, args.mask, cache)
+
+    stats = None
+    if args.frame_stats or args.stats_only:
+        stats = frame_stats.FrameStats(args.saturation)
+
+    if args.stats_only:
+        # Statistics of each frame, without merging them (e.g. to choose frames to exclude)
+        if is_hdf:
+            with frame_io.HDFFrameSource(hdf_files, args.dset_path, args.dset_start, args.dset_end) as source:
+                instruments.expect(len(source))
+                for i, frame in source:
+                    stats.add(frame, i)
+                    instruments.frame_done()
+        else:
+            instruments.expect(len(file_list))
+            frames = frame_io.prefetch_frames(file_list, get_data, readers=args.readers, prefetch=args.prefetch, cache=cache)
+            for nr, (file_name, frame) in zip(file_numbers, frames):
+                stats.add(frame, nr)
+                instruments.frame_done()
+        with merged_writer.MergedWriter(out_file_name, compression=args.compression, shuffle=args.shuffle) as writer:
+            writer.append_table('frame_stats', stats.table())
+        instruments.finish(args.report)
+        return
+
+    if args.reduce:
+        # Statistics of all of the frames, each written to data/<statistic>
+        # (data/summed and data/averaged for sum and mean)
+        with merged_writer.MergedWriter(out_file_name, compression=args.compression, shuffle=args.shuffle, pyramid=args.pyramid) as writer:
+            if is_hdf:
+                reduced = reductions.reduce_hdf(hdf_files, args.dset_path, args.reduce, args.dset_start, args.dset_end, memory_budget=args.memory_budget, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, clip_sigma=args.clip_sigma)
+            else:
+                loader = get_data if cache is None else functools.partial(cache.read, loader=get_data)
+                reduced = reductions.reduce_files(file_list, args.reduce, loader=loader, memory_budget=args.memory_budget, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, clip_sigma=args.clip_sigma)
+            for name, data in reduced.items():
+                writer.write_dataset(reductions.dataset_name(name), data)
+        instruments.finish(args.report)
+        return
+
+    with merged_writer.MergedWriter(out_file_name, compression=args.compression, shuffle=args.shuffle, n_windows=n_windows_written, pyramid=args.pyramid) as writer:
+        # Windows are written out as soon as they are merged
+        on_window = writer.append_window if args.window else None
+        checkpoint = None
+        if accumulator is not None:
+            accumulator.on_window = on_window
+            # Save the state before merging anything, so that the merge file
+            # can be resumed even if this run is interrupted
+            checkpoint = merge_state.Checkpointer(writer, accumulator, args.checkpoint_frames, frame_stats=stats)
+            checkpoint.save()
+
+        multi_accumulator = None
+        if len(windows) > 1:
+            if args.workers > 1:
+                instruments.message('Merging several window sizes in one pass, so windows will not be merged in parallel')
+                args.workers = 1
+            if not is_hdf:
+                for window in windows:
+                    warn_window_remainder(len(file_list), window, args.stride)
+            multi_accumulator = accumulators.MultiWindowAccumulator(windows, stride=args.stride, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype,
+                                                                    on_window=lambda window, avg, sumd: writer.append_window(avg, sumd, window_group(window)))
+
+        if is_hdf:
+            datasets_to_write = merge_hdf(hdf_files, args.dset_path, args.dset_start, args.dset_end, window=args.window, stride=args.stride, accumulator=accumulator or multi_accumulator, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, on_window=on_window, correction=correction, frame_stats=stats, checkpoint=checkpoint)
+        else:
+            datasets_to_write = merge_files(file_list, window = args.window, readers=args.readers, prefetch=args.prefetch, workers=args.workers, stride=args.stride, accumulator=accumulator or multi_accumulator, file_numbers=file_numbers, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, on_window=on_window, cache=cache, correction=correction, frame_stats=stats, checkpoint=checkpoint)
 
-    #Find out what character to use ofr the frame number separator:
-    frame_sep = get_frame_nr_separator(in_path, args.basename, file_numbers[0], args.file_ext)
+        if multi_accumulator is not None:
+            for window, window_accumulator in multi_accumulator.accumulators.items():
+                if window_accumulator.n_windows == 0:
+                    instruments.warning('Not enough frames ({}) to fill a window of {}'.format(window_accumulator.n_frames, window))
+        else:
+            writer.write(datasets_to_write)
+        if checkpoint is not None:
+            # Keep what's needed to carry on the merge later, with the
+            # statistics of the frames since the last checkpoint
+            checkpoint.save()
+        elif stats is not None:
+            writer.append_table(merge_state.FRAME_STATS_TABLE, stats.table())
+    instruments.finish(args.report)
 
-    if len(file_numbers) == 1 and args.file_ext in __hdf_ext:
-        dataset = get_data(build_file_path(in_path, args.basename, file_numbers[0], args.file_ext, frame_separator=frame_sep), args.dset_path)
-        datasets_to_write = merge_frames(dataset, (args.dset_start, args.dset_end), window=args.window)
-    else:
-        file_list = []
-        for i in file_numbers:
-            file_list.append(build_file_path(in_path, args.basename, i, args.file_ext, frame_separator=frame_sep))
-
-        #TODO: What about multiple hdf files? dset path, start, end???
-        datasets_to_write = merge_files(file_list, window = args.window)
-
-    runtime = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-    out_file_name = "{0}_{1}_{2}".format(runtime, args.basename, file_numbers[0])
-    if len(file_numbers) > 1:
-        out_file_name = '{0}-{1}'.format(out_file_name, file_numbers[-1])
-    if args.dset_start or args.dset_end:
-        #TODO: Needs testing with an hdf file
-        out_file_name = '{0}_Frames({1}-{2})'.format(out_file_name, args.dset_start, args.dset_end)
-    out_file_name = '{0}.{1}'.format(out_file_name, 'hdf')
-    out_file_name = os.path.join(out_path, out_file_name)
-    create_merged_hdf(out_file_name, datasets_to_write)
+
+if __name__=="__main__":
+    main()
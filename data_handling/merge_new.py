@@ -1,45 +1,37 @@
 import argparse
-import fabio
-import h5py
+import functools
 import numpy as np
 import os
 
+try:
+    from . import accumulators, corrections, discovery, follow, frame_cache, frame_io, frame_stats, instrumentation, merge_state, merged_writer, parallel, previews, reductions
+except ImportError:
+    import accumulators
+    import corrections
+    import discovery
+    import follow
+    import frame_cache
+    import frame_io
+    import frame_stats
+    import instrumentation
+    import merge_state
+    import merged_writer
+    import parallel
+    import previews
+    import reductions
+
+# Directories used for automatic merging at P02.1
+P021_RAW_PATH = '/gpfs/current/raw'
+P021_MERGED_PATH = '/gpfs/current/processed/merged'
+
 
 '''
 # TODO:
 - add additional arguments
-- add frame separator function (c.f. merge.py)
-- add argument p021 to allow automatic merging at beamline:
-  set /gpfs/current/processed/merged as output dir
-  create /gpfs/current/processed/merged if does not exist
-  set /gpfs/current/raw/basename as the input dir
-  set tif as the file_ext
 - add argument p021_local to allow merging on own machine, assuming same
 directory structure
 '''
 
-'''
-Identifies the index separator used to
-
-TODO This would be better done with regex:
-- identify files with the basename in the given directory
-- assert structure consists of basename+sep+file_index+.+file_ext
-- extract the sep based on the same regex
-- print warning if it's not in possible_separators
-'''
-def get_frame_nr_separator(path, basename, file_index, file_ext, zero_fill=5):
-    possible_separators = ['_', '-']
-    test_filenames = []
-    for sep in possible_separators:
-        filename = build_file_path(path, basename, file_index, file_ext, frame_separator=sep, zero_fill=zero_fill)
-        test_filenames.append(filename)
-        if os.path.exists(filename):
-            return sep
-    else:
-        test_filenames_printable = '\n'.join(test_filenames)
-        raise Exception('Could not find any of the files:\n{1}\n\nCannot determine the character which separates filename from the frame index.'.format(path, test_filenames_printable))
-
-
 '''
 Generates full input path + basename and merged path + merged filename
 
@@ -62,79 +54,163 @@ def set_up_paths(basename, n_files, in_path=None, out_path=None):
 
 
 '''
-Creates final output file. Provide the averaged and summed datasets (could
-these be passed in as a dictionary?)
-
-TODO Should this be part of the main function too?
+Assembles the path and file name for a given file number
 '''
-def create_hdf5(merge_filename, avgd_dataset=np.empty((1,)), sumd_dataset=np.empty((1,))):
-    # Create/update an hdf5 file which will hold our average & summed datasets
-    with h5py.File(merge_filename, 'a') as merged_f:
-        # On the first pass create the datasets...
-        print('Creating hdf5 file...')
-        merged_f.create_dataset('data/averaged', data=avgd_dataset, chunks=True, compression='gzip')
-        merged_f.create_dataset('data/summed', data=sumd_dataset, chunks=True, compression='gzip')
-        merged_f.flush()
+def get_file_name(basename, file_num, file_ext):
+    return basename + '-' + str(file_num).zfill(5) + '.' + file_ext
 
 
 '''
-Assembles the path and file and opens the dataset
-
-TODO This should be merged with the get_data function of merge.py
+Returns the paths of the files for the given file numbers. If a frame index
+(see discovery.index_frames) is given, the paths are looked up in it, which also
+checks that none of the files are missing or duplicated.
 '''
-def get_data(basename, file_num, file_ext):
-    full_filename = basename + '-' + str(file_num).zfill(5) + '.' + file_ext
-
-    print('Opening {}...'.format(full_filename))
-    img = fabio.open(full_filename)
-    return img.data
+def get_file_names(basename, file_nums, file_ext, frame_index=None):
+    if frame_index is None:
+        return [get_file_name(basename, num, file_ext) for num in file_nums]
+    return discovery.check_frames(frame_index, file_nums)
 
 
 '''
 Creates two new numpy datasets (summed and averaged) which are assembled from
 the given basenames, numbers and file extensions.
 
-Window average/summing is achieved by the functions calling itself with a subset
-of the file numbers to be merged which corresponds to the window.
+For window average/summing, file_nums is a list of lists of file numbers, each
+of which corresponds to one window. Files are read in order through a single
+prefetching reader, so read-ahead carries on across window boundaries. With
+more than one worker, windows are instead merged in parallel, each worker
+process reading the files of its own windows.
+
+To carry on an earlier merge, pass its accumulator; file_nums is then a flat
+list of the new file numbers, and the windowing is set by the accumulator.
+
+If frame_index is given, file paths are taken from it (see get_file_names).
+sum_dtype and avg_dtype set the data types of the merged datasets (see
+accumulators.MergeAccumulator). If on_window is given, windows are passed to
+on_window(avg, sum) as they are merged, rather than returned. If cache (a
+frame_cache.FrameCache) is given, decoded frames are read from and added to it.
+If correction (a corrections.FrameCorrection) is given, each frame is
+dark/flat/mask corrected before it is merged. If frame_stats (a
+frame_stats.FrameStats) is given, the statistics of each (uncorrected) frame
+are added to it. If checkpoint is given, it is called after each frame is
+added to a resumed merge's accumulator (see merge_state.Checkpointer). Progress and the time spent in each stage are recorded by
+the current instrumentation (see instrumentation.get).
 
 TODO Adds bounds argument (c.f. merge.py merge_frames)
 '''
-def merge(basename, file_nums, file_ext, window=False):
-    first_run = True
-    for i in range(len(file_nums)):
-        num = file_nums[i]
-        if window:
-            avg_n_dset, sum_n_dset = merge(basename, num, file_ext)
-            if first_run:
-                dset_shape = (len(file_nums), avg_n_dset.shape[0], avg_n_dset.shape[1])
-                avg_dset = np.empty(dset_shape)
-                sum_dset = np.empty(dset_shape)
-                first_run = False
-            avg_dset[i, ...] = avg_n_dset
-            sum_dset[i, ...] = sum_n_dset
+def merge(basename, file_nums, file_ext, window=False, readers=1, prefetch=None, workers=1, accumulator=None, frame_index=None, sum_dtype=None, avg_dtype=np.float32, on_window=None, cache=None, correction=None, frame_stats=None, checkpoint=None):
+    instruments = instrumentation.get()
+    instruments.expect(sum(len(window_nums) for window_nums in file_nums) if window else len(file_nums))
+    if window and workers > 1 and frame_stats is not None:
+        instruments.message('Collecting frame statistics, so windows will not be merged in parallel')
+        workers = 1
+
+    if accumulator is not None:
+        file_names = get_file_names(basename, file_nums, file_ext, frame_index)
+        frames = frame_io.prefetch_frames(file_names, readers=readers, prefetch=prefetch, cache=cache)
+        for num, (file_name, next_data) in zip(file_nums, frames):
+            if frame_stats is not None:
+                frame_stats.add(next_data, num)
+            if correction is not None:
+                next_data = correction.apply(next_data)
+            accumulator.add(next_data, num)
+            if checkpoint is not None:
+                checkpoint()
+            instruments.frame_done()
+        merged = accumulator.result()
+        if merged is None:
+            return None, None
+        return merged['avg'], merged['sum']
+
+    if window and workers > 1:
+        reduce_window = functools.partial(_merge_window, basename, file_ext, readers=readers, prefetch=prefetch, frame_index=frame_index, sum_dtype=sum_dtype, avg_dtype=avg_dtype, cache=cache, correction=correction)
+        merged = parallel.merge_windows(file_nums, reduce_window, workers, on_window=on_window)
+        if merged is None:
+            return None, None
+        return merged['avg'], merged['sum']
+
+    windows = file_nums if window else [file_nums]
+    file_names = get_file_names(basename, [num for window_nums in windows for num in window_nums], file_ext, frame_index)
+    frames = frame_io.prefetch_frames(file_names, readers=readers, prefetch=prefetch, cache=cache)
+
+    avg_dset = sum_dset = None
+    for i, window_nums in enumerate(windows):
+        accumulator = accumulators.MergeAccumulator(sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+        for num in window_nums:
+            file_name, next_data = next(frames)
+            if frame_stats is not None:
+                frame_stats.add(next_data, num)
+            if correction is not None:
+                next_data = correction.apply(next_data)
+            accumulator.add(next_data)
+            instruments.frame_done()
+        merged = accumulator.result()
+
+        if not window:
+            return merged['avg'], merged['sum']
+
+        if on_window is not None:
+            on_window(merged['avg'], merged['sum'])
         else:
-            next_data = get_data(basename, num, file_ext)
-
-            # Process the data
-            if first_run:
-                avg_dset = sum_dset = next_data
-                first_run = False
-            else:
-                avg_dset = (avg_dset + next_data) / 2
-                sum_dset = sum_dset + next_data
+            avg_dset, sum_dset = accumulators.store_window(avg_dset, sum_dset, i, len(windows), merged)
 
     return avg_dset, sum_dset
 
+
+'''
+Converts the (averaged, summed) pair returned by merge into a dictionary for
+merged_writer.MergedWriter.write (or None, if nothing was returned)
+'''
+def accumulator_result(merged):
+    avg_dset, sum_dset = merged
+    if avg_dset is None:
+        return None
+    return {'avg': avg_dset, 'sum': sum_dset}
+
+
+def _merge_window(basename, file_ext, file_nums, readers=1, prefetch=None, frame_index=None, sum_dtype=None, avg_dtype=np.float32, cache=None, correction=None):
+    avg_dset, sum_dset = merge(basename, file_nums, file_ext, readers=readers, prefetch=prefetch, frame_index=frame_index, sum_dtype=sum_dtype, avg_dtype=avg_dtype, cache=cache, correction=correction)
+    return {"avg": avg_dset, "sum": sum_dset}
+
+
 def main():
     parser = argparse.ArgumentParser(description='Merge a set of files as summed and averaged datasets in an hdf5 file.')
     parser.add_argument('basename', metavar='base', type=str, help='File base name')
-    parser.add_argument('file_ext', action='store', type=str, help='File extension (no .) of the files to be processed')
+    parser.add_argument('file_ext', action='store', type=str, nargs='?', default=None, help='File extension (no .) of the files to be processed')
     parser.add_argument('-i', '--in-path', dest='in_path', action='store', type=str, default=os.getcwd(), help='Directory containing input files')
     parser.add_argument('-o', '--out-path', dest='out_path', action='store', type=str, default=os.getcwd(), help='Directory where output hdf5 will be written')
     parser.add_argument('-r', '--range', dest='file_num_lims', type=int, nargs=2)
     parser.add_argument('-l', '--list', dest='file_num_list', type=int, nargs='*')
     parser.add_argument('--exclude', type=int, nargs='*')
     parser.add_argument('-w', '--window-size', dest='window_size', type=int, default=1)
+    parser.add_argument('--sum-dtype', dest='sum_dtype', choices=accumulators.SUM_DTYPES, default='auto', help='Data type of the summed frames (default: exact integer sums for integer frames, float64 for uint64 and floating point frames)')
+    parser.add_argument('--avg-dtype', dest='avg_dtype', choices=accumulators.AVG_DTYPES, default='float32', help='Data type of the averaged frames')
+    parser.add_argument('--compression', dest='compression', type=str, default='gzip', help='Compression of the output datasets: none, lzf, gzip or gzip:<level>')
+    parser.add_argument('--shuffle', dest='shuffle', action='store_true', help='Apply the shuffle filter before compressing the output')
+    parser.add_argument('--pyramid', dest='pyramid', type=previews.parse_levels, default=None, help='Also write the merged images downsampled by these factors, separated by commas (e.g. 2,4,8), to data/pyramid/<factor>x, with the colour histogram limits of each image, for quick looks at the data')
+    parser.add_argument('--follow', action='store_true', help='Watch the input directory and merge files as they are written, updating the merge file as we go')
+    parser.add_argument('--idle-timeout', dest='idle_timeout', type=float, default=None, help='In follow mode, stop after this many seconds without a new file (default: run until interrupted)')
+    parser.add_argument('--update-interval', dest='update_interval', type=float, default=5., help='In follow mode, minimum number of seconds between updates of the merge file')
+    parser.add_argument('--reorder-timeout', dest='reorder_timeout', type=float, default=follow.REORDER_TIMEOUT, help='In follow mode, number of seconds to wait for files missing from the numbering before merging on without them')
+    parser.add_argument('--p021', action='store_true', help='Automatic merging at P02.1: follow {}/<basename> and write to {} (tif files, unless file_ext is given)'.format(P021_RAW_PATH, P021_MERGED_PATH))
+    parser.add_argument('--resume', dest='resume', type=str, default=None, help='Merge file to update with only the files not yet merged into it (created if it does not exist)')
+    parser.add_argument('--checkpoint-every', dest='checkpoint_frames', type=int, default=merge_state.CHECKPOINT_FRAMES, help='With --resume, save the state of the merge to the merge file every this many files, so that an interrupted merge can be resumed from there (0 to only save it at the end)')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=1, help='Number of processes merging windows in parallel')
+    parser.add_argument('--readers', dest='readers', type=int, default=1, help='Number of threads opening and decoding files')
+    parser.add_argument('--prefetch', dest='prefetch', type=int, default=None, help='Number of files to read ahead of the frame being merged (default: twice the number of readers, or none with a single reader)')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None, help='Directory in which to cache decoded frames and the index of the input directory, so that merging the same files again is faster')
+    parser.add_argument('--cache-size', dest='cache_size', type=str, default='10G', help='Maximum size of the frame cache (e.g. 500M, 20G); least recently used frames are removed beyond this')
+    parser.add_argument('--dark', dest='dark', action='append', default=None, help='Dark image to subtract from every frame; give --dark more than once to average several dark images. Images in hdf files are given as file.h5:/path/to/dataset')
+    parser.add_argument('--flat', dest='flat', default=None, help='Flat field image (dark corrected) to divide every frame by')
+    parser.add_argument('--mask', dest='mask', default=None, help='Mask image; pixels which are non-zero in the mask are set to 0 in every frame')
+    parser.add_argument('--frame-stats', dest='frame_stats', action='store_true', help='Also write the total, mean, maximum and number of saturated pixels of each frame to data/frame_stats')
+    parser.add_argument('--stats-only', dest='stats_only', action='store_true', help='Only write the statistics of each frame (see --frame-stats), not the merged images')
+    parser.add_argument('--saturation', dest='saturation', type=float, default=None, help='Pixels at or above this value count as saturated (default: the largest value of integer frames)')
+    parser.add_argument('--reduce', dest='reduce', type=reductions.parse_reductions, default=None, help='Statistics of the frames to write, separated by commas, from: {} (e.g. sum,mean,median,std). Median and clipped_mean are calculated in bands of rows which fit in --memory-budget'.format(', '.join(reductions.REDUCTIONS)))
+    parser.add_argument('--memory-budget', dest='memory_budget', type=frame_cache.parse_size, default='1G', help='Memory to use for each band of rows of the frames with --reduce (e.g. 500M, 4G)')
+    parser.add_argument('--clip-sigma', dest='clip_sigma', type=float, default=3., help='Values more than this many standard deviations from the median are dropped from clipped_mean')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print progress or the summary of where the time went')
+    parser.add_argument('--report', dest='report', type=str, default=None, help='JSON file to write the time spent in each stage of the merge to (- for stdout); this is also stored in the attributes of the output data group')
 
         # parser.add_argument('-n', '--number', dest='n_files', action='store', type=int, default=None, help='Number of files to process (should be an integer!)')
         # parser.add_argument('-s', '--start-at', dest='init_n', action='store', type=int, default=None, help='Number to start counting the sequence of file numbers at')
@@ -146,6 +222,33 @@ def main():
 
 
     args = parser.parse_args()
+    instruments = instrumentation.start(quiet=args.quiet)
+
+    if args.p021:
+        args.in_path = os.path.join(P021_RAW_PATH, args.basename)
+        args.out_path = P021_MERGED_PATH
+        args.file_ext = args.file_ext or 'tif'
+        args.follow = True
+        os.makedirs(args.out_path, exist_ok=True)
+    if not args.file_ext:
+        parser.error('the file extension is required')
+    if args.reduce and (args.window_size > 1 or args.follow or args.resume):
+        parser.error('--reduce cannot be used with --window-size, --follow or --resume')
+    if args.reduce and (args.dark or args.flat or args.mask):
+        parser.error('--reduce cannot be used with --dark, --flat or --mask')
+    if (args.frame_stats or args.stats_only) and (args.reduce or args.follow):
+        parser.error('--frame-stats and --stats-only cannot be used with --reduce or --follow')
+    if args.stats_only and args.resume:
+        parser.error('--stats-only cannot be used with --resume')
+
+    if args.follow:
+        merge_file_path_name = args.resume or os.path.join(args.out_path, '{}-merged.hdf5'.format(args.basename))
+        window = args.window_size if args.window_size > 1 else None
+        correction = corrections.make_correction(args.dark, args.flat, args.mask)
+        follow.follow_merge(args.in_path, args.basename, args.file_ext, merge_file_path_name, window=window, idle_timeout=args.idle_timeout, update_interval=args.update_interval, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, correction=correction,
+                            compression=args.compression, shuffle=args.shuffle, pyramid=args.pyramid, reorder_timeout=args.reorder_timeout)
+        instruments.finish(args.report)
+        return
 
     if args.file_num_list:
         file_list = args.file_num_list
@@ -157,13 +260,84 @@ def main():
         for num in args.exclude:
             file_list.remove(num)
 
+    # Find all the files in one pass over the directory, and check they're all
+    # there before we start reading any of them
+    frame_index = discovery.index_frames(args.in_path, args.basename, args.file_ext, args.cache_dir)
+    discovery.check_frames(frame_index, file_list)
+
+    cache = None
+    if args.cache_dir:
+        cache = frame_cache.FrameCache(args.cache_dir, args.cache_size)
+    correction = corrections.make_correction(args.dark, args.flat, args.mask, cache)
+    stats = None
+    if args.frame_stats or args.stats_only:
+        stats = frame_stats.FrameStats(args.saturation)
+
+    if args.resume:
+        window = args.window_size if args.window_size > 1 else None
+        # Windows already in the file are kept there; new ones are appended
+        accumulator = merge_state.load_state(args.resume, load_windows=False)
+        n_windows_written = None
+        if accumulator is None:
+            accumulator = accumulators.MergeAccumulator(window=window, keep_partial=True, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype)
+        else:
+            merge_state.check_resumable(accumulator, window)
+            n_windows_written = accumulator.n_windows
+        if accumulator.last_index is not None:
+            # Only merge what has been added since the last run
+            file_list = [num for num in file_list if num > accumulator.last_index]
+        if not file_list:
+            print('No new files to merge into {}'.format(args.resume))
+            return
+
+        basename = os.path.join(args.in_path, args.basename)
+        with merged_writer.MergedWriter(args.resume, compression=args.compression, shuffle=args.shuffle, n_windows=n_windows_written, pyramid=args.pyramid) as writer:
+            if window:
+                accumulator.on_window = writer.append_window
+            # Save the state before merging anything, so that the merge file
+            # can be resumed even if this run is interrupted
+            checkpoint = merge_state.Checkpointer(writer, accumulator, args.checkpoint_frames, frame_stats=stats)
+            checkpoint.save()
+            # Any final, partial window is written but not counted as complete,
+            # so it is replaced when the merge is next resumed
+            writer.write(accumulator_result(merge(basename, file_list, args.file_ext, readers=args.readers, prefetch=args.prefetch, accumulator=accumulator, frame_index=frame_index, cache=cache, correction=correction, frame_stats=stats, checkpoint=checkpoint)))
+            # Also writes the statistics of the frames since the last checkpoint
+            checkpoint.save()
+        instruments.finish(args.report)
+        return
+
     # Set up paths
     merge_file_path_name, basename = set_up_paths(args.basename, len(file_list), args.in_path, args.out_path)
 
+    if args.stats_only:
+        # Statistics of each frame, without merging them (e.g. to choose files to exclude)
+        file_names = get_file_names(basename, file_list, args.file_ext, frame_index)
+        instruments.expect(len(file_names))
+        frames = frame_io.prefetch_frames(file_names, readers=args.readers, prefetch=args.prefetch, cache=cache)
+        for num, (file_name, next_data) in zip(file_list, frames):
+            stats.add(next_data, num)
+            instruments.frame_done()
+        with merged_writer.MergedWriter(merge_file_path_name, compression=args.compression, shuffle=args.shuffle) as writer:
+            writer.append_table('frame_stats', stats.table())
+        instruments.finish(args.report)
+        return
+
+    if args.reduce:
+        # Statistics of all of the frames, each written to data/<statistic>
+        # (data/summed and data/averaged for sum and mean)
+        file_names = get_file_names(basename, file_list, args.file_ext, frame_index)
+        loader = frame_io.read_image if cache is None else functools.partial(cache.read, loader=frame_io.read_image)
+        reduced = reductions.reduce_files(file_names, args.reduce, loader=loader, memory_budget=args.memory_budget, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, clip_sigma=args.clip_sigma)
+        with merged_writer.MergedWriter(merge_file_path_name, compression=args.compression, shuffle=args.shuffle, pyramid=args.pyramid) as writer:
+            for name, data in reduced.items():
+                writer.write_dataset(reductions.dataset_name(name), data)
+        instruments.finish(args.report)
+        return
+
     # Reshape list depending on window size
     if args.window_size > 1:
         if len(file_list) % args.window_size != 0:
-            print('\n!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\nWARNING: Number of files does not divide by {d} an integer number of times.\n The last window will be for a smaller set\n'.format(args.window_size))
+            instruments.warning('Number of files does not divide by {:d} an integer number of times; the last window will be for a smaller set'.format(args.window_size))
 
         window_file_list = []
         for i in range(len(file_list)):
@@ -173,8 +347,13 @@ def main():
                 window_file_list[-1].append(file_list[i])
         file_list = window_file_list
 
-    avg_dset, sum_dset = merge(basename, file_list, args.file_ext, window=args.window_size > 1)
-    create_hdf5(merge_file_path_name, avg_dset, sum_dset)
+    with merged_writer.MergedWriter(merge_file_path_name, compression=args.compression, shuffle=args.shuffle, pyramid=args.pyramid) as writer:
+        # Windows are written out as soon as they are merged
+        on_window = writer.append_window if args.window_size > 1 else None
+        writer.write(accumulator_result(merge(basename, file_list, args.file_ext, window=args.window_size > 1, readers=args.readers, prefetch=args.prefetch, workers=args.workers, frame_index=frame_index, sum_dtype=args.sum_dtype, avg_dtype=args.avg_dtype, on_window=on_window, cache=cache, correction=correction, frame_stats=stats)))
+        if stats is not None:
+            writer.append_table('frame_stats', stats.table())
+    instruments.finish(args.report)
 
 
 if __name__ == '__main__':
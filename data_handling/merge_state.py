@@ -0,0 +1,141 @@
+import h5py
+import os
+
+try:
+    from . import accumulators, instrumentation
+except ImportError:
+    import accumulators
+    import instrumentation
+
+STATE_GROUP = 'merge_state'
+CHECKPOINT_FRAMES = 100
+# Table of the statistics of each frame, in the group of the merged output
+FRAME_STATS_TABLE = 'frame_stats'
+
+
+'''
+Stores the state of a merge in an open (writable) hdf file, alongside the
+merged output, so that the merge can be carried on later with only the new
+frames. The sums of the completed windows are not duplicated; they are read
+back from the merged dataset at summed_path.
+
+The state can be saved again and again during a merge (see Checkpointer): its
+datasets are overwritten in place where they keep their shape and dtype, so
+the file doesn't grow with each save. frame_stats_rows, if given, is the
+number of rows of the frame_stats table which belong to the frames merged.
+'''
+def save_state(h5file, accumulator, summed_path='data/summed', frame_stats_rows=None):
+    group = h5file.require_group(STATE_GROUP)
+
+    attrs, sumd, recent = accumulator.get_state()
+    for name, value in attrs.items():
+        group.attrs[name] = value
+    group.attrs['summed_path'] = summed_path
+    if frame_stats_rows is not None:
+        group.attrs['frame_stats_rows'] = frame_stats_rows
+    _write_state_data(group, 'partial_sum', sumd)
+    _write_state_data(group, 'recent_frames', recent)
+
+
+def _write_state_data(group, name, data):
+    dset = group.get(name)
+    if dset is not None and data is not None and dset.shape == data.shape and dset.dtype == data.dtype:
+        dset[...] = data
+        return
+    if dset is not None:
+        del group[name]
+    if data is not None:
+        group.create_dataset(name, data=data)
+
+
+'''
+Saves the state of a merge (see save_state) in its output file every n_frames
+frames, so that a merge which is interrupted can be resumed from its last
+checkpoint rather than from the start. It is called after each frame has been
+added to the accumulator (see merge.merge_files); save saves the state
+straight away (e.g. when the merge starts, so that the output file always
+holds a state). Windows written after the last checkpoint are dropped when the
+merge is resumed (see merged_writer.MergedWriter n_windows), and merged again.
+
+If frame_stats (a frame_stats.FrameStats) is given, the statistics of the
+frames merged since the last checkpoint are appended to the frame_stats table
+of writer (a merged_writer.MergedWriter) at each checkpoint, and the number
+of rows is saved with the state. Rows written after the last checkpoint of an
+interrupted merge are cut from the table when it is resumed, like the windows.
+'''
+class Checkpointer(object):
+
+    def __init__(self, writer, accumulator, n_frames=CHECKPOINT_FRAMES, summed_path='data/summed', frame_stats=None):
+        self.writer = writer
+        self.accumulator = accumulator
+        self.n_frames = n_frames
+        self.summed_path = summed_path
+        self.frame_stats = frame_stats
+        self.n_added = 0
+        self.n_stats_rows = None
+        if frame_stats is not None:
+            self.n_stats_rows = self._cut_stats()
+
+    def __call__(self):
+        self.n_added += 1
+        if self.n_frames and self.n_added % self.n_frames == 0:
+            self.save()
+
+    def save(self):
+        if self.frame_stats is not None:
+            rows = self.frame_stats.take_table()
+            self.writer.append_table(FRAME_STATS_TABLE, rows)
+            self.n_stats_rows += len(rows)
+        with instrumentation.get().stage('write'):
+            save_state(self.writer.h5file, self.accumulator, self.summed_path, self.n_stats_rows)
+            self.writer.h5file.flush()
+        instrumentation.get().count('checkpoints')
+
+    '''
+    Cuts the frame_stats table back to the rows saved with the state, and
+    returns how many there are. A table written without a saved row count (by
+    a merge which only wrote the statistics at the end) is kept as it is.
+    '''
+    def _cut_stats(self):
+        state = self.writer.h5file.get(STATE_GROUP)
+        n_rows = None if state is None else state.attrs.get('frame_stats_rows')
+        if n_rows is not None:
+            self.writer.cut_table(FRAME_STATS_TABLE, int(n_rows))
+            return int(n_rows)
+        table = self.writer.table(FRAME_STATS_TABLE)
+        return 0 if table is None else table.shape[0]
+
+
+'''
+Recreates the accumulator of a merge from the state stored in a merged hdf
+file. Returns None if the file does not exist yet (i.e. a new merge).
+
+The sums of the completed windows are read back from the file, unless
+load_windows is False (e.g. if new windows will be appended to the file as
+they are completed, see accumulators.MergeAccumulator on_window).
+'''
+def load_state(file_path, load_windows=True):
+    if not os.path.exists(file_path):
+        return None
+
+    with h5py.File(file_path, 'r') as h5file:
+        if STATE_GROUP not in h5file:
+            raise Exception('{} does not contain a saved merge state (it was not written by a resumable merge), so the merge cannot be resumed. Delete it, or give another file, to start a new merge.'.format(file_path))
+        group = h5file[STATE_GROUP]
+        attrs = dict(group.attrs)
+        sumd = group['partial_sum'][()] if 'partial_sum' in group else None
+        recent = group['recent_frames'][()] if 'recent_frames' in group else None
+        window_sums = None
+        if attrs['window'] and attrs['n_windows'] > 0 and load_windows:
+            window_sums = h5file[attrs['summed_path']][()]
+
+    return accumulators.MergeAccumulator.from_state(attrs, sumd, recent, window_sums)
+
+
+'''
+Checks that a resumed merge uses the same windowing as the original merge
+'''
+def check_resumable(accumulator, window=None, stride=None):
+    stride = stride if stride != window else None
+    if accumulator.window != window or accumulator.stride != stride:
+        raise Exception('Cannot resume: the merge was started with window {} and stride {}, but window {} and stride {} were requested.'.format(accumulator.window, accumulator.stride, window, stride))
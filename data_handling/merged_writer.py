@@ -0,0 +1,285 @@
+import h5py
+import numpy as np
+import time
+
+try:
+    from . import instrumentation, previews
+except ImportError:
+    import instrumentation
+    import previews
+
+COMPRESSIONS = ['none', 'lzf', 'gzip']
+TABLE_CHUNK_ROWS = 4096
+PYRAMID_GROUP = 'pyramid'
+LIMITS_ATTR = 'histogram_limits'
+
+
+'''
+Converts a compression option (none, lzf, gzip or gzip:<level>) and shuffle
+flag into keyword arguments for h5py create_dataset
+'''
+def compression_options(compression=None, shuffle=False):
+    options = {}
+    if compression and compression != 'none':
+        name, _, level = compression.partition(':')
+        if name not in COMPRESSIONS:
+            raise Exception('Unknown compression {}; should be one of {}'.format(name, ', '.join(COMPRESSIONS)))
+        options['compression'] = name
+        if level:
+            if name != 'gzip':
+                raise Exception('A compression level can only be given for gzip')
+            options['compression_opts'] = int(level)
+    if shuffle:
+        options['shuffle'] = True
+    return options
+
+
+'''
+Writes merged data to an hdf file (use it in a with statement).
+
+Windowed output is written as it is produced: append_window adds one window to
+resizable <group>/averaged and <group>/summed datasets, so the whole series
+never needs to be held in memory. Datasets are chunked one frame per chunk and
+compressed as chosen (none by default, see compression_options).
+
+If n_windows is given, an existing file is updated instead of replaced: any
+windowed datasets are cut back to n_windows windows (dropping e.g. a partial
+window written last time) and new windows are appended after them.
+
+Images which are written again and again (e.g. the running sum of a merge
+which follows a scan as it is written) are overwritten in place, as long as
+their shape and dtype don't change, so the file doesn't grow with each update.
+A window which is still being merged can be written after the completed ones
+with write_partial_window; it is replaced by the next window.
+
+The group written to can be given to each write method (e.g. data/w10 for
+one of several window series); by default it is group.
+
+If pyramid levels are given (e.g. [2, 4, 8]), each merged image or window is
+also written downsampled by each factor (see previews.pyramid), as float32, to
+<group>/pyramid/<factor>x/<name>, chunked one frame per chunk, so that quick
+looks at the data only need to read a small part of the file. The colour
+histogram limits of each image (see previews.histogram_limits) are worked out
+from the full image and stored as a histogram_limits attribute of it and of
+each of its levels. Attributes can't grow with a stack of windows, so the
+limits of each window are instead appended to a table,
+<group>/pyramid/histogram_limits/<name> (one row of min and max per window),
+whose path is given by the histogram_limits_table attribute of the stack and
+its levels.
+
+Timing metadata (when writing started and finished, the elapsed time and the
+time spent writing) are stored as attributes of the group when the file is
+closed, with the timings of the merge so far (see
+instrumentation.Instrumentation.write_attrs).
+'''
+class MergedWriter(object):
+
+    def __init__(self, file_path, compression=None, shuffle=False, n_windows=None, group='data', pyramid=None):
+        self.file_path = file_path
+        self.options = compression_options(compression, shuffle)
+        self.n_windows = n_windows
+        self.group = group
+        self.pyramid = pyramid
+        self.h5file = None
+        # Groups whose last window is a partial one (see write_partial_window)
+        self.partial = set()
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.write_time = 0.
+        if self.n_windows is None:
+            self.h5file = h5py.File(self.file_path, 'w')
+        else:
+            self.h5file = h5py.File(self.file_path, 'a')
+            self._cut_windows(self.group, self.n_windows)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.h5file is None:
+            return
+        group = self.h5file.require_group(self.group)
+        end_time = time.time()
+        group.attrs['write_started'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start_time))
+        group.attrs['write_finished'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(end_time))
+        group.attrs['elapsed_seconds'] = end_time - self.start_time
+        group.attrs['write_seconds'] = self.write_time
+        instrumentation.get().write_attrs(group)
+        self.h5file.close()
+        self.h5file = None
+
+    '''
+    Writes merged output as returned by the merge functions: a single image
+    each for averaged and summed, or a stack of windows (which are appended).
+    Nothing is written for None.
+    '''
+    def write(self, merged, group=None):
+        if merged is None:
+            return
+        if merged['avg'].ndim == 3:
+            for avg, sumd in zip(merged['avg'], merged['sum']):
+                self.append_window(avg, sumd, group)
+        else:
+            self.write_image(merged['avg'], merged['sum'], group)
+
+    def write_image(self, avg, sumd, group=None):
+        self.write_dataset('averaged', avg, group)
+        self.write_dataset('summed', sumd, group)
+
+    '''
+    Writes (or replaces) one image, e.g. the median of the frames
+    '''
+    def write_dataset(self, name, data, group=None):
+        started = time.time()
+        path = '{}/{}'.format(group or self.group, name)
+        with instrumentation.get().stage('write'):
+            dset = self._replace_dataset(path, data)
+            if self.pyramid and data.ndim == 2:
+                self._write_pyramid_image(name, data, dset, group or self.group)
+        self.write_time += time.time() - started
+
+    '''
+    Appends rows to a one dimensional table (e.g. the statistics of each
+    frame), so that a resumed merge adds to the rows already written
+    '''
+    def append_table(self, name, rows, group=None):
+        started = time.time()
+        path = '{}/{}'.format(group or self.group, name)
+        with instrumentation.get().stage('write'):
+            dset = self.h5file.get(path)
+            if dset is None:
+                dset = self.h5file.create_dataset(path, shape=(0,), maxshape=(None,), dtype=rows.dtype, chunks=(TABLE_CHUNK_ROWS,), **self.options)
+            n_rows = dset.shape[0]
+            dset.resize(n_rows + len(rows), axis=0)
+            dset[n_rows:] = rows
+        self.write_time += time.time() - started
+
+    '''
+    Returns the table name (see append_table), or None if it hasn't been written
+    '''
+    def table(self, name, group=None):
+        return self.h5file.get('{}/{}'.format(group or self.group, name))
+
+    '''
+    Cuts a table (see append_table) back to its first n_rows rows
+    '''
+    def cut_table(self, name, n_rows, group=None):
+        dset = self.table(name, group)
+        if dset is not None and dset.shape[0] > n_rows:
+            dset.resize(n_rows, axis=0)
+
+    def append_window(self, avg, sumd, group=None):
+        self._append_window(avg, sumd, group or self.group)
+        instrumentation.get().count('windows_written')
+
+    '''
+    Writes a window which is still being merged (e.g. the frames of a scan so
+    far) after the completed windows, so that the latest frames can be looked
+    at. It is replaced by the next window appended (or partial window written).
+    It isn't counted in a saved merge state, so a resumed merge drops it too
+    (see n_windows).
+    '''
+    def write_partial_window(self, avg, sumd, group=None):
+        self._append_window(avg, sumd, group or self.group)
+        self.partial.add(group or self.group)
+
+    def _append_window(self, avg, sumd, group):
+        started = time.time()
+        with instrumentation.get().stage('write'):
+            if group in self.partial:
+                self.partial.discard(group)
+                self._cut_windows(group, self.h5file['{}/averaged'.format(group)].shape[0] - 1)
+            for name, data in [('averaged', avg), ('summed', sumd)]:
+                dset = self._window_dataset('{}/{}'.format(group, name), data)
+                n_windows = dset.shape[0]
+                dset.resize(n_windows + 1, axis=0)
+                dset[n_windows] = data
+                if self.pyramid:
+                    self._append_pyramid_window(name, data, dset, group)
+        self.write_time += time.time() - started
+
+    '''
+    Cuts the windowed datasets of group (and their pyramid levels and limits)
+    back to n_windows windows
+    '''
+    def _cut_windows(self, group, n_windows):
+        for name in ['averaged', 'summed']:
+            paths = ['{}/{}'.format(group, name), self._limits_path(name, group)]
+            paths += [self._level_path(name, group, factor) for factor in self.pyramid or []]
+            for path in paths:
+                dset = self.h5file.get(path)
+                if dset is not None and dset.ndim in (2, 3) and dset.maxshape[0] is None:
+                    dset.resize(n_windows, axis=0)
+
+    '''
+    Writes data to the dataset at path, overwriting it in place if it already
+    has the same shape and dtype, or replacing it otherwise. Returns the dataset.
+    '''
+    def _replace_dataset(self, path, data):
+        dset = self.h5file.get(path)
+        if dset is not None and dset.shape == data.shape and dset.dtype == data.dtype:
+            dset[...] = data
+            return dset
+        if dset is not None:
+            del self.h5file[path]
+        return self.h5file.create_dataset(path, data=data, chunks=data.shape, **self.options)
+
+    def _level_path(self, name, group, factor):
+        return '{}/{}/{}x/{}'.format(group, PYRAMID_GROUP, factor, name)
+
+    def _limits_path(self, name, group):
+        return '{}/{}/{}/{}'.format(group, PYRAMID_GROUP, LIMITS_ATTR, name)
+
+    def _write_pyramid_image(self, name, image, dset, group):
+        with instrumentation.get().stage('pyramid'):
+            limits = previews.histogram_limits(image)
+            levels = previews.pyramid(image, self.pyramid)
+        dset.attrs[LIMITS_ATTR] = limits
+        for factor, level in levels.items():
+            level_dset = self._replace_dataset(self._level_path(name, group, factor), level)
+            level_dset.attrs[LIMITS_ATTR] = limits
+
+    def _append_pyramid_window(self, name, window, dset, group):
+        with instrumentation.get().stage('pyramid'):
+            limits = previews.histogram_limits(window)
+            levels = previews.pyramid(window, self.pyramid)
+        n_windows = dset.shape[0]
+        limits_path = self._limits_path(name, group)
+        self._append_row(limits_path, n_windows - 1, np.array(limits, dtype=np.float64), chunk_rows=TABLE_CHUNK_ROWS)
+        dset.attrs['histogram_limits_table'] = limits_path
+        for factor, level in levels.items():
+            level_dset = self._append_row(self._level_path(name, group, factor), n_windows - 1, level)
+            level_dset.attrs['histogram_limits_table'] = limits_path
+
+    '''
+    Writes row index of a resizable dataset of rows of the shape of row (e.g. a
+    downsampled window), chunked chunk_rows rows per chunk
+    '''
+    def _append_row(self, path, index, row, chunk_rows=1):
+        dset = self.h5file.get(path)
+        if dset is None:
+            dset = self.h5file.create_dataset(path, shape=(0,) + row.shape, maxshape=(None,) + row.shape, dtype=row.dtype, chunks=(chunk_rows,) + row.shape, **self.options)
+        if dset.shape[0] <= index:
+            dset.resize(index + 1, axis=0)
+        dset[index] = row
+        return dset
+
+    def _window_dataset(self, path, frame):
+        dset = self.h5file.get(path)
+        if dset is not None and np.can_cast(frame.dtype, dset.dtype):
+            return dset
+
+        # New dataset, or the sums have had to move to a larger dtype part way
+        # through, in which case the windows so far are copied into a new one
+        dtype = frame.dtype if dset is None else np.result_type(dset.dtype, frame.dtype)
+        existing = None
+        if dset is not None:
+            existing = dset[()]
+            del self.h5file[path]
+        dset = self.h5file.create_dataset(path, shape=(0,) + frame.shape, maxshape=(None,) + frame.shape, dtype=dtype, chunks=(1,) + frame.shape, **self.options)
+        if existing is not None:
+            dset.resize(len(existing), axis=0)
+            dset[...] = existing
+        return dset
@@ -0,0 +1,198 @@
+import collections
+import numpy as np
+import os
+import struct
+
+'''
+Where the pixels of a frame are in its file: byte offset, frame shape and
+dtype. signature holds (position, bytes) pairs which every file with this
+layout has, used to check that another file in a series shares the layout
+without parsing its header again.
+'''
+FrameLayout = collections.namedtuple('FrameLayout', ['offset', 'shape', 'dtype', 'signature'])
+
+# Layouts already found, by (directory, extension, file size), so that a
+# header is only parsed once for a series of files written the same way
+_layout_cache = {}
+
+TIFF_COMPRESSION_NONE = 1
+TIFF_TAGS = {256: 'width', 257: 'height', 258: 'bits', 259: 'compression', 273: 'strip_offsets',
+             277: 'samples', 279: 'strip_byte_counts', 322: 'tile_width', 339: 'sample_format'}
+# TIFF field type -> struct format
+TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+# SampleFormat -> numpy dtype kind
+TIFF_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+EDF_BLOCK_SIZE = 512
+EDF_LAYOUT_KEYS = ['byteorder', 'datatype', 'dim_1', 'dim_2', 'dim_3', 'size', 'compression']
+EDF_DATA_TYPES = {
+    'unsignedbyte': 'u1', 'unsignedchar': 'u1', 'signedbyte': 'i1', 'signedchar': 'i1',
+    'unsignedshort': 'u2', 'unsignedshortinteger': 'u2', 'signedshort': 'i2', 'signedshortinteger': 'i2',
+    'unsignedinteger': 'u4', 'unsignedlong': 'u4', 'unsignedinteger32': 'u4', 'unsignedlonginteger': 'u4',
+    'signedinteger': 'i4', 'signedlong': 'i4', 'signedinteger32': 'i4', 'signedlonginteger': 'i4',
+    'unsigned64': 'u8', 'unsignedlong64': 'u8', 'signed64': 'i8', 'signedlong64': 'i8',
+    'floatvalue': 'f4', 'float': 'f4', 'real': 'f4', 'doublevalue': 'f8', 'double': 'f8',
+}
+
+
+'''
+Raised when a file can't be memory mapped (e.g. it is compressed), so that
+it should be read the usual way
+'''
+class UnsupportedLayout(Exception):
+    pass
+
+
+'''
+Returns the frame in an uncompressed TIFF or EDF file as a read-only memory
+map of the pixels in the file, so they are neither decoded nor copied. Returns
+None for any other file (including compressed ones), which should then be
+read with fabio.
+
+The header of the first file of a series is parsed and the layout is cached;
+other files of the same size in the same directory only have a few bytes
+checked against it.
+'''
+def read_frame(file_name):
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in ('.tif', '.tiff'):
+        parse_header = tiff_layout
+    elif ext == '.edf':
+        parse_header = edf_layout
+    else:
+        return None
+
+    file_size = os.path.getsize(file_name)
+    cache_key = (os.path.dirname(os.path.abspath(file_name)), ext, file_size)
+    layout = _layout_cache.get(cache_key)
+    try:
+        with open(file_name, 'rb') as image_file:
+            if layout is None or not _matches(image_file, layout.signature):
+                image_file.seek(0)
+                layout = parse_header(image_file)
+                _layout_cache[cache_key] = layout
+    except (UnsupportedLayout, ValueError, KeyError, struct.error):
+        return None
+
+    if layout.offset + int(np.prod(layout.shape)) * layout.dtype.itemsize > file_size:
+        return None
+    return np.memmap(file_name, dtype=layout.dtype, mode='r', offset=layout.offset, shape=layout.shape)
+
+
+def _matches(image_file, signature):
+    for position, expected in signature:
+        image_file.seek(position)
+        if image_file.read(len(expected)) != expected:
+            return False
+    return True
+
+
+'''
+Finds the layout of the first image in a TIFF file, if it is a single channel
+image stored in uncompressed, contiguous strips
+'''
+def tiff_layout(image_file):
+    header = image_file.read(8)
+    byte_order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byte_order is None or struct.unpack(byte_order + 'H', header[2:4])[0] != 42:
+        # Not a (classic) TIFF
+        raise UnsupportedLayout()
+    ifd_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+
+    image_file.seek(ifd_offset)
+    n_tags = struct.unpack(byte_order + 'H', image_file.read(2))[0]
+    entries = image_file.read(12 * n_tags)
+    tags = {}
+    for i in range(n_tags):
+        tag, field_type, count, value = struct.unpack(byte_order + 'HHI4s', entries[12*i:12*(i + 1)])
+        if tag in TIFF_TAGS:
+            tags[TIFF_TAGS[tag]] = _tiff_values(image_file, byte_order, field_type, count, value)
+
+    if tags.get('compression', [TIFF_COMPRESSION_NONE])[0] != TIFF_COMPRESSION_NONE or 'tile_width' in tags:
+        raise UnsupportedLayout()
+    if tags.get('samples', [1])[0] != 1:
+        raise UnsupportedLayout()
+
+    offsets, byte_counts = tags['strip_offsets'], tags['strip_byte_counts']
+    if any(offsets[i] + byte_counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        # Strips are not one after the other
+        raise UnsupportedLayout()
+
+    bits = tags['bits'][0]
+    kind = TIFF_SAMPLE_FORMATS.get(tags.get('sample_format', [1])[0])
+    if kind is None or bits % 8 != 0:
+        raise UnsupportedLayout()
+    dtype = np.dtype('{}{}{}'.format(byte_order, kind, bits // 8))
+
+    shape = (tags['height'][0], tags['width'][0])
+    if sum(byte_counts) != shape[0] * shape[1] * dtype.itemsize:
+        raise UnsupportedLayout()
+    # The byte order, magic number and offset of the image directory, and the
+    # directory itself (values which change between files, e.g. the time, are
+    # stored outside it)
+    return FrameLayout(offsets[0], shape, dtype, ((0, header), (ifd_offset + 2, entries)))
+
+
+def _tiff_values(image_file, byte_order, field_type, count, value):
+    if field_type not in TIFF_TYPES:
+        raise UnsupportedLayout()
+    fmt = '{}{}{}'.format(byte_order, count, TIFF_TYPES[field_type])
+    size = struct.calcsize(fmt)
+    if size <= 4:
+        return list(struct.unpack(fmt, value[:size]))
+    # Values which don't fit in the entry are stored elsewhere in the file
+    position = image_file.tell()
+    image_file.seek(struct.unpack(byte_order + 'I', value)[0])
+    values = list(struct.unpack(fmt, image_file.read(size)))
+    image_file.seek(position)
+    return values
+
+
+'''
+Finds the layout of the first image in an EDF file, if it is uncompressed
+'''
+def edf_layout(image_file):
+    header = image_file.read(EDF_BLOCK_SIZE)
+    if not header.startswith(b'{'):
+        raise UnsupportedLayout()
+    # Headers are padded to a multiple of the block size and end with '}\n'
+    while b'}' not in header:
+        block = image_file.read(EDF_BLOCK_SIZE)
+        if not block:
+            raise UnsupportedLayout()
+        header += block
+    end = header.index(b'}') + 1
+    if header[end:end + 1] == b'\n':
+        end += 1
+
+    # Keys and values, and where each 'key = value ;' entry is in the header
+    keys = {}
+    entries = {}
+    position = 1
+    for entry in header[1:header.index(b'}')].split(b';'):
+        key, sep, value = entry.decode('ascii', 'replace').partition('=')
+        if sep:
+            keys[key.strip().lower()] = value.strip()
+            entries[key.strip().lower()] = (position, entry)
+        position += len(entry) + 1
+
+    if keys.get('compression', 'none').lower() not in ('none', 'no', ''):
+        raise UnsupportedLayout()
+    if int(keys.get('dim_3', 1)) != 1:
+        raise UnsupportedLayout()
+    kind = EDF_DATA_TYPES.get(keys['datatype'].lower())
+    if kind is None:
+        raise UnsupportedLayout()
+    byte_order = '>' if keys.get('byteorder', 'LowByteFirst').lower() == 'highbytefirst' else '<'
+    dtype = np.dtype(byte_order + kind)
+
+    shape = (int(keys['dim_2']), int(keys['dim_1']))
+    if 'size' in keys and int(keys['size']) != shape[0] * shape[1] * dtype.itemsize:
+        raise UnsupportedLayout()
+    # Per-frame values (e.g. times) vary between files, so only check that
+    # the header closes in the same place and that the entries which set the
+    # layout are the same
+    closing = header[header.index(b'}'):end]
+    signature = [(0, b'{'), (end - len(closing), closing)]
+    signature.extend(entries[key] for key in EDF_LAYOUT_KEYS if key in entries)
+    return FrameLayout(end, shape, dtype, tuple(signature))
@@ -0,0 +1,82 @@
+import collections
+import concurrent.futures
+
+try:
+    from . import accumulators, instrumentation
+except ImportError:
+    import accumulators
+    import instrumentation
+
+# Number of windows submitted to the pool per worker, ahead of the window being
+# written out
+IN_FLIGHT_PER_WORKER = 2
+
+
+'''
+Merges windows in parallel over a pool of processes.
+
+Each entry in windows is passed to reduce_window in a worker process, which
+should read and merge its own subset of frames and return a dictionary
+{"avg": ..., "sum": ...} (c.f. merge.py merge_frames). reduce_window must be
+a module level function, so that it can be sent to the workers.
+
+Results are assembled in window order into (n_windows, H, W) datasets. Since
+each worker merges its frames in the same order as the serial path would, the
+results are identical. If on_window is given, each window is instead passed to
+on_window(avg, sum) in order, as soon as it is available, and None is
+returned. At most IN_FLIGHT_PER_WORKER windows per worker are submitted at a
+time (as frame_io.prefetch_frames does for files), so with on_window the
+memory needed doesn't grow with the number of windows.
+
+Progress is reported as each window is merged. The workers' own stages are
+not timed (see instrumentation.start_worker), so only the time spent waiting
+for windows and writing them is recorded.
+'''
+def merge_windows(windows, reduce_window, workers, on_window=None):
+    avgd = sumd = None
+    instruments = instrumentation.get()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.start_worker) as pool:
+        # Only a few windows are submitted ahead of the one being written, so
+        # finished windows don't pile up in memory while an earlier one is slow
+        pending = collections.deque()
+        window_iter = iter(enumerate(windows))
+        try:
+            for i, window in window_iter:
+                pending.append((i, pool.submit(reduce_window, window)))
+                if len(pending) >= IN_FLIGHT_PER_WORKER * workers:
+                    break
+
+            while pending:
+                i, future = pending.popleft()
+                with instruments.stage('wait'):
+                    merged = future.result()
+                for next_i, window in window_iter:
+                    pending.append((next_i, pool.submit(reduce_window, window)))
+                    break
+                instruments.frame_done(len(windows[i]))
+                if on_window is not None:
+                    on_window(merged['avg'], merged['sum'])
+                else:
+                    avgd, sumd = accumulators.store_window(avgd, sumd, i, len(windows), merged)
+        finally:
+            # If a window fails, don't merge windows which will never be used
+            for _, future in pending:
+                future.cancel()
+
+    if on_window is not None:
+        return None
+    return {"avg": avgd, "sum": sumd}
+
+
+'''
+Splits a list into windows of window items, starting every stride items (by
+default, consecutive windows). Items left over at the end which do not fill a
+whole window are dropped, unless keep_partial is set.
+'''
+def split_windows(items, window, keep_partial=False, stride=None):
+    stride = stride or window
+    windows = [items[i:i+window] for i in range(0, len(items) - window + 1, stride)]
+    n_used = (len(windows) - 1) * stride + window if windows else 0
+    if keep_partial and stride == window and n_used < len(items):
+        windows.append(items[n_used:])
+    return windows
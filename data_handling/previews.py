@@ -0,0 +1,78 @@
+import numpy as np
+
+try:
+    from . import histogram_limits as histogram
+except ImportError:
+    import histogram_limits as histogram
+
+PYRAMID_LEVELS = [2, 4, 8]
+# Percentage of the largest bin of the histogram a bin must hold to be within
+# the limits, as in DAWN (and plotting/histogram_applicator.py)
+VALUE_FREQ_PERCENT = 0.005
+
+
+'''
+Parses the pyramid option: downsampling factors separated by commas
+'''
+def parse_levels(value):
+    levels = sorted(set(int(factor) for factor in value.split(',')))
+    if levels[0] < 2:
+        raise Exception('Pyramid levels must downsample by at least 2, not {}'.format(levels[0]))
+    return levels
+
+
+'''
+Downsamples a frame by averaging blocks of factor x factor pixels, as float32.
+Rows and columns left over at the bottom and right edges (if the shape is not
+a multiple of factor) are dropped. A factor of 1 returns the frame as it is.
+This is also used by plotting/fast_preview.py.
+'''
+def block_mean(frame, factor):
+    if factor <= 1:
+        return frame
+    rows, cols = frame.shape[0] // factor, frame.shape[1] // factor
+    if rows == 0 or cols == 0:
+        raise Exception('Cannot downsample a frame of shape {} by {}'.format(frame.shape, factor))
+    # Adding up strided slices is several times quicker than mean over the
+    # axes of a (rows, factor, cols, factor) view
+    row_blocks = frame[:rows * factor, :cols * factor].reshape(rows, factor, cols * factor)
+    row_sums = row_blocks[:, 0].astype(np.float32)
+    for i in range(1, factor):
+        row_sums += row_blocks[:, i]
+    sums = row_sums[:, 0::factor].copy()
+    for i in range(1, factor):
+        sums += row_sums[:, i::factor]
+    sums /= factor * factor
+    return sums
+
+
+'''
+Returns {factor: downsampled frame} for each of the levels of a pyramid. Each
+level is made from the one before it where it can be (e.g. 4x from 2x), which
+is quicker than starting from the full frame each time.
+'''
+def pyramid(frame, levels=PYRAMID_LEVELS):
+    downsampled = {}
+    source, source_factor = frame, 1
+    for factor in sorted(levels):
+        if factor % source_factor == 0:
+            downsampled[factor] = block_mean(source, factor // source_factor)
+        else:
+            downsampled[factor] = block_mean(frame, factor)
+        source, source_factor = downsampled[factor], factor
+    return downsampled
+
+
+'''
+Min and max of the colour histogram of a frame, as plotting/histogram_applicator
+calculates them (see histogram_limits.histo_lims). Values which aren't finite
+(e.g. from dividing by a flat field) are left out.
+'''
+def histogram_limits(frame, value_freq_percent=VALUE_FREQ_PERCENT):
+    values = frame
+    if frame.dtype.kind == 'f' and not np.isfinite(frame).all():
+        values = frame[np.isfinite(frame)]
+        if values.size == 0:
+            return (np.nan, np.nan)
+    lo, hi = histogram.histo_lims(values, value_freq_percent)
+    return (float(lo), float(hi))
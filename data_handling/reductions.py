@@ -0,0 +1,266 @@
+import numpy as np
+import os
+import tempfile
+
+try:
+    from . import accumulators, frame_io, instrumentation
+except ImportError:
+    import accumulators
+    import frame_io
+    import instrumentation
+
+REDUCTIONS = ['sum', 'mean', 'std', 'min', 'max', 'median', 'clipped_mean']
+# Reductions which need every frame of a pixel at once, so can't be streamed
+TILED_REDUCTIONS = ['median', 'clipped_mean']
+# Names of the output datasets, where they differ from the reduction
+DATASET_NAMES = {'sum': 'summed', 'mean': 'averaged'}
+
+# Bytes of working memory per frame per pixel of a band, on top of the frames
+# themselves. The most is needed by the sigma clipping of clipped_mean (see
+# _clipped_mean): a float64 copy of the values (8), a float64 scratch array for
+# their deviations (8), the mask of values kept (1) and the mask of values
+# within the clipping limits (1). The other reductions need less at once: the
+# median partitions a copy of the band (at most 8) and std a float64 array of
+# deviations (8), both freed before clipping starts.
+WORKING_BYTES = 18
+# Bytes of working memory per pixel of a band, whatever the number of frames:
+# the per-pixel arrays of the reductions (the band's sums, means, medians,
+# clipping limits, counts of values kept and so on). With every reduction,
+# tracemalloc measures the peak of reduce_band at WORKING_BYTES per frame plus
+# 90-106 bytes per pixel for integer, float32 and float64 frames, and up to
+# about 195 for a band of only 2 float32 frames (where np.median takes a
+# different path); this leaves some headroom over that.
+PIXEL_BYTES = 256
+
+
+'''
+Parses a comma separated list of reductions (e.g. sum,mean,median,std)
+'''
+def parse_reductions(value):
+    reductions = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in reductions if name not in REDUCTIONS]
+    if unknown:
+        raise Exception('Unknown reduction(s) {}; should be some of {}'.format(', '.join(unknown), ', '.join(REDUCTIONS)))
+    return reductions
+
+
+def dataset_name(reduction):
+    return DATASET_NAMES.get(reduction, reduction)
+
+
+'''
+Running per-pixel statistics of frames which are added one at a time: the sum
+and mean (through accumulators.MergeAccumulator, so the sum is exact), the
+standard deviation (with Welford's algorithm, which doesn't lose precision
+like a running sum of squares does), and the minimum and maximum.
+'''
+class RunningStats(object):
+
+    def __init__(self, sum_dtype=None, avg_dtype=np.float32):
+        self.accumulator = accumulators.MergeAccumulator(sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+        self.avg_dtype = np.dtype(avg_dtype)
+        self.n_frames = 0
+        self.mean = self.m2 = None
+        self.min = self.max = None
+
+    def add(self, frame):
+        with instrumentation.get().stage('accumulate'):
+            self._add(frame)
+
+    def _add(self, frame):
+        self.accumulator.add(frame)
+        self.n_frames += 1
+        if self.mean is None:
+            self.mean = np.array(frame, dtype=np.float64)
+            self.m2 = np.zeros(frame.shape, dtype=np.float64)
+            self.min = np.array(frame)
+            self.max = np.array(frame)
+            return
+        delta = frame - self.mean
+        self.mean += delta / self.n_frames
+        self.m2 += delta * (frame - self.mean)
+        np.minimum(self.min, frame, out=self.min)
+        np.maximum(self.max, frame, out=self.max)
+
+    def result(self, reductions):
+        merged = self.accumulator.result()
+        stats = {'sum': merged['sum'], 'mean': merged['avg'], 'min': self.min, 'max': self.max}
+        if 'std' in reductions:
+            # Population standard deviation
+            stats['std'] = np.sqrt(self.m2 / self.n_frames).astype(self.avg_dtype)
+        return {name: stats[name] for name in reductions}
+
+
+'''
+Reduces a band of frames (frames, rows, columns) over the frames.
+
+Pixels are sigma clipped (for clipped_mean) by repeatedly dropping values more
+than clip_sigma standard deviations (of the values kept so far) from the
+median, up to clip_iters times or until nothing more is dropped. This removes
+zingers which would otherwise bias the mean.
+'''
+def reduce_band(band, reductions, sum_dtype=None, avg_dtype=np.float32, clip_sigma=3., clip_iters=5):
+    result = {}
+    if 'sum' in reductions or 'mean' in reductions:
+        merged = accumulators.reduce_stack(band, sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+        result['sum'], result['mean'] = merged['sum'], merged['avg']
+    if 'std' in reductions:
+        result['std'] = np.std(band, axis=0, dtype=np.float64).astype(avg_dtype)
+    if 'min' in reductions:
+        result['min'] = np.min(band, axis=0)
+    if 'max' in reductions:
+        result['max'] = np.max(band, axis=0)
+    if 'clipped_mean' in reductions or 'median' in reductions:
+        median = np.median(band, axis=0)
+        if 'median' in reductions:
+            result['median'] = median.astype(avg_dtype)
+        if 'clipped_mean' in reductions:
+            result['clipped_mean'] = _clipped_mean(band, median, clip_sigma, clip_iters).astype(avg_dtype)
+    return {name: result[name] for name in reductions}
+
+
+def _clipped_mean(band, median, clip_sigma, clip_iters):
+    # Deviations are worked out in place in one scratch array, and compared
+    # into one mask, so the working memory stays at WORKING_BYTES
+    values = band.astype(np.float64)
+    deviations = np.empty(band.shape, dtype=np.float64)
+    within = np.empty(band.shape, dtype=bool)
+    keep = np.ones(band.shape, dtype=bool)
+    n_kept = np.full(median.shape, band.shape[0])
+    for _ in range(clip_iters):
+        mean = np.sum(values, axis=0, where=keep) / n_kept
+        np.subtract(values, mean, out=deviations)
+        np.square(deviations, out=deviations)
+        std = np.sqrt(np.sum(deviations, axis=0, where=keep) / n_kept)
+        np.subtract(values, median, out=deviations)
+        np.abs(deviations, out=deviations)
+        np.less_equal(deviations, clip_sigma * std, out=within)
+        keep &= within
+        n_now = np.sum(keep, axis=0)
+        if np.array_equal(n_now, n_kept):
+            break
+        n_kept = n_now
+    # Should every value of a pixel have been dropped, fall back to the median
+    clipped = np.sum(values, axis=0, where=keep) / np.maximum(n_kept, 1)
+    return np.where(n_kept > 0, clipped, median)
+
+
+'''
+Number of rows of frames to reduce at a time, so that a band across all
+n_frames frames (plus the working memory to reduce it, see WORKING_BYTES and
+PIXEL_BYTES) fits in memory_budget bytes. At least one row is used, however small the budget.
+'''
+def band_rows(n_frames, frame_shape, dtype, memory_budget):
+    row_bytes = int(np.prod(frame_shape[1:])) * (n_frames * (np.dtype(dtype).itemsize + WORKING_BYTES) + PIXEL_BYTES)
+    return int(min(max(memory_budget // row_bytes, 1), frame_shape[0]))
+
+
+'''
+Reduces frames in bands of rows (see reduce_band and band_rows), so that
+reductions which need every frame of a pixel at once (e.g. the median) can be
+done on more frames than would fit in memory.
+
+read_band(first_row, last_row, out) should fill out (frames, rows, columns), a
+C contiguous array, with rows first_row to last_row - 1 of every frame.
+'''
+def reduce_tiled(read_band, n_frames, frame_shape, dtype, reductions, memory_budget=1024**3, **kwargs):
+    rows = band_rows(n_frames, frame_shape, dtype, memory_budget)
+    instruments = instrumentation.get()
+    instruments.message('Reducing {} frames in bands of {} rows'.format(n_frames, rows))
+    instruments.expect(n_frames)
+    band = np.empty((n_frames, rows) + tuple(frame_shape[1:]), dtype=dtype)
+
+    reduced = {}
+    for first_row in range(0, frame_shape[0], rows):
+        last_row = min(first_row + rows, frame_shape[0])
+        if last_row - first_row < rows:
+            # A slice of the band would not be contiguous (which h5py's
+            # read_direct needs), so the last, shorter band gets its own array
+            band = np.empty((n_frames, last_row - first_row) + tuple(frame_shape[1:]), dtype=dtype)
+        read_band(first_row, last_row, band)
+        with instruments.stage('reduce'):
+            reduced_band = reduce_band(band, reductions, **kwargs)
+        for name, data in reduced_band.items():
+            if name not in reduced:
+                reduced[name] = np.empty(frame_shape, dtype=data.dtype)
+            elif not np.can_cast(data.dtype, reduced[name].dtype):
+                # A band's sum had to be summed in a larger dtype
+                reduced[name] = reduced[name].astype(np.result_type(reduced[name], data))
+            reduced[name][first_row:last_row] = data
+    instruments.frame_done(n_frames)
+    return reduced
+
+
+'''
+Reduces the frames in a list of files. Reductions which can be streamed
+(sum, mean, std, min, max) are done one frame at a time (see RunningStats);
+otherwise the frames are reduced in bands of rows (see reduce_tiled).
+
+Bands are sliced straight out of memory mapped frames (see mmap_readers), so
+only the rows of the band are read. Frames which have to be decoded are first
+written once to a temporary memory mapped stack in tmp_dir, rather than being
+decoded again for every band.
+'''
+def reduce_files(file_list, reductions, loader=frame_io.read_image, memory_budget=1024**3, sum_dtype=None, avg_dtype=np.float32, tmp_dir=None, **kwargs):
+    instruments = instrumentation.get()
+    if not any(name in TILED_REDUCTIONS for name in reductions):
+        instruments.expect(len(file_list))
+        stats = RunningStats(sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+        for file_name in file_list:
+            stats.add(loader(file_name))
+            instruments.frame_done()
+        return stats.result(reductions)
+
+    first_frame = loader(file_list[0])
+    n_frames, frame_shape, dtype = len(file_list), first_frame.shape, first_frame.dtype
+    kwargs.update(sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+    single_band = band_rows(n_frames, frame_shape, dtype, memory_budget) == frame_shape[0]
+    if isinstance(first_frame, np.memmap) or single_band:
+        def read_band(first_row, last_row, out):
+            for i, file_name in enumerate(file_list):
+                out[i] = loader(file_name)[first_row:last_row]
+        return reduce_tiled(read_band, n_frames, frame_shape, dtype, reductions, memory_budget, **kwargs)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as stack_dir:
+        stack_file = os.path.join(stack_dir, 'stack.npy')
+        stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=dtype, shape=(n_frames,) + frame_shape)
+        for i, file_name in enumerate(file_list):
+            stack[i] = first_frame if i == 0 else loader(file_name)
+        stack.flush()
+        # The file must be closed (its memory map dropped) before the
+        # directory is removed
+        del stack
+        return _reduce_stack_file(stack_file, n_frames, frame_shape, dtype, reductions, memory_budget, **kwargs)
+
+
+'''
+Reduces a stack of frames written to an npy file (see reduce_files), reading
+it back through a memory map band by band. The memory map is only held while
+this runs.
+'''
+def _reduce_stack_file(stack_file, n_frames, frame_shape, dtype, reductions, memory_budget, **kwargs):
+    stack = np.load(stack_file, mmap_mode='r')
+
+    def read_band(first_row, last_row, out):
+        out[...] = stack[:, first_row:last_row]
+    return reduce_tiled(read_band, n_frames, frame_shape, dtype, reductions, memory_budget, **kwargs)
+
+
+'''
+Reduces frames start to finish of a dataset in an hdf file (or a list of
+files, see frame_io.HDFFrameSource), reading each band of rows across all of
+the frames as one hyperslab
+'''
+def reduce_hdf(file_name, dset_path, reductions, start=None, finish=None, memory_budget=1024**3, sum_dtype=None, avg_dtype=np.float32, **kwargs):
+    with frame_io.HDFFrameSource(file_name, dset_path, start, finish) as source:
+        if not any(name in TILED_REDUCTIONS for name in reductions):
+            instrumentation.get().expect(len(source))
+            stats = RunningStats(sum_dtype=sum_dtype, avg_dtype=avg_dtype)
+            for _, frame in source:
+                stats.add(frame)
+                instrumentation.get().frame_done()
+            return stats.result(reductions)
+
+        def read_band(first_row, last_row, out):
+            source.dataset.read_direct(out, source_sel=np.s_[source.first:source.last + 1, first_row:last_row])
+        return reduce_tiled(read_band, len(source), source.frame_shape, source.dataset.dtype, reductions, memory_budget, sum_dtype=sum_dtype, avg_dtype=avg_dtype, **kwargs)
@@ -0,0 +1,194 @@
+"""fast_preview.py: Quick-look previews of 2d (diffraction) images, coloured with a lookup table in numpy and saved directly with PIL, without matplotlib."""
+
+import os
+import sys
+
+from PIL import Image
+import numpy as np
+
+# The preview and histogram code is shared with data_handling, from the top of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.append(REPO_DIR)
+from data_handling import histogram_limits, previews
+
+__author__ = "Michael T. Wharmby"
+__license__ = "MIT License"
+__status__ = "Development"
+
+LUT_SIZE = 256
+# Colours of the matplotlib (ColorBrewer) sequential colormaps, from low to
+# high; matplotlib interpolates linearly between them
+COLORMAP_COLOURS = {
+    "Blues": ["f7fbff", "deebf7", "c6dbef", "9ecae1", "6baed6", "4292c6", "2171b5", "08519c", "08306b"],
+    "Greys": ["ffffff", "f0f0f0", "d9d9d9", "bdbdbd", "969696", "737373", "525252", "252525", "000000"],
+}
+FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG", "webp": "WEBP"}
+# Largest range of integer values indexed with a table of every value (see lut_indices)
+MAX_VALUE_TABLE = 2**16
+
+
+def colormap_lut(cmap="Blues_r"):
+    """256 entry RGB lookup table of a colormap, the same as matplotlib gives (cmap(np.arange(256), bytes=True)). Colormap names ending in _r are reversed.
+
+    Parameters
+    ----------
+    cmap : str
+        One of the colormaps in COLORMAP_COLOURS, with or without _r
+
+    Returns
+    -------
+    type : numpy array
+        uint8 array of shape (256, 3)"""
+    name = cmap[:-2] if cmap.endswith("_r") else cmap
+    if name not in COLORMAP_COLOURS:
+        raise Exception("Unknown colormap {}; should be one of {} (or reversed, with _r)".format(cmap, ", ".join(sorted(COLORMAP_COLOURS))))
+    colours = np.array([[int(colour[i:i+2], 16) for i in (0, 2, 4)] for colour in COLORMAP_COLOURS[name]], dtype=np.float64) / 255.
+    stops = np.linspace(0., 1., len(colours))
+    if cmap.endswith("_r"):
+        colours, stops = colours[::-1], 1. - stops[::-1]
+    # Interpolated as matplotlib does it, so that the colours round the same way
+    stops = stops * (LUT_SIZE - 1)
+    positions = (LUT_SIZE - 1) * np.linspace(0., 1., LUT_SIZE)
+    ind = np.searchsorted(stops, positions)[1:-1]
+    distance = ((positions[1:-1] - stops[ind - 1]) / (stops[ind] - stops[ind - 1]))[:, np.newaxis]
+    lut = np.concatenate([colours[:1], distance * (colours[ind] - colours[ind - 1]) + colours[ind - 1], colours[-1:]])
+    return (np.clip(lut, 0., 1.) * 255).astype(np.uint8)
+
+def colour_indices(img, histo_clims, dtype=None):
+    """Index into the colormap lookup table of each pixel, as matplotlib colours an image with these colour limits: values below the lower limit get the first colour and values above the upper limit the last. NaNs get the first colour.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image data
+    histo_clims : tuple of float
+        Min and max intensity values for the colourmap
+    dtype : numpy dtype
+        Type of the image the values come from, if img is a table of its values; it sets the precision of the calculation, as in matplotlib (float32 for 8 and 16 bit integers)
+
+    Returns
+    -------
+    type : numpy array
+        uint8 array of the shape of img"""
+    dtype = np.promote_types(dtype or img.dtype, np.float32)
+    lo, hi = np.array(histo_clims, dtype=dtype)
+    if hi <= lo:
+        return np.zeros(img.shape, dtype=np.uint8)
+    indices = np.subtract(img, lo, dtype=dtype)
+    indices /= hi - lo
+    indices *= LUT_SIZE
+    if dtype.kind == "f":
+        np.nan_to_num(indices, copy=False, nan=0.)
+    np.clip(indices, 0, LUT_SIZE - 1, out=indices)
+    return indices.astype(np.uint8)
+
+def lut_indices(img, histo_clims):
+    """Index into the colormap lookup table of each pixel of an image (see colour_indices).
+
+    Integer images with a small range of values (up to MAX_VALUE_TABLE values, e.g. any 16 bit image) are indexed with a table of the index of every value, so each pixel is only looked up once.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image data
+    histo_clims : tuple of float
+        Min and max intensity values for the colourmap
+
+    Returns
+    -------
+    type : numpy array
+        uint8 array of the shape of img"""
+    if img.dtype.kind == "u" and img.dtype.itemsize <= 2:
+        return colour_indices(np.arange(np.iinfo(img.dtype).max + 1), histo_clims, img.dtype).take(img)
+    if img.dtype.kind == "i" and img.size > MAX_VALUE_TABLE:
+        lo, hi = int(img.min()), int(img.max())
+        if hi - lo < MAX_VALUE_TABLE:
+            return colour_indices(np.arange(lo, hi + 1), histo_clims, img.dtype).take(np.subtract(img, lo, dtype=np.intp))
+    return colour_indices(img, histo_clims)
+
+def colour_image(img, histo_clims, lut):
+    """Colour an image with a lookup table (see colormap_lut) between the colour histogram limits.
+
+    Parameters
+    ----------
+    img : numpy array
+        Image data
+    histo_clims : tuple of float
+        Min and max intensity values for the colourmap
+    lut : numpy array
+        RGB lookup table
+
+    Returns
+    -------
+    type : numpy array
+        uint8 RGB array of shape img.shape + (3,)"""
+    return lut.take(lut_indices(img, histo_clims), axis=0)
+
+def save_indexed(indices, lut, file_name, image_format=None, compress_level=1, quality=85):
+    """Save an image coloured with a lookup table as a png, jpeg or webp image. pngs are saved with the lookup table as their palette, one byte per pixel, which is much quicker to compress than RGB; jpeg and webp images are coloured in full.
+
+    Parameters
+    ----------
+    indices : numpy array
+        uint8 indices into the lookup table (see lut_indices)
+    lut : numpy array
+        RGB lookup table
+    file_name : str
+        Output file
+    image_format : str
+        png, jpg/jpeg or webp (by default, from the extension of file_name)
+    compress_level : int
+        zlib compression level of pngs, from 0 (none, fastest) to 9
+    quality : int
+        Quality of jpeg and webp images, from 1 to 100"""
+    if image_format is None:
+        image_format = os.path.splitext(file_name)[1][1:]
+    image_format = image_format.lower()
+    if image_format not in FORMATS:
+        raise Exception("Unknown image format {}; should be one of {}".format(image_format, ", ".join(FORMATS)))
+    if FORMATS[image_format] == "PNG":
+        image = Image.fromarray(indices, "P")
+        image.putpalette(lut.tobytes())
+        image.save(file_name, "PNG", compress_level=compress_level)
+    else:
+        image = Image.fromarray(lut.take(indices, axis=0), "RGB")
+        image.save(file_name, FORMATS[image_format], quality=quality)
+
+def preview(img_arr, file_name, outlier_fraction=0.005, histo_clims=None, sample=None, downsample=1, cmap="Blues_r", image_format=None, compress_level=1, quality=85, lut=None):
+    """Save a quick-look preview of an image: the image coloured with a colormap between its colour histogram limits, at one pixel per pixel (or per block of pixels, if downsampled), with no axes or colourbar.
+
+    Parameters
+    ----------
+    img_arr : numpy array
+        Image data
+    file_name : str
+        Output file
+    outlier_fraction : float
+        Limiting percentage used to identify min and max of the colour histogram (see histogram_applicator.histo_lim_calc)
+    histo_clims : tuple of float
+        Colour histogram limits; if not given, they are calculated from the full image
+    sample : int
+        If given, estimate the histogram from about this many pixels
+    downsample : int
+        Average blocks of downsample x downsample pixels (see data_handling/previews.block_mean)
+    cmap : str
+        Colormap (see colormap_lut)
+    image_format, compress_level, quality
+        Output format and its settings (see save_indexed)
+    lut : numpy array
+        Lookup table to use instead of cmap, to avoid building it for each image
+
+    Returns
+    -------
+    type : tuple of float
+        Colour histogram limits used"""
+    if histo_clims:
+        histo_clims = tuple(map(float, histo_clims))
+    else:
+        histo_clims = histogram_limits.histo_lims(img_arr, outlier_fraction, sample)
+    if lut is None:
+        lut = colormap_lut(cmap)
+    indices = lut_indices(previews.block_mean(img_arr, downsample), histo_clims)
+    save_indexed(indices, lut, file_name, image_format, compress_level, quality)
+    return histo_clims
@@ -2,12 +2,23 @@
 """histogram_applicator.py: Applies a colour histrogram to a 2d (diffraction) dataset."""
 
 import os
+import sys
 import argparse
+import concurrent.futures
+import functools
+import time
 
-from PIL import Image
-import matplotlib.pyplot as plt
 import numpy as np
 
+import fast_preview
+import image_sources
+
+# The histogram code is shared with data_handling, from the top of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.append(REPO_DIR)
+from data_handling import histogram_limits
+
 __author__ = "Michael T. Wharmby"
 __license__ = "MIT License"
 __data__ = "10-09-2018"
@@ -16,58 +27,210 @@ __status__ = "Development"
 
 
 def get_img_array(image):
-    """Open an image and return it as a numpy array"""
-    img = Image.open(image)
-    return np.asarray(img)
+    """Open an image and return it as a numpy array. The image can be a TIFF, any other image fabio can open, or a frame of a dataset in an HDF file (see image_sources)"""
+    return image_sources.read_image(image)
 
-def histo_lim_calc(img, value_freq_percent=0.005):
+def histo_lim_calc(img, value_freq_percent=0.005, sample=None):
     """Calculate the upper and lower limits of the colour histogram to be applied to the data. Min and max are determined from the frequency of the occurrence of an intensity value, with selection based on the supplied percentage of the maximum frequency.
 
+    The histogram has 256 bins over the range of intensities. Integer images are counted exactly, value by value, rather than with np.histogram (see histogram_limits).
+
     Parameters
     ----------
     img : numpy array
         Image data to have histogram applied
     value_freq_percent : float
         Limiting percentage used to identify min and max. Default of 0.005% determined from DAWN (www.dawnsci.org)
+    sample : int
+        If given, estimate the histogram from about this many pixels, which is faster for large images
 
     Returns
     -------
     type : tuple of float
         Min and max intensity values for the colourmap"""
-    freqs, bins = np.histogram(img, bins=256)
-    # Need to reduce the number of bins by one. Chop of the highest one
-    bins = bins[:-1]
-    min_freq = np.amax(freqs) * (value_freq_percent/100)
-    more_than_min_bins = bins[freqs > min_freq]
-    return (np.amin(more_than_min_bins), np.amax(more_than_min_bins))
-
-def plot_img(img, name=None, outlier_fraction=0.005, histo_clims=None):
-    """Create a plot of an image using matplotlib and apply the histogram with limits"""
+    return histogram_limits.histo_lims(img, value_freq_percent, sample)
+
+def global_histo_lims(images, value_freq_percent=0.005, sample=None):
+    """Calculate one set of colour histogram limits for a batch of images, from the histogram of all of them together, so that they are all plotted on the same colour scale. Each image is read once.
+
+    Parameters
+    ----------
+    images : list of str or image_sources.HDFFrame
+        Image files or frames of HDF datasets
+    value_freq_percent : float
+        Limiting percentage used to identify min and max
+    sample : int
+        If given, estimate the histogram of each image from about this many pixels
+
+    Returns
+    -------
+    type : tuple of float
+        Min and max intensity values for the colourmap"""
+    accumulator = histogram_limits.HistogramAccumulator(sample=sample)
+    for image in images:
+        accumulator.add(get_img_array(image))
+    return accumulator.limits(value_freq_percent)
+
+class FigureRenderer(object):
+    """Saves plots of images as pngs, reusing one matplotlib figure: the image data and colour limits of the plot are updated (set_data/set_clim) rather than a new figure being made for each image. The figure is only made again if the shape of the images changes. Call close() when finished with it."""
+
+    def __init__(self):
+        self.figure = None
+        self.image = None
+
+    def render(self, img_arr, histo_clims, name):
+        """Plot an image with the given colour histogram limits and save it as name.png"""
+        # matplotlib is only imported once something is plotted with it, so
+        # previews (see preview_img) don't wait for it
+        import matplotlib.pyplot as plt
+        if self.image is None or self.image.get_array().shape != img_arr.shape:
+            self.close()
+            self.figure = plt.figure(tight_layout=True)
+            axes = self.figure.gca()
+
+            # List of colormaps available in matplotlib:
+            # https://matplotlib.org/users/colormaps.html
+            self.image = axes.imshow(img_arr, cmap="Blues_r", clim=tuple(histo_clims))
+            self.figure.colorbar(self.image)
+
+            #Set ticks for both axes to run from 0 to 2048 in steps of 500
+            axes.xaxis.set_ticks(np.arange(0,2048,500))
+            axes.yaxis.set_ticks(np.arange(0,2048,500))
+
+            # tight_layout adjusts the subplot parameters each time the figure
+            # is saved, starting from where it left them last time; keep the
+            # initial ones so every image is laid out as on a new figure
+            params = self.figure.subplotpars
+            self.subplot_params = dict((key, getattr(params, key)) for key in ["left", "bottom", "right", "top", "wspace", "hspace"])
+        else:
+            self.image.set_data(img_arr)
+            self.image.set_clim(*histo_clims)
+            self.figure.subplots_adjust(**self.subplot_params)
+
+        #Save the image as a 300dpi png
+        print("Saving {}.png...".format(name))
+        self.figure.savefig(str(name)+".png", dpi=300)
+
+    def close(self):
+        if self.figure is not None:
+            import matplotlib.pyplot as plt
+            plt.close(self.figure)
+            self.figure = None
+            self.image = None
+
+def plot_img(img, name=None, outlier_fraction=0.005, histo_clims=None, sample=None, renderer=None):
+    """Create a plot of an image using matplotlib and apply the histogram with limits. If a FigureRenderer is given, its figure is reused; otherwise a figure is made for this image and closed once it is saved."""
     if name ==None:
-        name = os.path.splitext(img)[0]
+        name = image_sources.output_name(img)
     img_arr = get_img_array(img)
 
-    plt.figure(tight_layout=True)
     if histo_clims:
         # Convert user supplied limits to a tuple of floats
         histo_clims = tuple(map(float, histo_clims))
     else:
         # No colormap limits provided, so calculate out own
-        histo_clims = histo_lim_calc(img_arr, outlier_fraction)
+        histo_clims = histo_lim_calc(img_arr, outlier_fraction, sample)
+
+    if renderer is not None:
+        renderer.render(img_arr, histo_clims, name)
+        return
+    renderer = FigureRenderer()
+    try:
+        renderer.render(img_arr, histo_clims, name)
+    finally:
+        renderer.close()
+
+def preview_img(img, name=None, outlier_fraction=0.005, histo_clims=None, sample=None, image_format="png", **options):
+    """Save a quick-look preview of an image, coloured with a lookup table and saved directly with PIL, without matplotlib (no axes or colourbar). This is much faster than plot_img, particularly if downsampled.
+
+    Parameters
+    ----------
+    img : str or image_sources.HDFFrame
+        Image file or frame of an HDF dataset
+    name : str
+        Output file, without its extension (by default, the image file without its extension)
+    image_format : str
+        png, jpg or webp
+    options
+        downsample, cmap, compress_level, quality and lut (see fast_preview.preview)"""
+    if name ==None:
+        name = image_sources.output_name(img)
+    file_name = "{}.{}".format(name, image_format)
+    print("Saving {}...".format(file_name))
+    fast_preview.preview(get_img_array(img), file_name, outlier_fraction, histo_clims, sample, image_format=image_format, **options)
+
+# Figure reused by each process rendering a batch (see render_batch)
+_batch_renderer = None
+
+def _start_batch_renderer(preview=False):
+    """Initialise a process for rendering a batch: the non-interactive Agg backend, and one figure for all of its images (unless making previews, which don't use matplotlib)"""
+    global _batch_renderer
+    if preview:
+        return
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
+    _batch_renderer = FigureRenderer()
+
+def _render_batch_image(img, outlier_fraction=0.005, histo_clims=None, sample=None, out_dir=None, preview=None):
+    started = time.time()
+    name = None
+    if out_dir is not None:
+        name = os.path.join(out_dir, os.path.basename(image_sources.output_name(img)))
+    if preview is not None:
+        preview_img(img, name=name, outlier_fraction=outlier_fraction, histo_clims=histo_clims, sample=sample, **preview)
+    else:
+        plot_img(img, name=name, outlier_fraction=outlier_fraction, histo_clims=histo_clims, sample=sample, renderer=_batch_renderer)
+    return img, time.time() - started
+
+def render_batch(images, workers=1, outlier_fraction=0.005, histo_clims=None, sample=None, out_dir=None, preview=None):
+    """Plot a batch of images (see plot_img), in a pool of worker processes if workers > 1. Each process renders with the Agg backend and reuses one figure for all of its images (see FigureRenderer), so memory does not grow with the number of images. If preview options are given, quick-look previews are saved instead (see preview_img).
+
+    The time taken for each image and the throughput of the whole batch are printed.
 
-    # List of colormaps available in matplotlib:
-    # https://matplotlib.org/users/colormaps.html
-    plt.imshow(img_arr, cmap="Blues_r", clim=tuple(histo_clims))
-    plt.colorbar()
+    Parameters
+    ----------
+    images : list of str or image_sources.HDFFrame
+        Image files or frames of HDF datasets (see image_sources.expand_images). Each image is only read when it is rendered, so a long series is streamed rather than loaded at once
+    workers : int
+        Number of processes rendering images
+    out_dir : str
+        Directory the pngs are saved in (by default, each is saved beside its image)
+    preview : dict
+        Options of preview_img (image_format, downsample, cmap, compress_level, quality), to make previews rather than plots
 
-    #Set ticks for both axes to run from 0 to 2048 in steps of 500
-    axes = plt.gca()
-    axes.xaxis.set_ticks(np.arange(0,2048,500))
-    axes.yaxis.set_ticks(np.arange(0,2048,500))
+    Returns
+    -------
+    type : dict
+        Number of images, total seconds, images per second and the seconds taken for each image"""
+    if preview is not None:
+        # Build the colormap lookup table once for the whole batch
+        preview = dict(preview)
+        preview["lut"] = fast_preview.colormap_lut(preview.pop("cmap", "Blues_r"))
+    render = functools.partial(_render_batch_image, outlier_fraction=outlier_fraction, histo_clims=histo_clims, sample=sample, out_dir=out_dir, preview=preview)
+    started = time.time()
+    per_image = []
+    if workers > 1:
+        # Worker processes mustn't inherit open HDF files
+        image_sources.close_files()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_start_batch_renderer, initargs=(preview is not None,)) as pool:
+            for img, seconds in pool.map(render, images):
+                print("Rendered {} in {:.2f} s".format(img, seconds))
+                per_image.append(seconds)
+    else:
+        _start_batch_renderer(preview is not None)
+        try:
+            for img, seconds in map(render, images):
+                print("Rendered {} in {:.2f} s".format(img, seconds))
+                per_image.append(seconds)
+        finally:
+            if _batch_renderer is not None:
+                _batch_renderer.close()
+            image_sources.close_files()
 
-    #Save the image as a 300dpi png
-    print("Saving {}.png...".format(name))
-    plt.savefig(str(name)+".png", dpi=300)
+    total = time.time() - started
+    rate = len(per_image) / total if total > 0 else 0.
+    print("Rendered {} images in {:.1f} s ({:.2f} images/s, {:.2f} s per image per worker)".format(len(per_image), total, rate, np.mean(per_image) if per_image else 0.))
+    return {"images": len(per_image), "seconds": total, "images_per_second": rate, "per_image_seconds": per_image}
 
 #######################################################################################################################
 
@@ -77,8 +240,20 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--file', dest='filename', default=None)
     parser.add_argument('-l', '--list', nargs='*', dest='filelist', default=None)
     parser.add_argument('-d', '--directory', dest='dirname', default=None)
-    parser.add_argument('-o', '--outliers', dest='outlier_frac', default=0.005)
+    parser.add_argument('--dset', dest='dset_path', default=image_sources.DEFAULT_DSET_PATH, help='Path to the dataset of frames in hdf files (default: %(default)s); a path can also be given with the file, as file.h5:/path/to/dataset')
+    parser.add_argument('--dset-start', dest='dset_start', type=int, default=None, help='First frame in an hdf dataset to plot')
+    parser.add_argument('--dset-finish', dest='dset_end', type=int, default=None, help='Last frame in an hdf dataset to plot')
+    parser.add_argument('-o', '--outliers', dest='outlier_frac', type=float, default=0.005)
     parser.add_argument('--histo-lims', dest='histo_clims', nargs=2)
+    parser.add_argument('--sample', dest='sample', type=int, default=None, help='Estimate the histogram of each image from about this many pixels, rather than all of them')
+    parser.add_argument('--global-limits', dest='global_limits', action='store_true', help='Use the same colour histogram limits for every image, from the histogram of all of the images')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=1, help='Number of processes rendering images in parallel')
+    parser.add_argument('--preview', dest='preview', action='store_true', help='Save quick-look previews (the image coloured pixel for pixel, without axes or colourbar) instead of matplotlib plots; much faster')
+    parser.add_argument('--format', dest='image_format', choices=['png', 'jpg', 'webp'], default='png', help='Format of previews')
+    parser.add_argument('--downsample', dest='downsample', type=int, default=1, help='Average blocks of this many pixels square in previews')
+    parser.add_argument('--cmap', dest='cmap', default='Blues_r', help='Colormap of previews: {} (or reversed, with _r)'.format(', '.join(sorted(fast_preview.COLORMAP_COLOURS))))
+    parser.add_argument('--compress-level', dest='compress_level', type=int, default=1, help='zlib compression level (0-9) of png previews')
+    parser.add_argument('--quality', dest='quality', type=int, default=85, help='Quality (1-100) of jpg and webp previews')
 
     args = parser.parse_args()
 
@@ -86,19 +261,30 @@ if __name__ == '__main__':
         outliers = args.outlier_frac
 
     if args.filename:
-        plot_img(args.filename, outlier_fraction=outliers, histo_clims=args.histo_clims)
+        images = [args.filename]
     elif args.filelist:
         for imgfile in args.filelist:
-            if os.path.exists(imgfile):
-                plot_img(imgfile, outlier_fraction=outliers, histo_clims=args.histo_clims)
-            else:
+            if not os.path.exists(image_sources.split_image_path(imgfile)[0]):
                 raise Exception('Cannot find file {}'.format(imgfile))
+        images = args.filelist
     elif args.dirname:
-        files_in_dir = os.listdir(args.dirname)
-        for imgfile in files_in_dir:
+        images = []
+        for imgfile in sorted(os.listdir(args.dirname)):
             full_imgfile = os.path.join(args.dirname, imgfile)
-            if os.path.splitext(full_imgfile)[1] not in ['.tif', '.tiff']:
+            if os.path.splitext(full_imgfile)[1].lower() not in image_sources.IMAGE_EXTS:
                 continue
-            plot_img(full_imgfile, outlier_fraction=outliers, histo_clims=args.histo_clims)
+            images.append(full_imgfile)
     else:
         raise Exception('No image source provided.')
+    # Frames of hdf datasets are listed here, but only read as they are plotted
+    images = image_sources.expand_images(images, args.dset_path, args.dset_start, args.dset_end)
+
+    histo_clims = args.histo_clims
+    if args.global_limits and not histo_clims:
+        histo_clims = global_histo_lims(images, outliers, args.sample)
+        print("Colour histogram limits for all images: {} - {}".format(*histo_clims))
+
+    preview = None
+    if args.preview:
+        preview = {"image_format": args.image_format, "downsample": args.downsample, "cmap": args.cmap, "compress_level": args.compress_level, "quality": args.quality}
+    render_batch(images, workers=args.workers, outlier_fraction=outliers, histo_clims=histo_clims, sample=args.sample, preview=preview)
@@ -0,0 +1,147 @@
+"""image_sources.py: Reads 2d (diffraction) images to plot from image files and from frames of datasets in HDF files, one frame at a time."""
+
+import os
+import sys
+
+from PIL import Image
+import numpy as np
+
+try:
+    import fabio
+except ImportError:
+    # Only needed for image formats other than TIFF
+    fabio = None
+try:
+    import h5py
+except ImportError:
+    # Only needed for HDF files
+    h5py = None
+
+__author__ = "Michael T. Wharmby"
+__license__ = "MIT License"
+__status__ = "Development"
+
+# The HDF path helpers are shared with data_handling, from the top of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.append(REPO_DIR)
+from data_handling.image_paths import HDF_EXTS, is_hdf, split_image_path
+
+PIL_EXTS = [".tif", ".tiff"]
+# Files picked up from a directory: TIFFs, other detector formats fabio can
+# open, and HDF files
+IMAGE_EXTS = PIL_EXTS + [".edf", ".cbf", ".img", ".mccd", ".sfrm", ".gfrm", ".npy"] + HDF_EXTS
+DEFAULT_DSET_PATH = "data/averaged"
+
+
+class HDFFrame(object):
+    """One frame of a dataset in an HDF file: the frame at index of a stack of frames (e.g. the windows of data/averaged in a merged file), or the whole dataset if it is a single image (index None). Only the file name, dataset path and index are held, so frames can be listed and sent to other processes without reading any data."""
+
+    def __init__(self, file_name, dset_path, index=None):
+        self.file_name = file_name
+        self.dset_path = dset_path
+        self.index = index
+
+    def __str__(self):
+        if self.index is None:
+            return "{}:{}".format(self.file_name, self.dset_path)
+        return "{}:{}[{}]".format(self.file_name, self.dset_path, self.index)
+
+    def output_name(self):
+        """Name for plots of the frame: the file without its extension, the dataset path and the index, e.g. merged_data_averaged_00003"""
+        name = "{}_{}".format(os.path.splitext(self.file_name)[0], self.dset_path.strip("/").replace("/", "_"))
+        if self.index is not None:
+            name += "_{:05d}".format(self.index)
+        return name
+
+    def read(self):
+        dataset = _open_dataset(self.file_name, self.dset_path)
+        if self.index is None:
+            return dataset[()]
+        return dataset[self.index]
+
+# HDF files opened in this process, kept open so that reading a series of
+# frames one at a time doesn't reopen the file for each frame. They must be
+# closed (see close_files) before starting worker processes, which would
+# otherwise inherit them.
+_hdf_files = {}
+
+def _open_dataset(file_name, dset_path):
+    if h5py is None:
+        raise Exception("h5py is needed to read {}".format(file_name))
+    data_file = _hdf_files.get(file_name)
+    if data_file is None:
+        data_file = _hdf_files[file_name] = h5py.File(file_name, "r")
+    dataset = data_file.get(dset_path)
+    if dataset is None:
+        raise Exception("Could not find dataset {} in {}".format(dset_path, file_name))
+    return dataset
+
+def close_files():
+    """Close the HDF files opened to read frames"""
+    for data_file in _hdf_files.values():
+        data_file.close()
+    _hdf_files.clear()
+
+def hdf_frames(image_path, dset_path=DEFAULT_DSET_PATH, start=None, finish=None):
+    """List the frames of a dataset in an HDF file, without reading them.
+
+    Parameters
+    ----------
+    image_path : str
+        HDF file, or file.h5:/path/to/dataset
+    dset_path : str
+        Path of the dataset, if not given in image_path
+    start, finish : int
+        First and last frames (inclusive; counting backwards if start > finish). By default, all of the frames
+
+    Returns
+    -------
+    type : list of HDFFrame
+        One frame, if the dataset is a single image"""
+    file_name, path = split_image_path(image_path)
+    dset_path = path or dset_path
+    if h5py is None:
+        raise Exception("h5py is needed to read {}".format(file_name))
+    with h5py.File(file_name, "r") as data_file:
+        dataset = data_file.get(dset_path)
+        if dataset is None:
+            raise Exception("Could not find dataset {} in {}".format(dset_path, file_name))
+        shape = dataset.shape
+    if len(shape) == 2:
+        return [HDFFrame(file_name, dset_path)]
+    if len(shape) != 3:
+        raise Exception("Dataset {} in {} has {} dimensions; expected a frame or a stack of frames".format(dset_path, file_name, len(shape)))
+
+    n_frames = shape[0]
+    start = 0 if start is None else start
+    finish = n_frames - 1 if finish is None else finish
+    if not (0 <= start < n_frames and 0 <= finish < n_frames):
+        raise Exception("Frames {}-{} are outside dataset {} ({} frames)".format(start, finish, dset_path, n_frames))
+    step = 1 if finish >= start else -1
+    return [HDFFrame(file_name, dset_path, i) for i in range(start, finish + step, step)]
+
+def expand_images(images, dset_path=DEFAULT_DSET_PATH, start=None, finish=None):
+    """Replace any HDF files in a list of images with their frames (see hdf_frames); other images are left as they are"""
+    expanded = []
+    for image in images:
+        if isinstance(image, str) and is_hdf(image):
+            expanded.extend(hdf_frames(image, dset_path, start, finish))
+        else:
+            expanded.append(image)
+    return expanded
+
+def output_name(image):
+    """Name for plots of an image (without an extension): an image file without its extension, or see HDFFrame.output_name"""
+    if isinstance(image, HDFFrame):
+        return image.output_name()
+    return os.path.splitext(image)[0]
+
+def read_image(image):
+    """Read an image and return it as a numpy array: a frame of an HDF dataset (HDFFrame), a TIFF (opened with PIL) or any other image fabio can open"""
+    if isinstance(image, HDFFrame):
+        return image.read()
+    if os.path.splitext(image)[1].lower() in PIL_EXTS or fabio is None:
+        return np.asarray(Image.open(image))
+    # There is no close function in fabio, so can't use a with statement
+    return fabio.open(image).data
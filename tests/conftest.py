@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import data_handling as a package from the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from data_handling import accumulators
+
+
+@pytest.mark.parametrize('frame_dtype,sum_dtype,expected', [
+    ('uint16', 'auto', 'uint32'), ('uint16', 'uint32', 'uint32'), ('int16', None, 'int64'),
+    ('int16', 'int64', 'int64'), ('uint32', 'uint32', 'uint32'), ('float32', 'uint32', 'float64'),
+    ('uint32', 'auto', 'int64'), ('uint64', 'auto', 'float64'), ('uint64', 'float64', 'float64'),
+])
+def test_choose_sum_dtype(frame_dtype, sum_dtype, expected):
+    assert accumulators.choose_sum_dtype(frame_dtype, sum_dtype) == np.dtype(expected)
+
+
+@pytest.mark.parametrize('frame_dtype,sum_dtype', [('int16', 'uint32'), ('int32', 'uint32'), ('uint64', 'int64')])
+def test_sum_dtype_must_hold_frame_values(frame_dtype, sum_dtype):
+    with pytest.raises(Exception, match='cannot be summed as'):
+        accumulators.choose_sum_dtype(frame_dtype, sum_dtype)
+
+
+# uint64 values above the int64 range must not wrap around to negative sums
+def test_large_uint64_frames_do_not_wrap():
+    frames = np.full((3, 2, 2), 2**63 + 2**40, dtype=np.uint64)
+    accumulator = accumulators.MergeAccumulator()
+    for frame in frames:
+        accumulator.add(frame)
+    for merged in [accumulator.result(), accumulators.reduce_stack(frames)]:
+        assert merged['sum'].dtype == np.float64
+        np.testing.assert_allclose(merged['sum'], 3 * float(2**63 + 2**40))
+        assert (merged['avg'] > 0).all()
+
+
+def test_signed_frames_rejected_before_summing():
+    accumulator = accumulators.MergeAccumulator(sum_dtype='uint32')
+    with pytest.raises(Exception, match='cannot be summed as uint32'):
+        accumulator.add(np.full((2, 2), -3, dtype=np.int16))
+    with pytest.raises(Exception, match='cannot be summed as uint32'):
+        accumulators.reduce_stack(np.full((3, 2, 2), -3, dtype=np.int16), sum_dtype='uint32')
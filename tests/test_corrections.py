@@ -0,0 +1,45 @@
+import h5py
+import numpy as np
+import pytest
+
+# corrections reads images through frame_io, which needs fabio
+pytest.importorskip('fabio')
+from data_handling import corrections, frame_cache
+
+FRAME_SHAPE = (6, 5)
+
+
+@pytest.fixture
+def darks(tmp_path):
+    rng = np.random.default_rng(7)
+    file_path = str(tmp_path / 'darks.h5')
+    with h5py.File(file_path, 'w') as h5file:
+        h5file['entry/dark'] = rng.integers(0, 100, (4,) + FRAME_SHAPE).astype(np.uint16)
+        h5file['entry/flat'] = rng.uniform(0.5, 1.5, FRAME_SHAPE)
+    return file_path
+
+
+def test_split_dark_paths(darks):
+    assert corrections.read_image(darks + ':entry/dark').shape == (4,) + FRAME_SHAPE
+
+
+def test_correction_with_cached_dark(tmp_path, darks):
+    dark_paths = [darks + ':entry/dark']
+    cache = frame_cache.FrameCache(str(tmp_path / 'cache'))
+    with h5py.File(darks, 'r') as h5file:
+        expected_dark = h5file['entry/dark'][()].mean(axis=0)
+
+    # The dark is averaged the first time, and read from the cache after that
+    for _ in range(2):
+        correction = corrections.make_correction(dark_paths, cache=cache)
+        np.testing.assert_allclose(correction.dark, expected_dark, rtol=1e-6)
+    assert (cache.misses, cache.hits) == (1, 1)
+
+
+def test_correction_applies_dark_and_flat(darks):
+    correction = corrections.make_correction([darks + ':entry/dark'], darks + ':entry/flat')
+    frame = np.full(FRAME_SHAPE, 200, dtype=np.uint16)
+    with h5py.File(darks, 'r') as h5file:
+        dark = h5file['entry/dark'][()].mean(axis=0)
+        flat = h5file['entry/flat'][()]
+    np.testing.assert_allclose(correction.apply(frame), (frame - dark) * flat.mean() / flat, rtol=1e-5)
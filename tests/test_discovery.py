@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from data_handling import discovery
+
+
+@pytest.fixture
+def scan_dir(tmp_path):
+    scan_dir = tmp_path / 'frames'
+    scan_dir.mkdir()
+    for nr in range(1, 6):
+        (scan_dir / 'scan_{:04d}.tif'.format(nr)).write_bytes(b'')
+    # A duplicate of frame 3 with a different zero fill
+    (scan_dir / 'scan_3.tif').write_bytes(b'')
+    return str(scan_dir)
+
+
+def test_index_frames(scan_dir):
+    index = discovery.index_frames(scan_dir, 'scan', 'tif')
+    assert sorted(index.paths) == [1, 2, 3, 4, 5]
+    assert (index.separator, index.zero_fill) == ('_', 4)
+    assert index.duplicates == {3: [os.path.join(scan_dir, 'scan_0003.tif'), os.path.join(scan_dir, 'scan_3.tif')]}
+    with pytest.raises(Exception, match='more than one file'):
+        discovery.check_frames(index, [2, 3])
+
+
+def test_index_is_reused_from_cache_dir(tmp_path, scan_dir, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    index = discovery.index_frames(scan_dir, 'scan', 'tif', cache_dir)
+
+    # A later run reads the saved index rather than the directory
+    def no_scandir(path):
+        raise AssertionError('directory was scanned again')
+    monkeypatch.setattr(discovery.os, 'scandir', no_scandir)
+    assert discovery.index_frames(scan_dir, 'scan', 'tif', cache_dir) == index
+    monkeypatch.undo()
+
+    # Adding a file changes the directory mtime, so the index is rebuilt
+    open(os.path.join(scan_dir, 'scan_0006.tif'), 'w').close()
+    stat = os.stat(scan_dir)
+    os.utime(scan_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert sorted(discovery.index_frames(scan_dir, 'scan', 'tif', cache_dir).paths) == [1, 2, 3, 4, 5, 6]
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+# frame_io opens frames with fabio
+pytest.importorskip('fabio')
+from data_handling import frame_io
+
+
+@pytest.fixture
+def frame_files(tmp_path):
+    rng = np.random.default_rng(11)
+    file_names = []
+    for i in range(7):
+        file_name = str(tmp_path / 'frame_{:05d}.npy'.format(i))
+        np.save(file_name, rng.integers(0, 1000, (5, 4)).astype(np.uint16))
+        file_names.append(file_name)
+    return file_names
+
+
+def mapped(file_name):
+    return np.load(file_name, mmap_mode='r')
+
+
+@pytest.mark.parametrize('readers,prefetch', [(1, 0), (1, 2), (3, None)])
+def test_prefetch_frames_in_order(frame_files, readers, prefetch):
+    frames = list(frame_io.prefetch_frames(frame_files, mapped, readers=readers, prefetch=prefetch))
+    assert [file_name for file_name, _ in frames] == frame_files
+    for file_name, frame in frames:
+        np.testing.assert_array_equal(frame, np.load(file_name))
+
+
+# Read ahead frames are read into memory by the reader threads, not when they
+# are merged; without read ahead they are left memory mapped
+def test_prefetched_frames_are_read_in_memory(frame_files):
+    for _, frame in frame_io.prefetch_frames(frame_files, mapped, readers=2):
+        assert not isinstance(frame, np.memmap)
+    for _, frame in frame_io.prefetch_frames(frame_files, mapped):
+        assert isinstance(frame, np.memmap)
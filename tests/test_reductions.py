@@ -0,0 +1,74 @@
+import tracemalloc
+
+import h5py
+import numpy as np
+import pytest
+
+# reductions reads frames through frame_io, which needs fabio
+pytest.importorskip('fabio')
+from data_handling import reductions
+
+N_FRAMES = 10
+FRAME_SHAPE = (7, 4)
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(5)
+    frames = rng.integers(0, 1000, (N_FRAMES,) + FRAME_SHAPE).astype(np.uint16)
+    # A zinger, for clipped_mean to drop
+    frames[2, 3, 1] = 60000
+    return frames
+
+
+def budget_for_rows(rows):
+    return rows * FRAME_SHAPE[1] * (N_FRAMES * (np.dtype(np.uint16).itemsize + reductions.WORKING_BYTES) + reductions.PIXEL_BYTES)
+
+
+def test_band_rows_follows_budget():
+    assert reductions.band_rows(N_FRAMES, FRAME_SHAPE, np.uint16, budget_for_rows(3)) == 3
+    assert reductions.band_rows(N_FRAMES, FRAME_SHAPE, np.uint16, 1) == 1
+    assert reductions.band_rows(N_FRAMES, FRAME_SHAPE, np.uint16, budget_for_rows(100)) == FRAME_SHAPE[0]
+
+
+# 7 rows in bands of 3 leaves a last band of 1 row, which h5py must read into
+# a contiguous array
+@pytest.mark.parametrize('rows', [1, 3, FRAME_SHAPE[0]])
+def test_hdf_bands_match_whole_frames(tmp_path, frames, rows):
+    file_path = str(tmp_path / 'frames.h5')
+    with h5py.File(file_path, 'w') as h5file:
+        h5file['data/frames'] = frames
+
+    names = ['sum', 'mean', 'median', 'clipped_mean']
+    reduced = reductions.reduce_hdf(file_path, 'data/frames', names, memory_budget=budget_for_rows(rows))
+    whole = reductions.reduce_band(frames, names)
+
+    np.testing.assert_array_equal(reduced['median'], np.median(frames, axis=0).astype(np.float32))
+    for name in names:
+        np.testing.assert_array_equal(reduced[name], whole[name])
+    assert reduced['clipped_mean'][3, 1] < 1000
+
+
+# The peak memory of reducing a band stays within what band_rows allows for
+@pytest.mark.parametrize('n_frames', [2, 10, 50])
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32, np.float64])
+def test_band_working_memory_within_budget(n_frames, dtype):
+    band = np.random.default_rng(1).integers(0, 1000, (n_frames, 40, 300)).astype(dtype)
+    band[0, 0, 0] = 60000
+    band_bytes = band[0].size * (n_frames * (band.itemsize + reductions.WORKING_BYTES) + reductions.PIXEL_BYTES)
+    tracemalloc.start()
+    try:
+        reductions.reduce_band(band, reductions.REDUCTIONS)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert band.nbytes + peak <= band_bytes
+
+
+def test_hdf_bands_of_frame_range(tmp_path, frames):
+    file_path = str(tmp_path / 'frames.h5')
+    with h5py.File(file_path, 'w') as h5file:
+        h5file['data/frames'] = frames
+
+    reduced = reductions.reduce_hdf(file_path, 'data/frames', ['median'], start=2, finish=8, memory_budget=budget_for_rows(2))
+    np.testing.assert_array_equal(reduced['median'], np.median(frames[2:9], axis=0).astype(np.float32))
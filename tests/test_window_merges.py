@@ -0,0 +1,201 @@
+import tracemalloc
+
+import h5py
+import numpy as np
+import pytest
+
+from data_handling import accumulators, frame_stats, merge_state, merged_writer, parallel
+
+N_FRAMES = 23
+FRAME_SHAPE = (6, 5)
+# (window, stride): consecutive windows, sliding windows, and windows with
+# frames skipped between them
+WINDOWINGS = [(4, None), (4, 2), (5, 1), (3, 5)]
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(3)
+    return rng.integers(0, 60000, (N_FRAMES,) + FRAME_SHAPE).astype(np.uint16)
+
+
+def serial_merge(frames, window=None, stride=None):
+    accumulator = accumulators.MergeAccumulator(window=window, stride=stride)
+    for i, frame in enumerate(frames):
+        accumulator.add(frame, i)
+    return accumulator.result()
+
+
+def reduce_window(frames):
+    return accumulators.reduce_stack(np.stack(frames))
+
+
+def assert_merged_equal(merged, expected):
+    np.testing.assert_array_equal(merged['sum'], expected['sum'])
+    np.testing.assert_array_equal(merged['avg'], expected['avg'])
+    assert merged['avg'].dtype == expected['avg'].dtype
+
+
+def test_reduce_stack_matches_serial(frames):
+    assert_merged_equal(accumulators.reduce_stack(frames), serial_merge(frames))
+
+
+@pytest.mark.parametrize('window,stride', WINDOWINGS)
+def test_windowed_reduce_stack_matches_serial(frames, window, stride):
+    assert_merged_equal(accumulators.reduce_stack(frames, window=window, stride=stride), serial_merge(frames, window, stride))
+
+
+# Sliding windows need one running sum (and numpy's working buffers) on top of
+# the windows returned, rather than a cumulative sum over the whole stack
+def test_sliding_reduce_stack_memory():
+    stack = np.ones((50, 40, 300), dtype=np.uint16)
+    tracemalloc.start()
+    try:
+        merged = accumulators.reduce_stack(stack, window=40, stride=5)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    frame_bytes = merged['sum'][0].nbytes
+    assert peak <= merged['sum'].nbytes + merged['avg'].nbytes + 4 * frame_bytes
+
+
+@pytest.mark.parametrize('window,stride', WINDOWINGS)
+def test_pool_merge_matches_serial(frames, window, stride):
+    windows = parallel.split_windows(list(frames), window, stride=stride)
+    merged = parallel.merge_windows(windows, reduce_window, workers=2)
+    assert_merged_equal(merged, serial_merge(frames, window, stride))
+
+
+def test_pool_merge_passes_windows_in_order(frames):
+    windows = parallel.split_windows(list(frames), 4, stride=2)
+    written = []
+    assert parallel.merge_windows(windows, reduce_window, workers=2, on_window=lambda avg, sumd: written.append(sumd)) is None
+    np.testing.assert_array_equal(np.stack(written), serial_merge(frames, 4, 2)['sum'])
+
+
+# Windows which count how many have been taken to submit to the pool
+class CountedWindows(list):
+    taken = 0
+
+    def __iter__(self):
+        for window in list.__iter__(self):
+            self.taken += 1
+            yield window
+
+
+def test_pool_merge_bounds_windows_in_flight(frames):
+    windows = CountedWindows(parallel.split_windows(list(frames), 1))
+    in_flight = []
+    parallel.merge_windows(windows, reduce_window, workers=2, on_window=lambda avg, sumd: in_flight.append(windows.taken - len(in_flight)))
+    assert len(in_flight) == N_FRAMES
+    assert max(in_flight) <= parallel.IN_FLIGHT_PER_WORKER * 2 + 1
+
+
+def test_split_windows_keep_partial():
+    assert parallel.split_windows(list(range(7)), 3, keep_partial=True) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert parallel.split_windows(list(range(7)), 3, stride=5) == [[0, 1, 2]]
+
+
+'''
+Merges frames into file_path as merge.py --resume does: windows are appended
+to the file as they are completed and the state is saved alongside them, every
+checkpoint_frames frames and at the end, with the statistics of each frame if
+stats is set. If fail_at is given, the merge stops with an exception after
+that many frames, without saving the state.
+'''
+def resumable_merge(file_path, frames, first_index, window=None, stride=None, checkpoint_frames=merge_state.CHECKPOINT_FRAMES, fail_at=None, stats=False):
+    accumulator = merge_state.load_state(file_path, load_windows=False)
+    n_windows = None
+    if accumulator is None:
+        accumulator = accumulators.MergeAccumulator(window=window, stride=stride)
+    else:
+        merge_state.check_resumable(accumulator, window, stride)
+        n_windows = accumulator.n_windows
+    with merged_writer.MergedWriter(file_path, n_windows=n_windows) as writer:
+        if window:
+            accumulator.on_window = writer.append_window
+        stats = frame_stats.FrameStats() if stats else None
+        checkpoint = merge_state.Checkpointer(writer, accumulator, checkpoint_frames, frame_stats=stats)
+        checkpoint.save()
+        for i, frame in enumerate(frames):
+            if i == fail_at:
+                raise RuntimeError('Interrupted')
+            if stats is not None:
+                stats.add(frame, first_index + i)
+            accumulator.add(frame, first_index + i)
+            checkpoint()
+        if not window:
+            writer.write(accumulator.result())
+        checkpoint.save()
+
+
+def assert_file_matches(file_path, expected):
+    with h5py.File(file_path, 'r') as h5file:
+        np.testing.assert_array_equal(h5file['data/summed'][()], expected['sum'])
+        np.testing.assert_array_equal(h5file['data/averaged'][()], expected['avg'])
+
+
+@pytest.mark.parametrize('window,stride', [(None, None)] + WINDOWINGS)
+@pytest.mark.parametrize('split', [1, 9, 12])
+def test_split_resume_matches_full_merge(tmp_path, frames, window, stride, split):
+    file_path = str(tmp_path / 'merged.h5')
+    resumable_merge(file_path, frames[:split], 0, window, stride)
+    resumable_merge(file_path, frames[split:], split, window, stride)
+
+    assert_file_matches(file_path, serial_merge(frames, window, stride))
+    assert merge_state.load_state(file_path).last_index == N_FRAMES - 1
+
+
+@pytest.mark.parametrize('window,stride', [(None, None)] + WINDOWINGS)
+@pytest.mark.parametrize('fail_at', [0, 3, 14])
+def test_interrupted_merge_resumes_from_checkpoint(tmp_path, frames, window, stride, fail_at):
+    file_path = str(tmp_path / 'merged.h5')
+    with pytest.raises(RuntimeError):
+        resumable_merge(file_path, frames, 0, window, stride, checkpoint_frames=5, fail_at=fail_at)
+
+    last_index = merge_state.load_state(file_path).last_index
+    first = 0 if last_index is None else last_index + 1
+    assert first == fail_at // 5 * 5
+    resumable_merge(file_path, frames[first:], first, window, stride)
+    assert_file_matches(file_path, serial_merge(frames, window, stride))
+
+
+@pytest.mark.parametrize('fail_at', [3, 14])
+def test_interrupted_merge_keeps_frame_stats(tmp_path, frames, fail_at):
+    file_path = str(tmp_path / 'merged.h5')
+    with pytest.raises(RuntimeError):
+        resumable_merge(file_path, frames, 0, 4, checkpoint_frames=5, fail_at=fail_at, stats=True)
+    with h5py.File(file_path, 'r') as h5file:
+        # Only the frames up to the last checkpoint
+        np.testing.assert_array_equal(h5file['data/frame_stats']['index'], np.arange(fail_at // 5 * 5))
+
+    last_index = merge_state.load_state(file_path).last_index
+    first = 0 if last_index is None else last_index + 1
+    resumable_merge(file_path, frames[first:], first, 4, stats=True)
+    expected = frame_stats.FrameStats()
+    for i, frame in enumerate(frames):
+        expected.add(frame, i)
+    with h5py.File(file_path, 'r') as h5file:
+        np.testing.assert_array_equal(h5file['data/frame_stats'][()], expected.table())
+
+
+def test_resume_cuts_frame_stats_after_checkpoint(tmp_path, frames):
+    file_path = str(tmp_path / 'merged.h5')
+    resumable_merge(file_path, frames[:10], 0, stats=True)
+    # Rows written after the last checkpoint, as if a merge had been interrupted
+    with merged_writer.MergedWriter(file_path, n_windows=0) as writer:
+        stats = frame_stats.FrameStats()
+        stats.add(frames[10], 10)
+        writer.append_table('frame_stats', stats.table())
+
+    resumable_merge(file_path, frames[10:], 10, stats=True)
+    with h5py.File(file_path, 'r') as h5file:
+        np.testing.assert_array_equal(h5file['data/frame_stats']['index'], np.arange(N_FRAMES))
+
+
+def test_resume_refuses_file_without_state(tmp_path, frames):
+    file_path = str(tmp_path / 'merged.h5')
+    with merged_writer.MergedWriter(file_path) as writer:
+        writer.write(serial_merge(frames))
+    with pytest.raises(Exception, match='Delete it'):
+        merge_state.load_state(file_path)